@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for Flask-Echelon, run with `python -m benchmarks.run --help`
+"""
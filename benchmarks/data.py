@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import random
+from collections import deque
+
+
+class User:
+    """
+    Minimal stand-in for a flask_login user
+    """
+
+    __slots__ = ('id', 'groups')
+
+    def __init__(self, id, groups):
+        self.id = id
+        self.groups = groups
+
+    def get_id(self):
+        return self.id
+
+    def __repr__(self):
+        return '<User {}>'.format(self.id)
+
+
+class Dataset:
+    """
+    Synthetic permission hierarchy
+
+    Echelons form a forest `depth` levels deep where every Echelon has up
+    to `fanout` children, generated breadth first until `echelons` exist.
+    Each Echelon grants `users_per_echelon` users and one group, and every
+    user belongs to `groups_per_user` groups. Generation is deterministic
+    for a given `seed`.
+
+    :param depth: (int) Levels in the deepest hierarchy
+    :param fanout: (int) Children per Echelon, and number of roots
+    :param echelons: (int) Total number of Echelons
+    :param users_per_echelon: (int) Users granted directly by each Echelon
+    :param groups_per_user: (int) Groups each user belongs to
+    :param users: (int) Size of the user pool, defaults to `echelons`
+    :param groups: (int) Size of the group pool, defaults to a tenth of
+    `echelons`
+    """
+
+    def __init__(self, depth=4, fanout=8, echelons=1000, users_per_echelon=5, groups_per_user=3,
+                 users=None, groups=None, separator='::', seed=0):
+        if depth < 1 or fanout < 1 or echelons < 1:
+            raise ValueError('depth, fanout and echelons must all be at least 1')
+        self.depth = depth
+        self.fanout = fanout
+        self.separator = separator
+        self._random = random.Random(seed)
+
+        self.echelons = self._tree(echelons)
+        user_ids = ['user{}'.format(i) for i in range(users or len(self.echelons))]
+        group_ids = ['group{}'.format(i) for i in range(groups or max(1, len(self.echelons) // 10))]
+        self.users = [User(user_id, self._random.sample(group_ids, min(groups_per_user, len(group_ids))))
+                      for user_id in user_ids]
+        self.documents = [{'echelon': echelon,
+                           'name': echelon,
+                           'help': 'Provides access to {}'.format(echelon),
+                           'users': self._random.sample(user_ids, min(users_per_echelon, len(user_ids))),
+                           'groups': [self._random.choice(group_ids)]}
+                          for echelon in self.echelons]
+        self.leaves = [echelon for echelon in self.echelons if echelon.count(separator) == depth - 1] \
+            or self.echelons
+
+    def __repr__(self):
+        return ('<Dataset depth={} fanout={} echelons={} users={}>'
+                .format(self.depth, self.fanout, len(self.echelons), len(self.users)))
+
+    def _tree(self, count):
+        echelons = []
+        queue = deque(('e{}'.format(i), 1) for i in range(self.fanout))
+        while queue and len(echelons) < count:
+            echelon, level = queue.popleft()
+            echelons.append(echelon)
+            if level < self.depth:
+                queue.extend(('{}{}{}'.format(echelon, self.separator, i), level + 1) for i in range(self.fanout))
+        return echelons
+
+    def user(self):
+        return self._random.choice(self.users)
+
+    def echelon(self):
+        """
+        A random Echelon at the bottom of a hierarchy, the most expensive
+        level to check
+        """
+        return self._random.choice(self.leaves)
+
+    def sample(self, count):
+        return self._random.sample(self.echelons, min(count, len(self.echelons)))
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Measure access checks, membership listing and API throughput
+
+Every operation is timed individually and reported as latency
+percentiles along with the backend round trips it cost on average.
+
+    python -m benchmarks.run --backend mongomock memory sqlite --echelons 5000
+"""
+
+import argparse
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+from flask import Flask
+
+from flask_echelon import EchelonManager, MemberTypes
+from flask_echelon.backends import MemoryBackend, SQLiteBackend
+
+from .data import Dataset
+
+BACKENDS = ('mongomock', 'mongo', 'memory', 'sqlite')
+MODES = {'levels': {},
+         'single_query': {'single_query': True},
+         'cache': {'single_query': True, 'cache_size': 10000},
+         'snapshot': {'snapshot': True},
+         'bitset': {'snapshot': 'bitset'}}
+
+
+def percentile(samples, percent):
+    """
+    Nearest rank percentile of already sorted `samples`
+    """
+    index = max(0, min(len(samples) - 1, int(round(percent / 100 * len(samples))) - 1))
+    return samples[index]
+
+
+@contextmanager
+def mongo_database(backend, uri):
+    if backend == 'mongomock':
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit('mongomock is required for the mongomock backend, `pip install mongomock`')
+        client = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+        client = MongoClient(uri, serverSelectionTimeoutMS=2000)
+    name = 'flask_echelon_benchmark'
+    client.drop_database(name)
+    try:
+        yield client[name]
+    finally:
+        client.drop_database(name)
+
+
+@contextmanager
+def build_manager(backend, mode, dataset, uri):
+    app = Flask(__name__)
+    options = dict(MODES[mode], separator=dataset.separator)
+    if backend in ('mongomock', 'mongo'):
+        with mongo_database(backend, uri) as db:
+            manager = EchelonManager(app, database=db, **options)
+            manager.import_echelons(dataset.documents)
+            yield app, manager
+        return
+    store = MemoryBackend() if backend == 'memory' else SQLiteBackend()
+    manager = EchelonManager(app, backend=store, **options)
+    manager.import_echelons(dataset.documents)
+    yield app, manager
+
+
+def operations(app, manager, dataset, batch):
+    """
+    Named callables, each performing a single operation against random
+    inputs drawn from `dataset`
+    """
+    client = app.test_client()
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, response.status
+        return response
+
+    return {
+        'check_access': lambda: manager.check_access(dataset.user(), dataset.echelon()),
+        'check_access_many': lambda: manager.check_access_many(dataset.user(),
+                                                               [dataset.echelon() for _ in range(batch)]),
+        'member_echelons': lambda: manager.member_echelons(dataset.user(), MemberTypes.USER),
+        'all_echelons': lambda: manager.all_echelons,
+        'api_get_echelon': lambda: get('/echelonapi/echelons/{}'.format(dataset.echelon())),
+        'api_list_echelons': lambda: get('/echelonapi/echelons?limit=100'),
+    }
+
+
+def measure(operation, manager, iterations, warmup):
+    for _ in range(warmup):
+        operation()
+    samples = []
+    queries = manager.query_count
+    for _ in range(iterations):
+        start = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - start)
+    round_trips = (manager.query_count - queries) / iterations
+    samples.sort()
+    return {'iterations': iterations,
+            'p50_us': percentile(samples, 50) * 1e6,
+            'p90_us': percentile(samples, 90) * 1e6,
+            'p99_us': percentile(samples, 99) * 1e6,
+            'ops_per_s': iterations / sum(samples),
+            'round_trips': round_trips}
+
+
+def run(args):
+    dataset = Dataset(depth=args.depth, fanout=args.fanout, echelons=args.echelons,
+                      users_per_echelon=args.users_per_echelon, groups_per_user=args.groups_per_user,
+                      seed=args.seed)
+    results = []
+    for backend in args.backend:
+        for mode in args.mode:
+            with build_manager(backend, mode, dataset, args.mongo_uri) as (app, manager):
+                for name, operation in operations(app, manager, dataset, args.batch).items():
+                    if args.operation and name not in args.operation:
+                        continue
+                    # Listing every Echelon is orders of magnitude slower than a check
+                    iterations = args.iterations if name != 'all_echelons' else max(10, args.iterations // 20)
+                    result = measure(operation, manager, iterations, args.warmup)
+                    result.update(backend=backend, mode=mode, operation=name)
+                    results.append(result)
+                    if args.format == 'text':
+                        print_row(result)
+    return results
+
+
+HEADER = '{:<10} {:<13} {:<18} {:>10} {:>10} {:>10} {:>10} {:>8}'
+ROW = '{backend:<10} {mode:<13} {operation:<18} {p50_us:>10.1f} {p90_us:>10.1f} {p99_us:>10.1f} ' \
+      '{ops_per_s:>10.0f} {round_trips:>8.2f}'
+
+
+def print_row(result):
+    print(ROW.format(**result))
+    sys.stdout.flush()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--backend', nargs='+', choices=BACKENDS, default=['mongomock', 'memory', 'sqlite'])
+    parser.add_argument('--mode', nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--operation', nargs='+', help='only run these operations')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=8)
+    parser.add_argument('--echelons', type=int, default=1000)
+    parser.add_argument('--users-per-echelon', type=int, default=5)
+    parser.add_argument('--groups-per-user', type=int, default=3)
+    parser.add_argument('--batch', type=int, default=10, help='Echelons per check_access_many call')
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=('text', 'json'), default='text')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.format == 'text':
+        print(HEADER.format('backend', 'mode', 'operation', 'p50 us', 'p90 us', 'p99 us', 'ops/s', 'trips'))
+    results = run(args)
+    if args.format == 'json':
+        json.dump({'dataset': vars(args), 'results': results}, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
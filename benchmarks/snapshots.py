@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the set based `EchelonSnapshot`, the bitset based `BitsetSnapshot`
+and the memory mapped `MappedSnapshot`
+
+Reports the time and memory to build each snapshot, the memory an
+effective permission set takes per member, and check latency. A mapped
+snapshot holds almost nothing on the heap, its file is shared by every
+process through the page cache and reported separately.
+
+    python -m benchmarks.snapshots --echelons 8000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from flask_echelon.snapshot import BitsetSnapshot, EchelonSnapshot, MappedSnapshot, write_snapshot
+
+from .data import Dataset
+from .run import percentile
+
+
+def deep_size(value):
+    """
+    Bytes held by a frozenset of strings or an int, counting each string
+    """
+    if isinstance(value, int):
+        return sys.getsizeof(value)
+    return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+
+
+def build(factory):
+    """
+    Build twice, timing the first build and tracing allocations of the
+    second, as tracing slows allocation down
+
+    :return: (snapshot, seconds, bytes)
+    """
+    start = time.perf_counter()
+    factory()
+    duration = time.perf_counter() - start
+    tracemalloc.start()
+    snapshot = factory()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return snapshot, duration, size
+
+
+def latency(operation, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return percentile(samples, 50) * 1e6, percentile(samples, 99) * 1e6
+
+
+def run(args):
+    dataset = Dataset(depth=args.depth, fanout=args.fanout, echelons=args.echelons,
+                      users_per_echelon=args.users_per_echelon, groups_per_user=args.groups_per_user,
+                      seed=args.seed)
+    ids = {echelon: i for i, echelon in enumerate(dataset.echelons)}
+    members = len(dataset.users) + len({group for user in dataset.users for group in user.groups})
+    directory = tempfile.TemporaryDirectory()
+    path = os.path.join(directory.name, 'echelons.snapshot')
+
+    def mapped():
+        write_snapshot(path, dataset.documents, dataset.separator)
+        return MappedSnapshot(path)
+
+    candidates = {'sets': lambda: EchelonSnapshot(dataset.documents, dataset.separator),
+                  'bitset': lambda: BitsetSnapshot(dataset.documents, ids, dataset.separator),
+                  'mmap': mapped}
+    results = {}
+    for name, factory in candidates.items():
+        snapshot, duration, size = build(factory)
+        shared = os.path.getsize(path) if name == 'mmap' else 0
+
+        def identity():
+            user = dataset.user()
+            return frozenset([user.get_id()]), frozenset(user.groups)
+
+        # What a member's effective permissions cost once materialized
+        effective = []
+        for user in dataset.users[:args.sample]:
+            users, groups = frozenset([user.get_id()]), frozenset(user.groups)
+            effective.append(snapshot.mask(users, groups) if name == 'bitset' else
+                             frozenset(snapshot.member_echelons(users, groups)))
+
+        operations = {'check': lambda: snapshot.check(dataset.echelon(), *identity()),
+                      'check_many': lambda: snapshot.check_many([dataset.echelon() for _ in range(args.batch)],
+                                                                *identity()),
+                      'member_echelons': lambda: snapshot.member_echelons(*identity())}
+        results[name] = {'build_ms': duration * 1e3,
+                         'snapshot_bytes_per_member': size / members,
+                         'shared_bytes_per_member': shared / members,
+                         'effective_bytes_per_user': sum(map(deep_size, effective)) / len(effective),
+                         'latency_us': {op: latency(operation, args.iterations)
+                                        for op, operation in operations.items()}}
+    directory.cleanup()
+    return dataset, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--echelons', type=int, default=8000)
+    parser.add_argument('--users-per-echelon', type=int, default=5)
+    parser.add_argument('--groups-per-user', type=int, default=3)
+    parser.add_argument('--batch', type=int, default=10, help='Echelons per check_many call')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--sample', type=int, default=500, help='users whose effective permissions are measured')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    dataset, results = run(args)
+    print(dataset)
+    print('{:<8} {:>10} {:>14} {:>14} {:>14} {:>22} {:>22} {:>22}'.format(
+        'snapshot', 'build ms', 'bytes/member', 'shared B/mem', 'effective B', 'check p50/p99 us',
+        'check_many p50/p99 us', 'member_echelons p50/p99'))
+    for name, result in results.items():
+        latencies = ['{:.1f} / {:.1f}'.format(*result['latency_us'][op])
+                     for op in ('check', 'check_many', 'member_echelons')]
+        print('{:<8} {:>10.1f} {:>14.0f} {:>14.0f} {:>14.0f} {:>22} {:>22} {:>22}'.format(
+            name, result['build_ms'], result['snapshot_bytes_per_member'], result['shared_bytes_per_member'],
+            result['effective_bytes_per_user'], *latencies))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,9 @@ __author__ = """Jesse Roberts"""
 __email__ = 'jesse@jesseops.net'
 __version__ = '0.1.0'
 
+import sys
 from enum import Enum
+from importlib import import_module
 
 
 class MemberTypes(Enum):
@@ -16,4 +18,25 @@ class AccessCheckFailed(Exception):
     pass
 
 
-from .flask_echelon import EchelonManager, MemberTypes
+class ImportFailed(ValueError):
+    """
+    An invalid document stopped `import_echelons` after `imported`
+    Echelons had already been written
+    """
+
+    def __init__(self, message, imported):
+        super().__init__(message)
+        self.imported = imported
+
+
+if sys.version_info < (3, 7):
+    from .flask_echelon import EchelonManager  # noqa: F401
+else:
+    def __getattr__(name):
+        """
+        Import the manager, and with it Flask and the backends, only once
+        it is first used
+        """
+        if name == 'EchelonManager':
+            return import_module('.flask_echelon', __name__).EchelonManager
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
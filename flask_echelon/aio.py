@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+import inspect
+from functools import wraps
+
+from flask import current_app
+from flask_login import current_user
+from pymongo import ASCENDING, ReturnDocument
+
+from . import AccessCheckFailed, MemberTypes
+from .backends.effective import collect_grants, defined_updates, member_key, refresh_query, refresh_writes
+from .backends.mongo import (INDEXES, add_members_update, define_update, descendants_filter, membership_filter,
+                             remove_members_update, version_id)
+from .flask_echelon import _EchelonQueries
+
+
+class _AsyncEffectivePermissions:
+    """
+    Keeps the materialized view of `EffectivePermissions` up to date
+    after writes made by an `AsyncEchelonManager`, in the same round trips
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    @property
+    def collection(self):
+        return self.manager.db['{}_effective'.format(self.manager._mongo_collection)]
+
+    async def create_indexes(self):
+        await self.collection.create_index([('granted', ASCENDING)], name='granted_1')
+        await self.collection.create_index([('echelons', ASCENDING)], name='echelons_1')
+
+    async def defined(self, echelons):
+        updates = defined_updates(echelons, self.manager._separator)
+        if updates:
+            self.manager.query_count += 1
+            await self.collection.bulk_write(updates, ordered=False)
+
+    async def removed(self, echelon):
+        self.manager.query_count += 2
+        keys = [d['_id'] async for d in self.collection.find({'granted': {'$in': [echelon]}}, {'_id': 1})]
+        await self.collection.update_many({'echelons': echelon}, {'$pull': {'echelons': echelon}})
+        await self.refresh(keys)
+
+    async def refresh(self, keys):
+        refresh = refresh_query(keys)
+        if refresh is None:
+            return
+        granted, query = refresh
+        manager = self.manager
+        manager.query_count += 1
+        async for document in manager._collection.find(query, {'_id': 0, 'echelon': 1, 'users': 1, 'groups': 1}):
+            collect_grants(granted, document)
+
+        roots = set().union(*granted.values())
+        echelons = []
+        if roots:
+            manager.query_count += 1
+            matches = manager._collection.find(descendants_filter(roots, manager._separator), {'_id': 0, 'echelon': 1},
+                                               sort=[('echelon', 1)])
+            echelons = [e['echelon'] async for e in matches]
+        manager.query_count += 1
+        await self.collection.bulk_write(refresh_writes(granted, echelons, manager._separator), ordered=False)
+
+
+class AsyncEchelonManager(_EchelonQueries):
+    """
+    Async Echelon Manager
+
+    Mirrors the public API of `EchelonManager` for asyncio based apps,
+    backed by an async Mongo driver such as Motor. Every level of a
+    hierarchy is resolved in a single query, nothing blocks the event loop
+    so concurrent checks overlap their I/O.
+
+    The `EchelonApi` blueprint is synchronous and is not registered.
+
+    Pass `effective=True` when synchronous managers sharing the collection
+    use `effective=True`, so writes made here also maintain their
+    materialized effective permissions.
+    """
+
+    def __init__(self, app=None, database=None, collection='echelons', separator='::', group_resolver=None,
+                 effective=False):
+        self._db = database
+        self._separator = separator
+        self._mongo_collection = collection
+        self._meta_collection = '{}_meta'.format(collection)
+        # May return groups directly or be a coroutine function
+        self._group_resolver = group_resolver
+        self.effective = _AsyncEffectivePermissions(self) if effective else None
+        self.query_count = 0
+        if app:
+            self.app = app
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.echelon_manager = self
+
+    async def create_indexes(self):
+        for name, spec in INDEXES.items():
+            await self._collection.create_index(spec['key'], name=name, unique=spec.get('unique', False))
+        if self.effective is not None:
+            await self.effective.create_indexes()
+
+    async def add_member(self, echelon, member, member_type):
+        members = self._members(member, member_type)
+        await self._collection.update_one({'echelon': echelon}, add_members_update(member_type, members))
+        if self.effective is not None:
+            await self.effective.refresh(member_key(member_type, member) for member in members)
+        await self._bump_generation(echelon)
+
+    async def remove_member(self, echelon, member, member_type):
+        members = self._members(member, member_type)
+        await self._collection.update_one({'echelon': echelon}, remove_members_update(member_type, members))
+        if self.effective is not None:
+            await self.effective.refresh(member_key(member_type, member) for member in members)
+        await self._bump_generation(echelon)
+
+    async def define_echelon(self, echelon, name=None, help=None):
+        """
+        Creates or updates an Echelon definition
+
+        :param echelon: (str) Representation of a single Echelon within
+        a permission hierarchy
+        :param name: (str) Pretty name for a given Echelon
+        :param help: (str) Help text defining Echelon purpose/scope
+        :return: None
+        """
+        payload = define_update(echelon, *self._definition(echelon, name, help))
+        await self._collection.update_one({'echelon': echelon}, payload, upsert=True)
+        if self.effective is not None:
+            await self.effective.defined([echelon])
+        await self._bump_generation(echelon)
+
+    async def get_echelon(self, echelon):
+        self.query_count += 1
+        return await self._collection.find_one({'echelon': echelon}, {'_id': 0})
+
+    async def remove_echelon(self, echelon):
+        await self._collection.delete_many({'echelon': echelon})
+        if self.effective is not None:
+            await self.effective.removed(echelon)
+        await self._bump_generation(echelon)
+
+    async def check_access(self, member, echelon, member_type=MemberTypes.USER):
+        """
+        Verify if a member has access to an Echelon, see
+        `EchelonManager.check_access`
+
+        :return: Bool
+        """
+        hierarchy = self._hierarchy(echelon)
+        users, groups = await self._identity(member, member_type)
+        if not users and not groups:
+            return False
+        query = membership_filter(users, groups)
+        query['echelon'] = {'$in': hierarchy}
+        self.query_count += 1
+        return await self._collection.find_one(query, {'_id': 1}) is not None
+
+    async def check_access_many(self, member, echelons, member_type=MemberTypes.USER):
+        """
+        Verify if a member has access to each of several Echelons with
+        a single query
+
+        :return: dict mapping each Echelon to Bool
+        """
+        hierarchies = {echelon: self._hierarchy(echelon) for echelon in echelons}
+        users, groups = await self._identity(member, member_type)
+        granted = set()
+        if users or groups:
+            query = membership_filter(users, groups)
+            query['echelon'] = {'$in': sorted({level for levels in hierarchies.values() for level in levels})}
+            self.query_count += 1
+            granted = {e['echelon'] async for e in self._collection.find(query, {'_id': 0, 'echelon': 1})}
+        return {echelon: not granted.isdisjoint(levels) for echelon, levels in hierarchies.items()}
+
+    async def granted_echelons(self, member, member_type=MemberTypes.USER):
+        """
+        Retrieve the Echelons a member, or any of their groups, is
+        granted directly
+
+        :return: frozenset
+        """
+        users, groups = await self._identity(member, member_type)
+        if not users and not groups:
+            return frozenset()
+        self.query_count += 1
+        direct = self._collection.find(membership_filter(users, groups), {'_id': 0, 'echelon': 1})
+        return frozenset([e['echelon'] async for e in direct])
+
+    async def member_echelons(self, member, member_type):
+        """
+        Retrieve every defined Echelon a member can access, either
+        directly or inherited from a level above it
+
+        :return: list, sorted by name
+        """
+        granted = await self.granted_echelons(member, member_type)
+        if not granted:
+            return []
+        self.query_count += 1
+        matches = self._collection.find(descendants_filter(granted, self._separator), {'_id': 0, 'echelon': 1},
+                                        sort=[('echelon', 1)])
+        return [e['echelon'] async for e in matches]
+
+    @property
+    async def all_echelons(self):
+        """
+        Retrieve all Echelons as a dictionary where the top level key is
+        the Echelon and the value is the data for the corresponding Echelon
+
+        Use as `await manager.all_echelons`
+
+        :return: dict
+        """
+        self.query_count += 1
+        return {e['echelon']: e async for e in self._collection.find({}, {'_id': 0})}
+
+    @property
+    def db(self):
+        """
+        Access a database instance. Prioritizes a DB assigned
+        to the `AsyncEchelonManager` instance, falling back to the
+        previously initialized app if it exists.
+
+        :return: `motor.motor_asyncio.AsyncIOMotorDatabase`
+        """
+        if self._db is not None:
+            return self._db
+        if getattr(self, 'app', None):
+            try:
+                return self.app.db
+            except AttributeError:
+                pass  # We'll handle this failure at the end of the method
+        raise Exception('No database defined on manager or current_app')
+
+    @property
+    def _collection(self):
+        return self.db[self._mongo_collection]
+
+    async def _identity(self, member, member_type):
+        if member_type is MemberTypes.USER:
+            if self._group_resolver is not None:
+                groups = self._group_resolver(member)
+                if inspect.isawaitable(groups):
+                    groups = await groups
+            else:
+                groups = getattr(member, 'groups', [])
+            return frozenset([member.get_id()]), frozenset(groups)
+        if member_type is MemberTypes.GROUP:
+            return frozenset(), frozenset([member])
+        return frozenset(), frozenset()
+
+    async def _bump_generation(self, echelon):
+        # Lets synchronous managers in other processes drop their caches
+        meta = self.db[self._meta_collection]
+        generation = (await meta.find_one_and_update({'_id': 'generation'}, {'$inc': {'value': 1}},
+                                                     upsert=True, return_document=ReturnDocument.AFTER))['value']
+        await meta.update_one({'_id': version_id(echelon)}, {'$max': {'value': generation}}, upsert=True)
+
+
+async def has_access(echelon):
+    """
+    Check if `current_user` has access to an Echelon in `current_app`
+    using its `AsyncEchelonManager`
+
+    :return: bool
+    """
+    if not hasattr(current_app, 'echelon_manager'):
+        raise Exception("Flask app '{!r}' does not have a bound interaction manager".format(current_app))
+    return await current_app.echelon_manager.check_access(current_user, echelon)
+
+
+def require_echelon(echelon):
+    """
+    Check if `current_user` has access to an Echelon before running an
+    async view. If check fails, raise `AccessCheckFailed`
+    """
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if await has_access(echelon):
+                return await func(*args, **kwargs)
+            raise AccessCheckFailed('{} does not have access to Echelon "{}"'.format(current_user, echelon))
+
+        return wrapper
+
+    return decorator
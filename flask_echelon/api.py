@@ -1,9 +1,10 @@
+import json
 import logging
 
-from flask import Blueprint, current_app, jsonify, request, abort
+from flask import Blueprint, Response, current_app, jsonify, request, abort, stream_with_context, url_for
 from werkzeug.local import LocalProxy
 
-from flask_echelon import __version__
+from flask_echelon import ImportFailed, __version__
 from .flask_echelon import MemberTypes
 
 manager = LocalProxy(lambda: current_app.echelon_manager)
@@ -13,6 +14,18 @@ EchelonApi = Blueprint('EchelonApi', __name__, url_prefix='/echelonapi')
 api = EchelonApi
 
 
+def _not_modified(etag):
+    """
+    Short circuit a conditional GET whose `If-None-Match` still matches
+    `etag`, before any Echelon is read
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
 @api.route('/')
 def index():
     return f'{EchelonApi.name} v{__version__}'
@@ -20,50 +33,154 @@ def index():
 
 @api.route('/echelons')
 def echelons():
-    return jsonify(list(manager.all_echelons.values()))
+    """
+    List Echelons. Supports keyset pagination with `after` and `limit`,
+    an anchored `prefix` filter and a comma separated `fields` projection.
+    When a page is full a `Link` header points at the next one.
+
+    Tagged with the collection version, a matching `If-None-Match` is
+    answered with 304 without reading any Echelon.
+    """
+    etag = str(manager.version())
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+    response = _list_echelons()
+    response.set_etag(etag)
+    return response
+
+
+def _list_echelons():
+    args = request.args
+    if not {'after', 'limit', 'prefix', 'fields'} & set(args):
+        return jsonify(list(manager.all_echelons.values()))
+
+    fields = args['fields'].split(',') if 'fields' in args else None
+    limit = args.get('limit', type=int)
+    try:
+        page = manager.list_echelons(after=args.get('after'), limit=limit, prefix=args.get('prefix'), fields=fields)
+    except ValueError as e:
+        abort(400, str(e))
+    response = jsonify(page)
+    if limit and len(page) == limit:
+        next_args = dict(args.items(), after=page[-1]['echelon'])
+        response.headers['Link'] = '<{}>; rel="next"'.format(url_for('.echelons', **next_args))
+    return response
 
 
 @api.route('/echelons/<echelon>')
 def get_echelon(echelon):
+    # Read before the Echelon so a concurrent write can only make the tag stale.
+    # Version 0 means the Echelon was never written, ie it may not exist.
+    version = manager.version(echelon)
+    etag = str(version) if version else None
+    if etag is not None:
+        not_modified = _not_modified(etag)
+        if not_modified:
+            return not_modified
     e = manager.get_echelon(echelon)
     if e:
-        return jsonify(e)
+        response = jsonify(e)
+        if etag is not None:
+            response.set_etag(etag)
+        return response
     return f'{echelon} does not exist', 404
 
 
+@api.route('/echelons/<echelon>/members')
+def echelon_members(echelon):
+    """
+    Every member with effective access to an Echelon and the level
+    granting it. Optionally filtered by `member_type` ('users' or
+    'groups'), streamed as NDJSON if asked for with `format=ndjson` or
+    an `Accept: application/x-ndjson` header.
+    """
+    try:
+        member_type = MemberTypes(request.args['member_type']) if 'member_type' in request.args else None
+        members = manager.members_with_access(echelon, member_type)
+    except ValueError as e:
+        abort(400, str(e))
+
+    if request.args.get('format') == 'ndjson' or \
+            request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+        def generate():
+            for member in members:
+                yield json.dumps(member) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    return jsonify(list(members))
+
+
 @api.route('/echelons/<echelon>', methods=['PUT'])
 def create_echelon(echelon):
-    if manager.get_echelon(echelon):
-        abort(409, f'Tried to create {echelon} but it already exists!')
     e = request.get_json()
     if e.get('echelon', echelon) != echelon:
         abort(400, f'Tried to create {echelon} but was provided inconsistent echelon in request: {e.get("echelon")}')
-    manager.define_echelon(echelon, name=e.get('name'), help=e.get('help'))
-    for member_type in MemberTypes:
-        if member_type.value in e:
-            manager.add_member(echelon, e[member_type.value], member_type=member_type)
+    try:
+        result = manager.apply_changes(echelon, set={key: e[key] for key in ('name', 'help', 'users', 'groups')
+                                                     if key in e}, create=True)
+    except (TypeError, ValueError) as error:
+        abort(400, str(error))
+    if not result['created']:
+        abort(409, f'Tried to create {echelon} but it already exists!')
     return f'{echelon} created', 201
 
 
 @api.route('/echelons/<echelon>', methods=['POST'])
 def edit_echelon(echelon):
-    req = request.get_json()
-    current_echelon = manager.get_echelon(echelon)
-    if not current_echelon:
+    """
+    Update the name or help of an Echelon and add or remove members, all
+    in a single atomic write
+    """
+    req = request.get_json() or {}
+    if not isinstance(req, dict):
+        abort(400, f'Expected a JSON object to update {echelon} with')
+    try:
+        result = manager.apply_changes(echelon, set={key: req[key] for key in ('name', 'help') if key in req},
+                                       add=req.get('add'), remove=req.get('remove'))
+    except (TypeError, ValueError) as error:
+        abort(400, str(error))
+    if not result['matched']:
         abort(404, f'{echelon} does not exist, have you created it?')
-    if 'name' in req or 'help' in req:
-        manager.define_echelon(echelon,
-                               name=req.get('name', current_echelon['name']),
-                               help=req.get('help', current_echelon['help']))
-
-    for member_type in MemberTypes:
-        if member_type.value in req.get('add', {}):
-            manager.add_member(echelon, req['add'][member_type.value], member_type)
-        if member_type.value in req.get('remove', {}):
-            manager.remove_member(echelon, req['remove'][member_type.value], member_type)
     return f'{echelon} updated', 200
 
 
+@api.route('/bulk', methods=['POST'])
+def bulk_update_members():
+    req = request.get_json()
+    try:
+        results = manager.bulk_update_members(req['ops'], batch_size=req.get('batch_size', 1000))
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        abort(400, f'Invalid bulk update: {e!r}')
+    return jsonify({'batches': results})
+
+
+@api.route('/export')
+def export_echelons():
+    try:
+        echelons = manager.export_echelons(batch_size=request.args.get('batch_size', 1000, type=int))
+    except ValueError as e:
+        abort(400, f'Invalid export: {e!r}')
+
+    def generate():
+        for echelon in echelons:
+            yield json.dumps(echelon) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@api.route('/import', methods=['POST'])
+def import_echelons():
+    try:
+        imported = manager.import_echelons(request.stream, batch_size=request.args.get('batch_size', 1000, type=int))
+    except ImportFailed as e:
+        # Earlier batches were written, tell the caller how many
+        return jsonify({'error': str(e), 'imported': e.imported}), 400
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        abort(400, f'Invalid import: {e!r}')
+    return jsonify({'imported': imported})
+
+
 @api.route('/echelons/<echelon>', methods=['DELETE'])
 def delete_echelon(echelon):
     manager.remove_echelon(echelon)
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+from .base import Backend
+from .memory import MemoryBackend
+from .mongo import MongoBackend
+from .sqlite import SQLiteBackend
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+
+class Backend:
+    """
+    Storage for Echelon definitions and their members
+
+    `EchelonManager` performs every read and write through a backend, so
+    each implementation must provide all of the methods below. Echelons
+    are returned as dicts with `echelon`, `name`, `help`, `users` and
+    `groups` keys, in the order they were defined.
+
+    `query_count` counts the round trips made to the underlying store.
+    """
+
+    def __init__(self):
+        self.query_count = 0
+
+    #: Whether `is_member` answers for every level of a hierarchy with a
+    #: single point lookup, making a query per level pointless
+    indexed_checks = False
+
+    def create_indexes(self):
+        """
+        Create whatever indexes the backend relies on
+
+        :return: None
+        """
+
+    def verify_indexes(self):
+        """
+        Compare the indexes the backend relies on with those which exist
+
+        :return: list of (str) problems, empty if every index is in place
+        """
+        return []
+
+    def echelon_ids(self, echelons):
+        """
+        Dense integer IDs of `echelons`, assigning the next free ones to
+        any seen for the first time. Assignments are stored with the
+        generation, so IDs never change and are never reused, and every
+        process sharing the store agrees on them.
+
+        :param echelons: iterable of (str) Echelons
+        :return: dict of (str) Echelon to (int) ID
+        """
+        raise NotImplementedError
+
+    def rebuild_effective(self):
+        """
+        Recreate the materialized effective permissions from the Echelons
+
+        :return: (int) number of members in the view
+        """
+        raise NotImplementedError('{} has no materialized effective permissions'.format(type(self).__name__))
+
+    def check_effective(self):
+        """
+        Compare the materialized effective permissions with the Echelons
+
+        :return: list of (str) problems, empty if they are consistent
+        """
+        raise NotImplementedError('{} has no materialized effective permissions'.format(type(self).__name__))
+
+    def explain(self, users, groups, levels, separator):
+        """
+        Explain every query a check of `levels` issues, warning about any
+        which scans the whole store
+
+        :param levels: list of (str) each level of a hierarchy, top first
+        :return: dict of (str) query name to list of (str) plan stages
+        """
+        raise NotImplementedError('{} cannot explain its queries'.format(type(self).__name__))
+
+    def define(self, echelon, name, help):
+        """
+        Create an Echelon with no members, or update the name and help
+        of an existing Echelon leaving its members untouched
+
+        :return: None
+        """
+        raise NotImplementedError
+
+    def get(self, echelon):
+        """
+        :return: dict or None if `echelon` is not defined
+        """
+        raise NotImplementedError
+
+    def remove(self, echelon):
+        """
+        :return: None
+        """
+        raise NotImplementedError
+
+    def add_members(self, echelon, member_type, members):
+        """
+        Add `members` to an Echelon, ignoring those already present.
+        Does nothing if `echelon` is not defined.
+
+        :param member_type: (`MemberTypes`)
+        :param members: (list)
+        :return: None
+        """
+        raise NotImplementedError
+
+    def remove_members(self, echelon, member_type, members):
+        """
+        :param member_type: (`MemberTypes`)
+        :param members: (list)
+        :return: None
+        """
+        raise NotImplementedError
+
+    def bulk_update(self, ops):
+        """
+        Apply a batch of membership changes with as few round trips as
+        the store allows. Ops may be applied in any order.
+
+        :param ops: list of (action, echelon, member_type, members) where
+        action is 'add' or 'remove'
+        :return: dict with the number of `operations`, `matched` and
+        `modified` Echelons
+        """
+        raise NotImplementedError
+
+    def apply_changes(self, echelon, fields=None, add=None, remove=None, create=False):
+        """
+        Apply several changes to one Echelon in a single atomic write, so
+        no reader sees them half applied
+
+        :param fields: dict overwriting any of `name`, `help` and the
+        `users` or `groups` lists
+        :param add: dict of (`MemberTypes`) to list of members to add,
+        for types not in `fields`
+        :param remove: dict of (`MemberTypes`) to list of members to
+        remove, for types not in `fields` and disjoint from `add`
+        :param create: (bool) only create the Echelon from `fields`,
+        which then holds all of them, leaving an existing one untouched
+        :return: dict with `matched` (the Echelon existed), `modified`
+        and `created` bools
+        """
+        raise NotImplementedError
+
+    def find_all(self, batch_size=1000):
+        """
+        Iterate over every Echelon, fetching at most `batch_size` of them
+        from the store at a time
+
+        :return: iterable of dicts
+        """
+        raise NotImplementedError
+
+    def find_page(self, after=None, limit=None, prefix=None, fields=None):
+        """
+        Echelons ordered by name, for keyset pagination on the unique
+        echelon index
+
+        :param after: (str) only return Echelons sorting after this one
+        :param limit: (int) maximum number of Echelons to return
+        :param prefix: (str) only return Echelons starting with this
+        :param fields: (iterable) keys to return besides `echelon`,
+        defaults to all of them
+        :return: list of dicts
+        """
+        raise NotImplementedError
+
+    def replace(self, documents):
+        """
+        Create or entirely replace a batch of Echelons, members included
+
+        :param documents: list of dicts
+        :return: None
+        """
+        raise NotImplementedError
+
+    def is_member(self, users, groups, levels):
+        """
+        Verify if any of `users` or `groups` is granted any of `levels`
+
+        :param users: (frozenset) user ids
+        :param groups: (frozenset) group names
+        :param levels: (list) Echelons
+        :return: Bool
+        """
+        raise NotImplementedError
+
+    def granted(self, users, groups, levels=None):
+        """
+        Echelons granted directly to any of `users` or `groups`,
+        restricted to `levels` if given
+
+        :return: set
+        """
+        raise NotImplementedError
+
+    def find_levels(self, levels):
+        """
+        Documents of every defined Echelon in `levels`, fetched together,
+        with at least their `echelon`, `users` and `groups`
+
+        :return: iterable of dicts, in any order
+        """
+        raise NotImplementedError
+
+    def descendants(self, echelons, separator):
+        """
+        Defined Echelons which are in `echelons` or beneath them
+
+        :return: list, sorted by name
+        """
+        raise NotImplementedError
+
+    def bump_generation(self, echelons=()):
+        """
+        Increment the generation shared by every process using this store,
+        recording it as the version of each of `echelons`
+
+        :param echelons: iterable of (str) Echelons which were written to
+        :return: (int) new generation
+        """
+        raise NotImplementedError
+
+    def generation(self):
+        """
+        :return: (int) current generation
+        """
+        raise NotImplementedError
+
+    def version(self, echelon):
+        """
+        Generation at which `echelon` was last written to
+
+        :return: (int) 0 if it never was
+        """
+        raise NotImplementedError
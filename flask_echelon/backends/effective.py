@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+from pymongo import ASCENDING, DeleteOne, ReplaceOne, UpdateMany
+
+from .. import MemberTypes
+
+
+def member_key(member_type, member):
+    return {'member_type': member_type.value, 'member': member}
+
+
+def levels(echelon, separator):
+    """
+    Every level of `echelon`, top first
+    """
+    parts = echelon.split(separator)
+    return [separator.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+def effective_echelons(granted, echelons, separator):
+    """
+    Those of `echelons` which are in `granted` or beneath one of them
+
+    :return: list
+    """
+    return [echelon for echelon in echelons if not granted.isdisjoint(levels(echelon, separator))]
+
+
+def defined_updates(echelons, separator):
+    """
+    Updates making newly defined `echelons` effective for every member
+    granted a level above them
+
+    :return: list of `UpdateMany`
+    """
+    return [UpdateMany({'granted': {'$in': levels(echelon, separator)[:-1]}}, {'$addToSet': {'echelons': echelon}})
+            for echelon in echelons if separator in echelon]
+
+
+def refresh_query(keys):
+    """
+    Query for every Echelon granted directly to one of the members `keys`
+
+    :param keys: iterable of dicts as built by `member_key`
+    :return: (dict of (member_type, member) to an empty set to collect
+    their grants in, dict) or None if there are no keys
+    """
+    keys = {(key['member_type'], key['member']) for key in keys}
+    if not keys:
+        return None
+    wanted = {member_type.value: {member for t, member in keys if t == member_type.value}
+              for member_type in MemberTypes}
+    query = {'$or': [{member_type: {'$in': list(members)}} for member_type, members in wanted.items() if members]}
+    return {key: set() for key in keys}, query
+
+
+def collect_grants(granted, document):
+    """
+    Record the Echelon of `document` as granted to each of its members
+    found in `granted`, as returned by `refresh_query`
+    """
+    for member_type in MemberTypes:
+        for member in document.get(member_type.value, ()):
+            grants = granted.get((member_type.value, member))
+            if grants is not None:
+                grants.add(document['echelon'])
+
+
+def refresh_writes(granted, echelons, separator):
+    """
+    Writes replacing the document of each member in `granted`, or
+    deleting it once nothing is granted to them
+
+    :param granted: dict of (member_type, member) to set of Echelons
+    :param echelons: list of every defined Echelon their grants reach
+    :return: list of `ReplaceOne` and `DeleteOne`
+    """
+    writes = []
+    for (member_type, member), grants in granted.items():
+        key = {'member_type': member_type, 'member': member}
+        if grants:
+            document = {'_id': key, 'granted': sorted(grants),
+                        'echelons': effective_echelons(grants, echelons, separator)}
+            writes.append(ReplaceOne({'_id': key}, document, upsert=True))
+        else:
+            writes.append(DeleteOne({'_id': key}))
+    return writes
+
+
+class EffectivePermissions:
+    """
+    Materialized view of every member's effective Echelons, kept in a
+    `<collection>_effective` collection next to the echelons collection
+
+    Each user and group granted anything has one document, keyed by
+    member, holding the Echelons granted to it directly and every defined
+    Echelon those grants reach, descendants included::
+
+        {'_id': {'member_type': 'users', 'member': 'alice'},
+         'granted': ['billing'],
+         'echelons': ['billing', 'billing::refunds', 'billing::refunds::issue']}
+
+    A check is then a point lookup on the `_id` index. Writes only
+    recompute the documents of the members they touch, `rebuild`
+    recreates the whole view from the echelons collection and `check`
+    reports any drift between the two.
+
+    :param backend: (`MongoBackend`) owning the echelons collection
+    :param separator: (str) Echelon hierarchy separator
+    """
+
+    def __init__(self, backend, separator='::'):
+        self.backend = backend
+        self.separator = separator
+
+    @property
+    def collection_name(self):
+        return '{}_effective'.format(self.backend.collection_name)
+
+    @property
+    def collection(self):
+        return self.backend.db[self.collection_name]
+
+    def create_indexes(self, collection=None):
+        collection = collection if collection is not None else self.collection
+        self.backend.query_count += 2
+        collection.create_index([('granted', ASCENDING)], name='granted_1')
+        collection.create_index([('echelons', ASCENDING)], name='echelons_1')
+
+    def is_member(self, users, groups, levels):
+        self.backend.query_count += 1
+        query = {'_id': {'$in': self._keys(users, groups)}, 'echelons': {'$in': list(levels)}}
+        return self.collection.find_one(query, {'_id': 1}) is not None
+
+    def granted(self, users, groups, levels=None):
+        self.backend.query_count += 1
+        granted = set()
+        for document in self.collection.find({'_id': {'$in': self._keys(users, groups)}}, {'granted': 1}):
+            granted.update(document['granted'])
+        if levels is not None:
+            granted.intersection_update(levels)
+        return granted
+
+    def members_granted(self, echelons):
+        """
+        Keys of the members granted any of `echelons` directly
+
+        :return: list of dicts
+        """
+        self.backend.query_count += 1
+        return [d['_id'] for d in self.collection.find({'granted': {'$in': list(echelons)}}, {'_id': 1})]
+
+    def defined(self, echelons):
+        """
+        Make newly defined `echelons` effective for every member granted
+        a level above them
+        """
+        updates = defined_updates(echelons, self.separator)
+        if updates:
+            self.backend.query_count += 1
+            self.collection.bulk_write(updates, ordered=False)
+
+    def removed(self, echelon):
+        """
+        Drop a removed Echelon from every member, recomputing those which
+        were granted it directly
+        """
+        keys = self.members_granted([echelon])
+        self.backend.query_count += 1
+        self.collection.update_many({'echelons': echelon}, {'$pull': {'echelons': echelon}})
+        self.refresh(keys)
+
+    def refresh(self, keys):
+        """
+        Recompute the documents of the members `keys` from the echelons
+        collection, in three round trips however many members there are
+
+        :param keys: iterable of dicts as built by `member_key`
+        """
+        refresh = refresh_query(keys)
+        if refresh is None:
+            return
+        granted, query = refresh
+        self.backend.query_count += 1
+        for document in self.backend.collection.find(query, {'_id': 0, 'echelon': 1, 'users': 1, 'groups': 1}):
+            collect_grants(granted, document)
+
+        roots = set().union(*granted.values())
+        echelons = self.backend.descendants(roots, self.separator) if roots else []
+        self.backend.query_count += 1
+        self.collection.bulk_write(refresh_writes(granted, echelons, self.separator), ordered=False)
+
+    def expected(self):
+        """
+        The whole view as computed from the echelons collection
+
+        :return: dict of (member_type, member) to a dict with `granted`
+        and `echelons` lists
+        """
+        self.backend.query_count += 1
+        documents = list(self.backend.collection.find({}, {'_id': 0, 'echelon': 1, 'users': 1, 'groups': 1}))
+        defined = {document['echelon'] for document in documents}
+        granted = {}
+        for document in documents:
+            for member_type in MemberTypes:
+                for member in document.get(member_type.value, ()):
+                    granted.setdefault((member_type.value, member), set()).add(document['echelon'])
+        # Map every defined level to the Echelons beneath it once, rather than once per member
+        beneath = {}
+        for echelon in defined:
+            for level in levels(echelon, self.separator):
+                beneath.setdefault(level, []).append(echelon)
+        view = {}
+        for key, grants in granted.items():
+            echelons = set()
+            for echelon in grants:
+                echelons.update(beneath.get(echelon, ()))
+            view[key] = {'granted': sorted(grants), 'echelons': sorted(echelons)}
+        return view
+
+    def rebuild(self):
+        """
+        Recreate the view from scratch in a scratch collection, then swap
+        it in atomically
+
+        :return: (int) number of members in the view
+        """
+        view = self.expected()
+        scratch = self.backend.db['{}_rebuild'.format(self.collection_name)]
+        self.backend.query_count += 1
+        scratch.drop()
+        self.create_indexes(scratch)
+        if view:
+            self.backend.query_count += 1
+            scratch.insert_many([dict(document, _id={'member_type': member_type, 'member': member})
+                                 for (member_type, member), document in view.items()])
+        self.backend.query_count += 1
+        scratch.rename(self.collection_name, dropTarget=True)
+        return len(view)
+
+    def check(self):
+        """
+        Compare the view with the echelons collection
+
+        :return: list of (str) problems, empty if the view is consistent
+        """
+        expected = self.expected()
+        problems = []
+        self.backend.query_count += 1
+        for document in self.collection.find():
+            key = (document['_id']['member_type'], document['_id']['member'])
+            wanted = expected.pop(key, None)
+            if wanted is None:
+                problems.append('{}:{} should not be in the view'.format(*key))
+                continue
+            for field in ('granted', 'echelons'):
+                found = sorted(document.get(field, []))
+                if found != wanted[field]:
+                    problems.append('{}:{} has {} {}, expected {}'.format(key[0], key[1], field, found, wanted[field]))
+        problems.extend('{}:{} is missing from the view'.format(*key) for key in expected)
+        return problems
+
+    def _keys(self, users, groups):
+        return [member_key(MemberTypes.USER, user) for user in users] + \
+            [member_key(MemberTypes.GROUP, group) for group in groups]
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from bisect import bisect_right
+
+from .. import MemberTypes
+from .base import Backend
+
+
+class MemoryBackend(Backend):
+    """
+    Keeps every Echelon in process memory, with a reverse index from
+    each member to the Echelons granting it.
+
+    Nothing is shared between processes, making this suited to tests
+    and small single process deployments.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._echelons = {}
+        # (member_type, member) -> set of Echelons granting that member
+        self._grants = {}
+        self._generation = 0
+        self._versions = {}
+        self._ids = {}
+        self._lock = threading.RLock()
+
+    def define(self, echelon, name, help):
+        self.query_count += 1
+        with self._lock:
+            document = self._echelons.setdefault(echelon, {'echelon': echelon, 'users': [], 'groups': []})
+            document.update(name=name, help=help)
+
+    def get(self, echelon):
+        self.query_count += 1
+        with self._lock:
+            document = self._echelons.get(echelon)
+            return self._copy(document) if document is not None else None
+
+    def remove(self, echelon):
+        self.query_count += 1
+        self._remove_echelon(echelon)
+
+    def _remove_echelon(self, echelon):
+        with self._lock:
+            document = self._echelons.pop(echelon, None)
+            if document is None:
+                return
+            for member_type in MemberTypes:
+                for member in document[member_type.value]:
+                    self._grants[member_type, member].discard(echelon)
+
+    def add_members(self, echelon, member_type, members):
+        self.query_count += 1
+        self._add(echelon, member_type, members)
+
+    def remove_members(self, echelon, member_type, members):
+        self.query_count += 1
+        self._remove(echelon, member_type, members)
+
+    def bulk_update(self, ops):
+        self.query_count += 1
+        result = {'operations': len(ops), 'matched': 0, 'modified': 0}
+        with self._lock:
+            for action, echelon, member_type, members in ops:
+                modified = (self._add if action == 'add' else self._remove)(echelon, member_type, members)
+                if modified is not None:
+                    result['matched'] += 1
+                    result['modified'] += modified
+        return result
+
+    def apply_changes(self, echelon, fields=None, add=None, remove=None, create=False):
+        fields, add, remove = fields or {}, add or {}, remove or {}
+        self.query_count += 1
+        with self._lock:
+            document = self._echelons.get(echelon)
+            if create:
+                if document is not None:
+                    return {'matched': True, 'modified': False, 'created': False}
+                self._echelons[echelon] = {'echelon': echelon, 'users': [], 'groups': []}
+                document = self._echelons[echelon]
+            elif document is None:
+                return {'matched': False, 'modified': False, 'created': False}
+            previous = self._copy(document)
+            document.update((field, fields[field]) for field in ('name', 'help') if field in fields)
+            for member_type in MemberTypes:
+                if member_type.value in fields:
+                    self._remove(echelon, member_type, document[member_type.value])
+                    self._add(echelon, member_type, fields[member_type.value])
+                self._add(echelon, member_type, add.get(member_type, ()))
+                self._remove(echelon, member_type, remove.get(member_type, ()))
+            return {'matched': not create, 'modified': document != previous, 'created': create}
+
+    def find_all(self, batch_size=1000):
+        self.query_count += 1
+        with self._lock:
+            return [self._copy(document) for document in self._echelons.values()]
+
+    def find_page(self, after=None, limit=None, prefix=None, fields=None):
+        self.query_count += 1
+        with self._lock:
+            echelons = sorted(self._echelons)
+            start = bisect_right(echelons, after) if after is not None else 0
+            page = []
+            for echelon in echelons[start:]:
+                if limit is not None and len(page) >= limit:
+                    break
+                if prefix and not echelon.startswith(prefix):
+                    continue
+                document = self._copy(self._echelons[echelon])
+                if fields is not None:
+                    document = {key: value for key, value in document.items() if key == 'echelon' or key in fields}
+                page.append(document)
+            return page
+
+    def replace(self, documents):
+        self.query_count += 1
+        with self._lock:
+            for document in documents:
+                self._remove_echelon(document['echelon'])
+                self._echelons[document['echelon']] = self._copy(document)
+                for member_type in MemberTypes:
+                    for member in document[member_type.value]:
+                        self._grants.setdefault((member_type, member), set()).add(document['echelon'])
+
+    def is_member(self, users, groups, levels):
+        self.query_count += 1
+        return any(not grants.isdisjoint(levels) for grants in self._member_grants(users, groups))
+
+    def granted(self, users, groups, levels=None):
+        self.query_count += 1
+        granted = set().union(*self._member_grants(users, groups))
+        if levels is not None:
+            granted.intersection_update(levels)
+        return granted
+
+    def find_levels(self, levels):
+        self.query_count += 1
+        with self._lock:
+            return [self._copy(self._echelons[level]) for level in set(levels) if level in self._echelons]
+
+    def descendants(self, echelons, separator):
+        self.query_count += 1
+        roots = set(echelons)
+        prefixes = tuple(root + separator for root in roots)
+        with self._lock:
+            return sorted(e for e in self._echelons if e in roots or e.startswith(prefixes))
+
+    def bump_generation(self, echelons=()):
+        self.query_count += 1
+        with self._lock:
+            self._generation += 1
+            self._versions.update(dict.fromkeys(echelons, self._generation))
+            return self._generation
+
+    def echelon_ids(self, echelons):
+        echelons = list(echelons)
+        self.query_count += 1
+        with self._lock:
+            for echelon in echelons:
+                self._ids.setdefault(echelon, len(self._ids))
+            return {echelon: self._ids[echelon] for echelon in echelons}
+
+    def generation(self):
+        self.query_count += 1
+        return self._generation
+
+    def version(self, echelon):
+        self.query_count += 1
+        return self._versions.get(echelon, 0)
+
+    def _add(self, echelon, member_type, members):
+        """
+        :return: None if `echelon` is not defined, else whether it changed
+        """
+        with self._lock:
+            document = self._echelons.get(echelon)
+            if document is None:
+                return None
+            current = document[member_type.value]
+            size = len(current)
+            for member in members:
+                if member not in current:
+                    current.append(member)
+                    self._grants.setdefault((member_type, member), set()).add(echelon)
+            return len(current) != size
+
+    def _remove(self, echelon, member_type, members):
+        with self._lock:
+            document = self._echelons.get(echelon)
+            if document is None:
+                return None
+            members = set(members)
+            size = len(document[member_type.value])
+            document[member_type.value] = [m for m in document[member_type.value] if m not in members]
+            for member in members:
+                self._grants.get((member_type, member), set()).discard(echelon)
+            return len(document[member_type.value]) != size
+
+    def _member_grants(self, users, groups):
+        with self._lock:
+            keys = [(MemberTypes.USER, user) for user in users] + [(MemberTypes.GROUP, group) for group in groups]
+            return [frozenset(self._grants.get(key, ())) for key in keys]
+
+    @staticmethod
+    def _copy(document):
+        return dict(document, users=list(document['users']), groups=list(document['groups']))
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+
+from pymongo import ASCENDING, ReplaceOne, ReturnDocument, UpdateOne
+
+from .. import MemberTypes
+from .base import Backend
+from .effective import EffectivePermissions, member_key
+
+logger = logging.getLogger(__name__)
+
+#: Indexes on the echelons collection. The compound multikey indexes lead
+#: with a member field so a lookup starting from a user or group never
+#: scans, and carry the echelon so a check of specific levels is answered
+#: from the index alone.
+INDEXES = {'echelon_1': {'key': [('echelon', ASCENDING)], 'unique': True},
+           'users_1_echelon_1': {'key': [('users', ASCENDING), ('echelon', ASCENDING)]},
+           'groups_1_echelon_1': {'key': [('groups', ASCENDING), ('echelon', ASCENDING)]}}
+
+
+def membership_filter(users, groups):
+    clauses = []
+    if groups:
+        clauses.append({'groups': {'$in': list(groups)}})
+    if users:
+        clauses.append({'users': {'$in': list(users)}})
+    return {'$or': clauses}
+
+
+def levels_filter(users, groups, levels):
+    query = membership_filter(users, groups)
+    query['echelon'] = levels[0] if len(levels) == 1 else {'$in': sorted(levels)}
+    return query
+
+
+def descendants_filter(echelons, separator):
+    """
+    Match `echelons` and every level beneath them with anchored
+    prefix patterns, which can make use of the echelon index
+
+    :param echelons: iterable of (str) Echelons
+    :return: dict
+    """
+    # Anything beneath an Echelon already included is covered by it
+    roots = []
+    for echelon in sorted(echelons):
+        if not roots or (echelon != roots[-1] and not echelon.startswith(roots[-1] + separator)):
+            roots.append(echelon)
+    separator = re.escape(separator)
+    return {'echelon': {'$in': [re.compile('^{}(?:{}|$)'.format(re.escape(root), separator)) for root in roots]}}
+
+
+def plan_stages(plan):
+    """
+    Every stage of a query plan as returned by `explain()`, depth first
+
+    :return: list of (str) stage names, ie ['FETCH', 'IXSCAN']
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def version_id(echelon):
+    """
+    `_id` of the meta document holding the version of `echelon`
+    """
+    return 'echelon:{}'.format(echelon)
+
+
+def integer_id(echelon):
+    """
+    `_id` of the meta document holding the integer ID of `echelon`
+    """
+    return 'id:{}'.format(echelon)
+
+
+def define_update(echelon, name, help):
+    init = {'groups': [], 'users': []}
+    payload = {"echelon": echelon, "name": name, "help": help}
+    return {"$set": payload, "$setOnInsert": init}
+
+
+def add_members_update(member_type, members):
+    return {'$addToSet': {member_type.value: {'$each': list(members)}}}
+
+
+def remove_members_update(member_type, members):
+    return {'$pull': {member_type.value: {'$in': list(members)}}}
+
+
+def members_expression(field, add, remove):
+    """
+    Aggregation expression for a member list with `remove` filtered out
+    and the members of `add` not yet present appended, keeping order.
+    Values are wrapped in `$literal` so members starting with `$` are
+    never read as field paths.
+    """
+    current = {'$ifNull': ['$' + field, []]}
+    return {'$concatArrays': [
+        {'$filter': {'input': current, 'as': 'member',
+                     'cond': {'$eq': [{'$in': ['$$member', {'$literal': list(remove)}]}, False]}}},
+        {'$filter': {'input': {'$literal': list(add)}, 'as': 'member',
+                     'cond': {'$eq': [{'$in': ['$$member', current]}, False]}}}]}
+
+
+def changes_update(fields, add, remove):
+    """
+    Fold every change into one update. Classic operators are used unless
+    members are both added to and removed from the same list, which they
+    cannot express in one update, then a pipeline update is built instead.
+    Pipeline updates need pymongo 3.9 and MongoDB 4.2.
+
+    :return: dict, list of pipeline stages, or None if there is nothing
+    to change
+    """
+    if any(add.get(member_type) and remove.get(member_type) for member_type in MemberTypes):
+        stage = {field: {'$literal': value} for field, value in fields.items()}
+        for member_type in MemberTypes:
+            if add.get(member_type) or remove.get(member_type):
+                stage[member_type.value] = members_expression(member_type.value, add.get(member_type, ()),
+                                                              remove.get(member_type, ()))
+        return [{'$set': stage}]
+    update = {}
+    if fields:
+        update['$set'] = dict(fields)
+    for member_type, members in add.items():
+        if members:
+            update.setdefault('$addToSet', {})[member_type.value] = {'$each': list(members)}
+    for member_type, members in remove.items():
+        if members:
+            update.setdefault('$pull', {})[member_type.value] = {'$in': list(members)}
+    return update or None
+
+
+class MongoBackend(Backend):
+    """
+    Stores one document per Echelon in a MongoDB collection, with a
+    `<collection>_meta` collection alongside it for the generation.
+
+    The database may be given directly or resolved on each access through
+    `resolve_database`, which is how `EchelonManager` falls back to `app.db`.
+
+    With `effective=True` every write also maintains the materialized
+    `EffectivePermissions` of the members it touches, and checks become
+    a point lookup on it.
+    """
+
+    def __init__(self, database=None, collection='echelons', resolve_database=None, effective=False,
+                 separator='::'):
+        super().__init__()
+        self._database = database
+        self._resolve_database = resolve_database
+        self.collection_name = collection
+        self.meta_collection_name = '{}_meta'.format(collection)
+        self.effective = EffectivePermissions(self, separator) if effective else None
+
+    @property
+    def indexed_checks(self):
+        return self.effective is not None
+
+    @property
+    def db(self):
+        if self._database is not None:
+            return self._database
+        if self._resolve_database is not None:
+            return self._resolve_database()
+        raise Exception('No database defined for {}'.format(type(self).__name__))
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    @property
+    def meta(self):
+        return self.db[self.meta_collection_name]
+
+    def create_indexes(self):
+        for name, spec in INDEXES.items():
+            self.query_count += 1
+            self.collection.create_index(spec['key'], name=name, unique=spec.get('unique', False))
+        if self.effective is not None:
+            self.effective.create_indexes()
+
+    def verify_indexes(self):
+        self.query_count += 1
+        existing = self.collection.index_information()
+        problems = []
+        for name, spec in INDEXES.items():
+            index = existing.get(name)
+            if index is None:
+                problems.append('{} is missing'.format(name))
+            elif [tuple(key) for key in index['key']] != spec['key'] or \
+                    bool(index.get('unique')) != spec.get('unique', False):
+                problems.append('{} does not match {}'.format(name, spec))
+        return problems
+
+    def queries(self, users, groups, levels, separator):
+        """
+        The filters this backend issues for a check of `levels`, by method
+
+        :return: dict of (str) name to (filter, projection)
+        """
+        return {'get': ({'echelon': levels[-1]}, {'_id': 0}),
+                'is_member': (levels_filter(users, groups, levels[:1]), {'_id': 1}),
+                'is_member_single_query': (levels_filter(users, groups, levels), {'_id': 1}),
+                'granted': (membership_filter(users, groups), {'_id': 0, 'echelon': 1}),
+                'granted_levels': (levels_filter(users, groups, levels), {'_id': 0, 'echelon': 1}),
+                'descendants': (descendants_filter(levels[:1], separator), {'_id': 0, 'echelon': 1}),
+                'find_page_prefix': ({'echelon': {'$regex': '^' + re.escape(levels[0])}}, {'_id': 0})}
+
+    def rebuild_effective(self):
+        if self.effective is None:
+            return super().rebuild_effective()
+        return self.effective.rebuild()
+
+    def check_effective(self):
+        if self.effective is None:
+            return super().check_effective()
+        return self.effective.check()
+
+    def explain(self, users, groups, levels, separator):
+        report = {}
+        for name, (query, projection) in self.queries(users, groups, levels, separator).items():
+            self.query_count += 1
+            stages = plan_stages(self.collection.find(query, projection).explain().get('queryPlanner', {}))
+            report[name] = stages
+            if 'COLLSCAN' in stages:
+                logger.warning('%s on %s falls back to a collection scan: %s', name, self.collection_name, query)
+        return report
+
+    def define(self, echelon, name, help):
+        self.query_count += 1
+        self.collection.update_one({'echelon': echelon}, define_update(echelon, name, help), upsert=True)
+        if self.effective is not None:
+            self.effective.defined([echelon])
+
+    def get(self, echelon):
+        self.query_count += 1
+        return self.collection.find_one({'echelon': echelon}, {'_id': 0})
+
+    def remove(self, echelon):
+        self.query_count += 1
+        self.collection.delete_one({'echelon': echelon})
+        if self.effective is not None:
+            self.effective.removed(echelon)
+
+    def add_members(self, echelon, member_type, members):
+        self.query_count += 1
+        self.collection.update_one({'echelon': echelon}, add_members_update(member_type, members))
+        if self.effective is not None:
+            self.effective.refresh(member_key(member_type, member) for member in members)
+
+    def remove_members(self, echelon, member_type, members):
+        self.query_count += 1
+        self.collection.update_one({'echelon': echelon}, remove_members_update(member_type, members))
+        if self.effective is not None:
+            self.effective.refresh(member_key(member_type, member) for member in members)
+
+    def bulk_update(self, ops):
+        updates = {'add': add_members_update, 'remove': remove_members_update}
+        requests = [UpdateOne({'echelon': echelon}, updates[action](member_type, members))
+                    for action, echelon, member_type, members in ops]
+        self.query_count += 1
+        result = self.collection.bulk_write(requests, ordered=False)
+        if self.effective is not None:
+            self.effective.refresh(member_key(member_type, member)
+                                   for _, _, member_type, members in ops for member in members)
+        return {'operations': len(requests), 'matched': result.matched_count, 'modified': result.modified_count}
+
+    def apply_changes(self, echelon, fields=None, add=None, remove=None, create=False):
+        fields, add, remove = fields or {}, add or {}, remove or {}
+        touched = [member_key(member_type, member) for changes in (add, remove)
+                   for member_type, members in changes.items() for member in members]
+        touched += [member_key(member_type, member) for member_type in MemberTypes
+                    for member in fields.get(member_type.value, ())]
+        if create:
+            self.query_count += 1
+            result = self.collection.update_one({'echelon': echelon},
+                                                {'$setOnInsert': dict(fields, echelon=echelon)}, upsert=True)
+            created = result.upserted_id is not None
+            if created and self.effective is not None:
+                self.effective.defined([echelon])
+                self.effective.refresh(touched)
+            return {'matched': not created, 'modified': created, 'created': created}
+
+        update = changes_update(fields, add, remove)
+        if update is None:
+            return {'matched': self.get(echelon) is not None, 'modified': False, 'created': False}
+        # Members losing a grant to a replaced list are only known before the write
+        replaced = any(member_type.value in fields for member_type in MemberTypes)
+        if replaced and self.effective is not None:
+            touched += self.effective.members_granted([echelon])
+        self.query_count += 1
+        result = self.collection.update_one({'echelon': echelon}, update)
+        if result.modified_count and self.effective is not None:
+            self.effective.refresh(touched)
+        return {'matched': bool(result.matched_count), 'modified': bool(result.modified_count), 'created': False}
+
+    def find_all(self, batch_size=1000):
+        self.query_count += 1
+        return self.collection.find({}, {'_id': 0}, batch_size=batch_size)
+
+    def find_page(self, after=None, limit=None, prefix=None, fields=None):
+        query = {}
+        if after is not None:
+            query['$gt'] = after
+        if prefix:
+            query['$regex'] = '^' + re.escape(prefix)
+        projection = {'_id': 0}
+        if fields is not None:
+            projection.update({field: 1 for field in fields}, echelon=1)
+        cursor = self.collection.find({'echelon': query} if query else {}, projection).sort('echelon', 1)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        self.query_count += 1
+        return list(cursor)
+
+    def replace(self, documents):
+        echelons = [d['echelon'] for d in documents]
+        # Members losing a grant are only known before the write
+        previous = self.effective.members_granted(echelons) if self.effective is not None else None
+        self.query_count += 1
+        self.collection.bulk_write([ReplaceOne({'echelon': d['echelon']}, d, upsert=True) for d in documents],
+                                   ordered=False)
+        if self.effective is not None:
+            self.effective.defined(echelons)
+            self.effective.refresh(previous + [member_key(member_type, member) for d in documents
+                                               for member_type in MemberTypes
+                                               for member in d.get(member_type.value, ())])
+
+    def is_member(self, users, groups, levels):
+        if self.effective is not None:
+            return self.effective.is_member(users, groups, levels)
+        self.query_count += 1
+        return self.collection.find_one(levels_filter(users, groups, levels), {'_id': 1}) is not None
+
+    def granted(self, users, groups, levels=None):
+        if self.effective is not None:
+            return self.effective.granted(users, groups, levels)
+        query = membership_filter(users, groups) if levels is None else levels_filter(users, groups, list(levels))
+        self.query_count += 1
+        return {e['echelon'] for e in self.collection.find(query, {'_id': 0, 'echelon': 1})}
+
+    def find_levels(self, levels):
+        self.query_count += 1
+        projection = {'_id': 0, 'echelon': 1, 'users': 1, 'groups': 1}
+        return self.collection.find({'echelon': {'$in': sorted(levels)}}, projection)
+
+    def descendants(self, echelons, separator):
+        self.query_count += 1
+        matches = self.collection.find(descendants_filter(echelons, separator), {'_id': 0, 'echelon': 1})
+        return [e['echelon'] for e in matches.sort('echelon', 1)]
+
+    def bump_generation(self, echelons=()):
+        self.query_count += 1
+        generation = self.meta.find_one_and_update({'_id': 'generation'}, {'$inc': {'value': 1}},
+                                                   upsert=True, return_document=ReturnDocument.AFTER)['value']
+        echelons = set(echelons)
+        if echelons:
+            self.query_count += 1
+            self.meta.bulk_write([UpdateOne({'_id': version_id(echelon)}, {'$max': {'value': generation}}, upsert=True)
+                                  for echelon in echelons], ordered=False)
+        return generation
+
+    def echelon_ids(self, echelons):
+        echelons = list(echelons)
+        ids = self._read_ids(echelons)
+        missing = [echelon for echelon in dict.fromkeys(echelons) if echelon not in ids]
+        if missing:
+            # Reserve a block of IDs, then claim one per Echelon unless a
+            # concurrent process got there first, leaving a harmless gap
+            self.query_count += 1
+            end = self.meta.find_one_and_update({'_id': 'next_id'}, {'$inc': {'value': len(missing)}},
+                                                upsert=True, return_document=ReturnDocument.AFTER)['value']
+            self.query_count += 1
+            self.meta.bulk_write([UpdateOne({'_id': integer_id(echelon)}, {'$setOnInsert': {'value': value}},
+                                            upsert=True)
+                                  for value, echelon in enumerate(missing, end - len(missing))], ordered=False)
+            ids.update(self._read_ids(missing))
+        return ids
+
+    def _read_ids(self, echelons):
+        self.query_count += 1
+        documents = self.meta.find({'_id': {'$in': [integer_id(echelon) for echelon in echelons]}})
+        return {document['_id'][len('id:'):]: document['value'] for document in documents}
+
+    def generation(self):
+        self.query_count += 1
+        doc = self.meta.find_one({'_id': 'generation'})
+        return doc['value'] if doc else 0
+
+    def version(self, echelon):
+        self.query_count += 1
+        doc = self.meta.find_one({'_id': version_id(echelon)})
+        return doc['value'] if doc else 0
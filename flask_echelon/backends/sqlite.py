@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import threading
+
+from .. import MemberTypes
+from .base import Backend
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS echelons (
+    id INTEGER PRIMARY KEY,
+    echelon TEXT NOT NULL UNIQUE,
+    name TEXT,
+    help TEXT
+);
+CREATE TABLE IF NOT EXISTS members (
+    id INTEGER PRIMARY KEY,
+    echelon_id INTEGER NOT NULL REFERENCES echelons (id) ON DELETE CASCADE,
+    member_type TEXT NOT NULL,
+    member TEXT,
+    UNIQUE (echelon_id, member_type, member)
+);
+CREATE INDEX IF NOT EXISTS members_by_member ON members (member_type, member, echelon_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Bound parameters per statement, well under the limit of 999 before SQLite 3.32
+MAX_VARIABLES = 500
+
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+def _chunks(values, size=MAX_VARIABLES):
+    """
+    Split `values` into lists of at most `size`, always yielding at least
+    one so a query runs even when there are none
+    """
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+    if not values:
+        yield values
+
+
+def _upper_bound(prefix):
+    """
+    Smallest string greater than every string starting with `prefix`, so
+    a prefix match becomes a range scan on the echelon index
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SQLiteBackend(Backend):
+    """
+    Stores Echelons in SQLite, with members in their own table indexed
+    by member so both forward checks and reverse lookups are index scans.
+
+    Pass a file path to share the store, and its generation, between
+    processes. The default is a private in memory database.
+
+    Requires SQLite 3.24 or later, for `ON CONFLICT ... DO UPDATE`
+    upserts. Long lists of values are split across statements so none
+    binds more than `MAX_VARIABLES` parameters.
+    """
+
+    def __init__(self, path=':memory:'):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        with self._connection:
+            self._connection.executescript(SCHEMA)
+
+    def _execute(self, sql, parameters=()):
+        self.query_count += 1
+        with self._lock, self._connection:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def define(self, echelon, name, help):
+        self._execute('INSERT INTO echelons (echelon, name, help) VALUES (?, ?, ?) '
+                      'ON CONFLICT (echelon) DO UPDATE SET name = excluded.name, help = excluded.help',
+                      (echelon, name, help))
+
+    def get(self, echelon):
+        with self._lock:
+            rows = self._execute('SELECT id, echelon, name, help FROM echelons WHERE echelon = ?', (echelon,))
+            if not rows:
+                return None
+            return self._documents(rows)[0]
+
+    def remove(self, echelon):
+        self._execute('DELETE FROM echelons WHERE echelon = ?', (echelon,))
+
+    def add_members(self, echelon, member_type, members):
+        self.query_count += 1
+        with self._lock, self._connection:
+            self._add(echelon, member_type, members)
+
+    def remove_members(self, echelon, member_type, members):
+        self.query_count += 1
+        with self._lock, self._connection:
+            self._remove(echelon, member_type, members)
+
+    def bulk_update(self, ops):
+        self.query_count += 1
+        result = {'operations': len(ops), 'matched': 0, 'modified': 0}
+        with self._lock, self._connection:
+            for action, echelon, member_type, members in ops:
+                if not self._connection.execute('SELECT 1 FROM echelons WHERE echelon = ?', (echelon,)).fetchone():
+                    continue
+                apply = self._add if action == 'add' else self._remove
+                result['matched'] += 1
+                result['modified'] += bool(apply(echelon, member_type, members))
+        return result
+
+    def apply_changes(self, echelon, fields=None, add=None, remove=None, create=False):
+        fields, add, remove = fields or {}, add or {}, remove or {}
+        self.query_count += 1
+        with self._lock, self._connection:
+            connection = self._connection
+            if create:
+                cursor = connection.execute('INSERT INTO echelons (echelon, name, help) VALUES (?, ?, ?) '
+                                            'ON CONFLICT (echelon) DO NOTHING',
+                                            (echelon, fields.get('name'), fields.get('help')))
+                if not cursor.rowcount:
+                    return {'matched': True, 'modified': False, 'created': False}
+            row = connection.execute('SELECT id, name, help FROM echelons WHERE echelon = ?', (echelon,)).fetchone()
+            if row is None:
+                return {'matched': False, 'modified': False, 'created': False}
+            echelon_id, name, help = row
+            modified = create
+            if not create and ('name' in fields or 'help' in fields):
+                name, help = fields.get('name', name), fields.get('help', help)
+                modified |= bool(connection.execute('UPDATE echelons SET name = ?, help = ? WHERE id = ? '
+                                                    'AND (name IS NOT ? OR help IS NOT ?)',
+                                                    (name, help, echelon_id, name, help)).rowcount)
+            for member_type in MemberTypes:
+                if member_type.value in fields:
+                    members = connection.execute('SELECT member FROM members WHERE echelon_id = ? AND member_type = ? '
+                                                 'ORDER BY id', (echelon_id, member_type.value)).fetchall()
+                    if [member for member, in members] != fields[member_type.value]:
+                        connection.execute('DELETE FROM members WHERE echelon_id = ? AND member_type = ?',
+                                           (echelon_id, member_type.value))
+                        self._add(echelon, member_type, fields[member_type.value])
+                        modified = True
+                if add.get(member_type):
+                    modified |= self._add(echelon, member_type, add[member_type]) > 0
+                if remove.get(member_type):
+                    modified |= self._remove(echelon, member_type, remove[member_type]) > 0
+            return {'matched': not create, 'modified': modified, 'created': create}
+
+    def find_all(self, batch_size=1000):
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._execute('SELECT id, echelon, name, help FROM echelons WHERE id > ? ORDER BY id LIMIT ?',
+                                     (last, batch_size))
+                if not rows:
+                    return
+                documents = self._documents(rows)
+            yield from documents
+            last = rows[-1][0]
+
+    def find_page(self, after=None, limit=None, prefix=None, fields=None):
+        clauses, parameters = [], []
+        if after is not None:
+            clauses.append('echelon > ?')
+            parameters.append(after)
+        if prefix:
+            clauses.append('echelon >= ? AND echelon < ?')
+            parameters.extend((prefix, _upper_bound(prefix)))
+        sql = 'SELECT id, echelon, name, help FROM echelons'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY echelon'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        with self._lock:
+            rows = self._execute(sql, parameters)
+            if fields is None or not {'users', 'groups'}.isdisjoint(fields):
+                documents = self._documents(rows)
+            else:
+                documents = [{'echelon': echelon, 'name': name, 'help': help} for _, echelon, name, help in rows]
+        if fields is None:
+            return documents
+        return [{key: value for key, value in document.items() if key == 'echelon' or key in fields}
+                for document in documents]
+
+    def replace(self, documents):
+        self.query_count += 1
+        with self._lock, self._connection:
+            for document in documents:
+                self._connection.execute('DELETE FROM echelons WHERE echelon = ?', (document['echelon'],))
+                self._connection.execute('INSERT INTO echelons (echelon, name, help) VALUES (?, ?, ?)',
+                                         (document['echelon'], document['name'], document['help']))
+                for member_type in MemberTypes:
+                    self._add(document['echelon'], member_type, document[member_type.value])
+
+    def is_member(self, users, groups, levels):
+        levels = list(levels)
+        for users, groups in self._member_chunks(users, groups):
+            membership, parameters = self._membership(users, groups)
+            rows = self._execute('SELECT 1 FROM members m JOIN echelons e ON e.id = m.echelon_id '
+                                 'WHERE e.echelon IN ({}) AND ({}) LIMIT 1'.format(_placeholders(levels), membership),
+                                 levels + parameters)
+            if rows:
+                return True
+        return False
+
+    def granted(self, users, groups, levels=None):
+        granted = set()
+        with self._lock:
+            for users, groups in self._member_chunks(users, groups):
+                membership, parameters = self._membership(users, groups)
+                sql = 'SELECT DISTINCT e.echelon FROM members m JOIN echelons e ON e.id = m.echelon_id ' \
+                      'WHERE ({})'.format(membership)
+                if levels is None:
+                    granted.update(row[0] for row in self._execute(sql, parameters))
+                    continue
+                for chunk in _chunks(levels, MAX_VARIABLES // 2):
+                    rows = self._execute(sql + ' AND e.echelon IN ({})'.format(_placeholders(chunk)),
+                                         parameters + chunk)
+                    granted.update(row[0] for row in rows)
+        return granted
+
+    def find_levels(self, levels):
+        levels = sorted(set(levels))
+        if not levels:
+            return []
+        documents = {}
+        with self._lock:
+            for chunk in _chunks(levels):
+                rows = self._execute('SELECT echelons.echelon, member_type, member FROM echelons '
+                                     'LEFT JOIN members ON members.echelon_id = echelons.id '
+                                     'WHERE echelons.echelon IN ({}) ORDER BY members.id'.format(_placeholders(chunk)),
+                                     chunk)
+                for echelon, member_type, member in rows:
+                    document = documents.setdefault(echelon, {'echelon': echelon, 'users': [], 'groups': []})
+                    if member_type is not None:
+                        document[member_type].append(member)
+        return list(documents.values())
+
+    def descendants(self, echelons, separator):
+        echelons = list(echelons)
+        if not echelons:
+            return []
+        found = set()
+        with self._lock:
+            for chunk in _chunks(echelons, MAX_VARIABLES // 3):
+                clauses, parameters = [], []
+                for echelon in chunk:
+                    prefix = echelon + separator
+                    clauses.append('echelon = ? OR (echelon >= ? AND echelon < ?)')
+                    parameters.extend((echelon, prefix, _upper_bound(prefix)))
+                rows = self._execute('SELECT echelon FROM echelons WHERE {}'.format(' OR '.join(clauses)), parameters)
+                found.update(row[0] for row in rows)
+        return sorted(found)
+
+    def bump_generation(self, echelons=()):
+        self.query_count += 1
+        with self._lock, self._connection:
+            self._connection.execute("INSERT INTO meta (key, value) VALUES ('generation', 1) "
+                                     "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+            generation = self._connection.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+            self._connection.executemany('INSERT INTO meta (key, value) VALUES (?, ?) '
+                                         'ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value)',
+                                         [('echelon:' + echelon, generation) for echelon in set(echelons)])
+            return generation
+
+    def echelon_ids(self, echelons):
+        echelons = list(echelons)
+        self.query_count += 1
+        with self._lock, self._connection:
+            # A write first, so the transaction holds the write lock before IDs are read
+            self._connection.execute("INSERT INTO meta (key, value) VALUES ('next_id', 0) "
+                                     "ON CONFLICT (key) DO NOTHING")
+            ids = {}
+            for start in range(0, len(echelons), MAX_VARIABLES):
+                keys = ['id:' + echelon for echelon in echelons[start:start + MAX_VARIABLES]]
+                rows = self._connection.execute('SELECT key, value FROM meta WHERE key IN ({})'
+                                                .format(_placeholders(keys)), keys)
+                ids.update((key[len('id:'):], value) for key, value in rows)
+            missing = [echelon for echelon in dict.fromkeys(echelons) if echelon not in ids]
+            if missing:
+                start = self._connection.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()[0]
+                assigned = {echelon: value for value, echelon in enumerate(missing, start)}
+                self._connection.executemany('INSERT INTO meta (key, value) VALUES (?, ?)',
+                                             [('id:' + echelon, value) for echelon, value in assigned.items()])
+                self._connection.execute("UPDATE meta SET value = ? WHERE key = 'next_id'", (start + len(missing),))
+                ids.update(assigned)
+            return ids
+
+    def generation(self):
+        rows = self._execute("SELECT value FROM meta WHERE key = 'generation'")
+        return rows[0][0] if rows else 0
+
+    def version(self, echelon):
+        rows = self._execute('SELECT value FROM meta WHERE key = ?', ('echelon:' + echelon,))
+        return rows[0][0] if rows else 0
+
+    def _add(self, echelon, member_type, members):
+        """
+        :return: (int) number of members added
+        """
+        # IS rather than = so a null member, ie an anonymous user, is only stored once
+        cursor = self._connection.executemany(
+            'INSERT INTO members (echelon_id, member_type, member) '
+            'SELECT e.id, :type, :member FROM echelons e WHERE e.echelon = :echelon AND NOT EXISTS ('
+            'SELECT 1 FROM members m WHERE m.echelon_id = e.id AND m.member_type = :type AND m.member IS :member)',
+            [{'type': member_type.value, 'member': member, 'echelon': echelon} for member in members])
+        return cursor.rowcount
+
+    def _remove(self, echelon, member_type, members):
+        """
+        :return: (int) number of members removed
+        """
+        cursor = self._connection.executemany(
+            'DELETE FROM members WHERE member_type = ? AND member IS ? '
+            'AND echelon_id = (SELECT id FROM echelons WHERE echelon = ?)',
+            [(member_type.value, member, echelon) for member in members])
+        return cursor.rowcount
+
+    @staticmethod
+    def _member_chunks(users, groups, size=MAX_VARIABLES // 2):
+        """
+        Split `users` and `groups` so each pair binds at most `size`
+        members, leaving room for the levels bound beside them
+        """
+        members = [(MemberTypes.USER, user) for user in users] + [(MemberTypes.GROUP, group) for group in groups]
+        for chunk in _chunks(members, size):
+            yield ([member for member_type, member in chunk if member_type is MemberTypes.USER],
+                   [member for member_type, member in chunk if member_type is MemberTypes.GROUP])
+
+    @staticmethod
+    def _membership(users, groups):
+        clauses, parameters = [], []
+        for member_type, members in ((MemberTypes.USER, users), (MemberTypes.GROUP, groups)):
+            members = list(members)
+            if not members:
+                continue
+            values = [member for member in members if member is not None]
+            tests = ['m.member IN ({})'.format(_placeholders(values))] if values else []
+            if len(values) != len(members):
+                tests.append('m.member IS NULL')
+            clauses.append('(m.member_type = ? AND ({}))'.format(' OR '.join(tests)))
+            parameters += [member_type.value] + values
+        return ' OR '.join(clauses) or '0', parameters
+
+    def _documents(self, rows):
+        documents = {}
+        for echelon_id, echelon, name, help in rows:
+            documents[echelon_id] = {'echelon': echelon, 'name': name, 'help': help, 'users': [], 'groups': []}
+        if not documents:
+            return []
+        for ids in _chunks(documents):
+            members = self._execute('SELECT echelon_id, member_type, member FROM members '
+                                    'WHERE echelon_id IN ({}) ORDER BY id'.format(_placeholders(ids)), ids)
+            for echelon_id, member_type, member in members:
+                documents[echelon_id][member_type].append(member)
+        return list(documents.values())
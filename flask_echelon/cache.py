@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import OrderedDict
+from threading import RLock
+
+
+class TTLCache:
+    """
+    Bounded least recently used cache whose entries expire after `ttl` seconds
+
+    Keeps hit, miss and eviction counters so the cache can be sized
+    against a memory budget.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, timer=time.monotonic):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1, got {}'.format(maxsize))
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Retrieve a cached value, marking it as recently used
+
+        :return: cached value or `default` if missing or expired
+        """
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self._timer():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = self._timer() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard_where(self, predicate):
+        """
+        Drop every entry whose key matches `predicate`
+
+        :param predicate: callable accepting a key, returning bool
+        :return: (int) number of entries dropped
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    @property
+    def stats(self):
+        """
+        Snapshot of the cache counters
+
+        :return: dict
+        """
+        return {'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations}
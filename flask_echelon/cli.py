@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+echelon_cli = AppGroup('echelon', help='Manage Flask-Echelon permissions.')
+
+
+def _manager():
+    if not hasattr(current_app, 'echelon_manager'):
+        raise click.ClickException("Flask app '{!r}' does not have a bound interaction manager".format(current_app))
+    return current_app.echelon_manager
+
+
+@echelon_cli.command('rebuild-effective')
+def rebuild_effective():
+    """Recreate the materialized effective permissions."""
+    members = _manager().rebuild_effective()
+    click.echo('Rebuilt effective permissions of {} members'.format(members))
+
+
+@echelon_cli.command('check-effective')
+def check_effective():
+    """Compare the materialized effective permissions with the Echelons."""
+    problems = _manager().check_effective()
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise click.ClickException('{} inconsistencies found, run `flask echelon rebuild-effective`'
+                                   .format(len(problems)))
+    click.echo('Effective permissions are consistent')
+
+
+@echelon_cli.command('write-snapshot')
+@click.argument('path', required=False)
+@click.option('--interval', type=float, help='Keep running, rewriting the file whenever the Echelons change, '
+                                             'checked for every INTERVAL seconds.')
+def write_snapshot(path, interval):
+    """Compile the Echelons into a snapshot file for workers to map."""
+    manager = _manager()
+    generation = manager.write_snapshot(path)
+    click.echo('Wrote snapshot of generation {}'.format(generation))
+    while interval:
+        time.sleep(interval)
+        if manager.version() != generation:
+            generation = manager.write_snapshot(path)
+            click.echo('Wrote snapshot of generation {}'.format(generation))
+
+
+@echelon_cli.command('audit')
+@click.option('--all', 'show_all', is_flag=True, help='List unguarded routes too.')
+def audit(show_all):
+    """List the Echelons guarding each route and report undefined ones."""
+    manager = _manager()
+    missing = set()
+    for registry in getattr(current_app, 'echelon_registries', []):
+        for route in registry.policy(current_app):
+            if route['echelons'] or show_all:
+                click.echo('{:<40} {:<30} {}'.format(route['rule'], route['endpoint'],
+                                                     ', '.join(route['echelons']) or '-'))
+        missing.update(registry.missing(current_app, manager))
+    for echelon in sorted(missing):
+        click.echo('Echelon "{}" is not defined'.format(echelon), err=True)
+    if missing:
+        raise click.ClickException('{} guarding Echelons are not defined'.format(len(missing)))
+
+
+@echelon_cli.command('ensure-indexes')
+def ensure_indexes():
+    """Create the indexes Flask-Echelon relies on, if missing."""
+    problems = _manager().ensure_indexes()
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise click.ClickException('{} indexes do not match, drop them and run again'.format(len(problems)))
+    click.echo('Indexes are in place')
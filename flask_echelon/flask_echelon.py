@@ -1,11 +1,73 @@
 # -*- coding: utf-8 -*-
 
+import json
+import logging
+import os
+import threading
+import time
+from itertools import islice
 
-from . import MemberTypes
-from .api import EchelonApi
+from flask import current_app, has_app_context
 
+from . import ImportFailed, MemberTypes
+from .backends import MongoBackend
+from .cache import TTLCache
+from .snapshot import BitsetSnapshot, EchelonSnapshot, MappedSnapshot, SnapshotRefresher, write_snapshot
+from .tokens import PermissionToken, roots
 
-class EchelonManager:
+ECHELON_FIELDS = frozenset(['echelon', 'name', 'help', 'users', 'groups'])
+INDEX_MODES = ('eager', 'deferred', 'manual')
+
+logger = logging.getLogger(__name__)
+
+
+class _EchelonQueries:
+    """
+    Hierarchy handling and argument validation shared by the
+    synchronous and asynchronous managers
+    """
+
+    _separator = '::'
+
+    def _hierarchy(self, echelon):
+        """
+        Split an Echelon into each level of its hierarchy, top > bottom
+        ie 'foo::bar::baz' -> ['foo', 'foo::bar', 'foo::bar::baz']
+
+        :param echelon: (str) Representation of a single point in a
+        permission hierarchy
+        :return: list
+        """
+        if echelon.startswith(self._separator):
+            raise ValueError('{} leads with separator "{}"'.format(echelon, self._separator))
+        levels = []
+        for part in echelon.split(self._separator):
+            levels.append(self._separator.join((levels[-1], part)) if levels else part)
+        return levels
+
+    @staticmethod
+    def _members(member, member_type):
+        """
+        Normalize a single member or an iterable of members to a list
+
+        :return: list
+        """
+        if member_type not in MemberTypes:
+            raise TypeError('Got invalid argument for member_type: {}'.format(member_type))
+        if not isinstance(member, str) and hasattr(member, '__iter__'):
+            return list(member)
+        return [member]
+
+    def _definition(self, echelon, name=None, help=None):
+        """
+        :return: (name, help) with defaults filled in
+        """
+        if echelon.startswith(self._separator):
+            raise ValueError('{} leads with separator "{}"'.format(echelon, self._separator))
+        return name or echelon, help or "Provides access to {}".format(echelon)
+
+
+class EchelonManager(_EchelonQueries):
     """
     Echelon Manager
 
@@ -13,34 +75,127 @@ class EchelonManager:
     approach to managing Flask application permissions.
     """
 
-    def __init__(self, app=None, database=None, collection='echelons', separator='::', api_url_prefix=None):
+    def __init__(self, app=None, database=None, collection='echelons', separator='::', api_url_prefix=None,
+                 single_query=False, cache_size=None, cache_ttl=300, generation_interval=5,
+                 snapshot=False, snapshot_interval=None, snapshot_path=None,
+                 group_resolver=None, group_cache_size=None, group_cache_ttl=300, backend=None, metrics=False,
+                 effective=False, index_mode='eager'):
         self._db = database
         self._separator = separator
-        self._mongo_collection = collection
+        # Every read and write goes through the backend, by default a Mongo
+        # collection in `database` or `app.db`, optionally maintaining
+        # materialized effective permissions to answer checks from
+        self.backend = backend if backend is not None else MongoBackend(collection=collection,
+                                                                        resolve_database=lambda: self.db,
+                                                                        effective=effective, separator=separator)
+        # Every write bumps a generation shared by all processes using the
+        # backend, letting them know their cached state is stale
+        self._generation = None
+        self._generation_checked = None
+        self._generation_interval = generation_interval
+        self._single_query = single_query
+        # Optional cache of check_access decisions, disabled unless a size is given
+        self.cache = TTLCache(cache_size, cache_ttl) if cache_size else None
+        # Optional in memory snapshot of the whole collection, rebuilt in the
+        # background every `snapshot_interval` seconds and after any write.
+        # `snapshot='bitset'` compiles it to a `BitsetSnapshot` instead.
+        # `snapshot='mmap'` maps the file at `snapshot_path` written by a
+        # single `flask echelon write-snapshot` process, shared by every
+        # worker and remapped once replaced, checked for every
+        # `snapshot_interval` seconds
+        if snapshot not in (False, None, True, 'bitset', 'mmap'):
+            raise ValueError('Got invalid argument for snapshot: {}'.format(snapshot))
+        if snapshot == 'mmap':
+            if not snapshot_path:
+                raise ValueError('snapshot_path is required with snapshot="mmap"')
+            snapshot_interval = snapshot_interval or 1
+        self._snapshot_bitset = snapshot == 'bitset'
+        self._snapshot_path = snapshot_path if snapshot == 'mmap' else None
+        self.snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_refresher = SnapshotRefresher(self.refresh_snapshot, snapshot_interval) if snapshot else None
+        # Resolves the groups of a user, defaults to reading `user.groups`.
+        # Expensive resolvers can be cached per user id for `group_cache_ttl`
+        self._group_resolver = group_resolver
+        self.group_cache = TTLCache(group_cache_size, group_cache_ttl) if group_cache_size else None
+        # Optional timing of every operation, see `instrument`
+        self.metrics = None
+        if metrics:
+            self.instrument(None if metrics is True else metrics)
+        # When `init_app` creates the backend's indexes: 'eager' right away,
+        # 'deferred' in a background thread on the first request, 'manual'
+        # never, leaving it to `flask echelon ensure-indexes`
+        if index_mode not in INDEX_MODES:
+            raise ValueError('Got invalid argument for index_mode: {}'.format(index_mode))
+        self.index_mode = index_mode
+        self._index_thread = None
         if app:
             self.app = app
             self.init_app(app, api_url_prefix)
 
     def init_app(self, app, api_url_prefix=None):
-        self.db[self._mongo_collection].create_index('echelon', unique=True)
+        # Imported here so importing the package does not pull in the blueprint and CLI
+        from .api import EchelonApi
+        from .cli import echelon_cli
+        from .helpers import registry
+
+        if self.index_mode == 'eager':
+            self.backend.create_indexes()
+        elif self.index_mode == 'deferred':
+            app.before_first_request(self._create_indexes_in_background)
         app.echelon_manager = self
+        app.cli.add_command(echelon_cli)
+        registry.init_app(app)
         app.register_blueprint(EchelonApi, url_prefix=api_url_prefix)
 
+    def ensure_indexes(self):
+        """
+        Create every index the backend relies on, if missing, then verify
+        them. Backs `flask echelon ensure-indexes`, for deployments using
+        `index_mode='manual'`.
+
+        :return: list of (str) problems, empty if every index is in place
+        """
+        self.backend.create_indexes()
+        return self.backend.verify_indexes()
+
     def add_member(self, echelon, member, member_type):
-        if member_type not in MemberTypes:
-            raise TypeError('Got invalid argument for member_type: {}'.format(member_type))
-        if not isinstance(member, str) and hasattr(member, '__iter__'):
-            member = {'$each': member}
-        payload = {'$addToSet': {member_type.value: member}}
-        self.db[self._mongo_collection].update({'echelon': echelon}, payload)
+        members = self._members(member, member_type)
+        self.backend.add_members(echelon, member_type, members)
+        self._invalidate(echelon, frozenset(members), member_type)
 
     def remove_member(self, echelon, member, member_type):
-        if member_type not in MemberTypes:
-            raise TypeError('Got invalid argument for member_type: {}'.format(member_type))
-        if isinstance(member, str):
-            member = [member]
-        payload = {'$pull': {member_type.value: {'$in': member}}}
-        self.db[self._mongo_collection].update({'echelon': echelon}, payload)
+        members = self._members(member, member_type)
+        self.backend.remove_members(echelon, member_type, members)
+        self._invalidate(echelon, frozenset(members), member_type)
+
+    def bulk_update_members(self, ops, batch_size=1000):
+        """
+        Apply many membership changes across many Echelons
+
+        Every op is validated before anything is written, then changes are
+        written in batches of `batch_size`, each with as few round trips as
+        the backend allows. With Mongo every batch is a
+        single unordered `bulk_write`, so an add and a remove of the same
+        member on the same Echelon within one batch may apply in any order.
+
+        :param ops: iterable of dicts with keys `op` ('add' or 'remove'),
+        `echelon`, `member` (a single member or a list) and `member_type`
+        (`MemberTypes` or its value, ie 'users')
+        :param batch_size: (int) number of ops written per batch, at least 1
+        :return: list of dicts, one per batch, with the number of
+        `operations`, `matched` Echelons and `modified` Echelons
+        """
+        self._check_batch_size(batch_size)
+        ops = iter([self._member_op(op) for op in ops])
+        results = []
+        while True:
+            batch = list(islice(ops, batch_size))
+            if not batch:
+                return results
+            results.append(self.backend.bulk_update(batch))
+            self._invalidate_many([(echelon, frozenset(members), member_type)
+                                   for _, echelon, member_type, members in batch])
 
     def define_echelon(self, echelon, name=None, help=None):
         """
@@ -52,18 +207,65 @@ class EchelonManager:
         :param help: (str) Help text defining Echelon purpose/scope
         :return: None
         """
-        if echelon.startswith(self._separator):
-            raise ValueError('{} leads with separator "{}"'.format(echelon, self._separator))
+        name, help = self._definition(echelon, name, help)
+        self.backend.define(echelon, name, help)
+        # Membership is only ever initialized here, so no cached decision changes
+        self._invalidate(echelon, frozenset())
 
-        init = {'groups': [], 'users': []}
+    def apply_changes(self, echelon, set=None, add=None, remove=None, create=False):
+        """
+        Apply several changes to one Echelon in a single atomic write, so
+        no reader ever sees them half applied
 
-        payload = {"echelon": echelon,
-                   "name": name or echelon,
-                   "help": help or "Provides access to {}".format(echelon)}
+        Every change is folded into as few operators as possible. With
+        Mongo, adding to and removing from the same member list becomes a
+        pipeline update, which requires MongoDB 4.2.
 
-        self.db[self._mongo_collection].update({"echelon": echelon},
-                                               {"$set": payload, "$setOnInsert": init},
-                                               upsert=True)
+        :param echelon: (str) Representation of a single Echelon within
+        a permission hierarchy
+        :param set: dict overwriting any of `name`, `help` and the `users`
+        or `groups` lists. A name or help of None resets it to its default.
+        :param add: dict of (`MemberTypes`) or its value, ie 'users', to a
+        member or list of members to add
+        :param remove: dict like `add` of members to remove, applied after
+        `add`
+        :param create: (bool) only create the Echelon, leaving an existing
+        one untouched
+        :return: dict with `matched` (the Echelon existed), `modified` and
+        `created` bools
+        """
+        self._hierarchy(echelon)
+        fields = dict(set or {})
+        unknown = fields.keys() - {'name', 'help', 'users', 'groups'}
+        if unknown:
+            raise ValueError('Cannot set {} on an Echelon'.format(', '.join(sorted(unknown))))
+        add, remove = self._member_changes(add), self._member_changes(remove)
+
+        if create or 'name' in fields or 'help' in fields:
+            name, help = self._definition(echelon, fields.get('name'), fields.get('help'))
+            defaults = {'name': name, 'help': help}
+            fields.update((key, value) for key, value in defaults.items() if create or key in fields)
+        # Fold member changes into replaced lists, and drop adds which are removed again
+        writes = []
+        for member_type in MemberTypes:
+            added, removed = add.pop(member_type, []), remove.pop(member_type, [])
+            if create or member_type.value in fields:
+                members = self._members(fields.get(member_type.value, []), member_type) + added
+                fields[member_type.value] = [m for m in dict.fromkeys(members) if m not in removed]
+                writes.append((echelon, frozenset(fields[member_type.value]) if create else None, member_type))
+                continue
+            added = [m for m in dict.fromkeys(added) if m not in removed]
+            if added:
+                add[member_type] = added
+            if removed:
+                remove[member_type] = removed
+            if added or removed:
+                writes.append((echelon, frozenset(added + removed), member_type))
+
+        result = self.backend.apply_changes(echelon, fields, add, remove, create)
+        if result['modified']:
+            self._invalidate_many(writes or [(echelon, frozenset(), None)])
+        return result
 
     def get_echelon(self, echelon):
         """
@@ -73,7 +275,7 @@ class EchelonManager:
         a permission hierarchy
         :return: dict
         """
-        return self.db[self._mongo_collection].find_one({'echelon': echelon}, {'_id': 0})
+        return self.backend.get(echelon)
 
     def remove_echelon(self, echelon):
         """
@@ -83,7 +285,8 @@ class EchelonManager:
         a permission hierarchy
         :return: None
         """
-        self.db[self._mongo_collection].remove({'echelon': echelon})
+        self.backend.remove(echelon)
+        self._invalidate(echelon)
 
     def check_access(self, member, echelon, member_type=MemberTypes.USER):
         """
@@ -98,31 +301,143 @@ class EchelonManager:
         This method does a top > bottom check as the most common use
         case is users with more general ie higher privilege levels.
 
+        If the manager was created with `single_query=True` every level
+        of the hierarchy is resolved in one query rather than one query
+        per level. Results are identical either way.
+
+        If the manager was created with a `cache_size` decisions are
+        cached until they expire or a write invalidates them.
+
+        If the manager was created with `snapshot=True` checks are answered
+        from an in memory snapshot without touching the database, with
+        `snapshot='bitset'` from a bitset compiled snapshot, with
+        `snapshot='mmap'` from a memory mapped snapshot file.
+
         :param user: (`Flask_Login.User`)
         :param echelon: (str) Representation of a single point in a
         permission hierarchy
         :return: Bool
         """
-        if echelon.startswith(self._separator):
-            raise ValueError('{} leads with separator "{}"'.format(echelon, self._separator))
-        hierarchy = echelon.split(self._separator)
-        level = None
-
-        while hierarchy:
-            if level is not None:
-                level = self._separator.join((level, hierarchy.pop(0)))
-            else:
-                level = hierarchy.pop(0)
-            if self._is_member(member, level, member_type=member_type):
-                return True
-        return False
+        hierarchy = self._hierarchy(echelon)
+        users, groups = self._identity(member, member_type)
+        if self._snapshot_refresher is not None:
+            self._sync_generation()
+            return self._get_snapshot().check(echelon, users, groups)
+
+        if self.cache is None:
+            return self._check_hierarchy(users, groups, hierarchy)
+
+        self._sync_generation()
+        key = (member_type, users, groups, echelon)
+        access = self.cache.get(key)
+        if access is None:
+            access = self._check_hierarchy(users, groups, hierarchy)
+            self.cache.set(key, access)
+        return access
+
+    def check_access_many(self, member, echelons, member_type=MemberTypes.USER):
+        """
+        Verify if a member has access to each of several Echelons
+
+        Levels shared between the requested Echelons are only checked
+        once and everything is resolved with a single query.
+
+        :param member: (`Flask_Login.User`) or (str) group name
+        :param echelons: iterable of (str) Echelons
+        :param member_type: (`MemberTypes`)
+        :return: dict mapping each Echelon to Bool
+        """
+        hierarchies = {echelon: self._hierarchy(echelon) for echelon in echelons}
+        users, groups = self._identity(member, member_type)
+        if self._snapshot_refresher is not None:
+            self._sync_generation()
+            snapshot = self._get_snapshot()
+            return snapshot.check_many(hierarchies, users, groups)
+
+        access = {}
+        if self.cache is not None:
+            self._sync_generation()
+            for echelon in hierarchies:
+                cached = self.cache.get((member_type, users, groups, echelon))
+                if cached is not None:
+                    access[echelon] = cached
+
+        pending = [echelon for echelon in hierarchies if echelon not in access]
+        if not pending:
+            return access
+        granted = set()
+        if users or groups:
+            granted = self.backend.granted(users, groups, {level for e in pending for level in hierarchies[e]})
+
+        for echelon in pending:
+            access[echelon] = not granted.isdisjoint(hierarchies[echelon])
+            if self.cache is not None:
+                self.cache.set((member_type, users, groups, echelon), access[echelon])
+        return access
 
     def member_echelons(self, member, member_type):
-        echelons = []
-        for echelon in self.all_echelons:
-            if self.check_access(member, echelon=echelon, member_type=member_type):
-                echelons.append(echelon)
-        return echelons
+        """
+        Retrieve every defined Echelon a member can access, either
+        directly or inherited from a level above it
+
+        Echelons granted directly are found with a single query, their
+        descendants with a second anchored prefix query.
+
+        :param member: (`Flask_Login.User`) or (str) group name
+        :param member_type: (`MemberTypes`)
+        :return: list, sorted by name whether read from the backend or a
+        snapshot
+        """
+        if self._snapshot_refresher is not None:
+            self._sync_generation()
+            users, groups = self._identity(member, member_type)
+            return sorted(self._get_snapshot().member_echelons(users, groups))
+
+        granted = self.granted_echelons(member, member_type)
+        if not granted:
+            return []
+
+        return self.backend.descendants(granted, self._separator)
+
+    def members_with_access(self, echelon, member_type=None):
+        """
+        Every member with effective access to an Echelon, either granted
+        on it directly or on any level above it
+
+        All levels are read with a single query, always from the backend
+        so reviews never see a stale snapshot. Members are yielded as the
+        levels are merged top > bottom, each once with the highest level
+        granting it, so large Echelons can be streamed.
+
+        :param echelon: (str) Representation of a single point in a
+        permission hierarchy
+        :param member_type: (`MemberTypes`) only yield members of this type
+        :return: generator of dicts with `member`, `member_type` (ie
+        'users') and `echelon`, the level granting access
+        """
+        hierarchy = self._hierarchy(echelon)
+        if member_type is not None and member_type not in MemberTypes:
+            raise TypeError('Got invalid argument for member_type: {}'.format(member_type))
+        member_types = list(MemberTypes) if member_type is None else [member_type]
+        return self._merge_levels(hierarchy, member_types)
+
+    def granted_echelons(self, member, member_type=MemberTypes.USER):
+        """
+        Retrieve the Echelons a member, or any of their groups, is
+        granted directly. A member has access to an Echelon if any
+        level of its hierarchy is in this set.
+
+        :param member: (`Flask_Login.User`) or (str) group name
+        :param member_type: (`MemberTypes`)
+        :return: frozenset
+        """
+        users, groups = self._identity(member, member_type)
+        if self._snapshot_refresher is not None:
+            self._sync_generation()
+            return self._get_snapshot().granted(users, groups)
+        if not users and not groups:
+            return frozenset()
+        return frozenset(self.backend.granted(users, groups))
 
     @property
     def all_echelons(self):
@@ -133,10 +448,275 @@ class EchelonManager:
         :return: dict
         """
         echelons = {}
-        for echelon in self.db[self._mongo_collection].find({}, {'_id': 0}):
+        for echelon in self.backend.find_all():
             echelons[echelon['echelon']] = echelon
         return echelons
 
+    def list_echelons(self, after=None, limit=None, prefix=None, fields=None):
+        """
+        Retrieve a page of Echelons ordered by name
+
+        Pages are keyed on the unique echelon index, pass the last
+        Echelon of one page as `after` to fetch the next.
+
+        :param after: (str) only return Echelons sorting after this one
+        :param limit: (int) maximum number of Echelons to return
+        :param prefix: (str) only return Echelons starting with this
+        :param fields: (iterable) keys to return besides `echelon`, ie
+        ('name', 'help') to leave out the member lists
+        :return: list of dicts
+        """
+        if fields is not None:
+            fields = set(fields)
+            unknown = fields - ECHELON_FIELDS
+            if unknown:
+                raise ValueError('Got unknown fields: {}'.format(', '.join(sorted(unknown))))
+        if limit is not None and limit < 0:
+            raise ValueError('limit must not be negative, got {}'.format(limit))
+        if limit == 0:
+            return []
+        return self.backend.find_page(after=after, limit=limit, prefix=prefix, fields=fields)
+
+    def export_echelons(self, batch_size=1000):
+        """
+        Stream every Echelon straight from the backend, holding at most
+        `batch_size` of them in memory at a time
+
+        :param batch_size: (int) number of Echelons read per batch, at
+        least 1
+        :return: iterable of dicts
+        """
+        self._check_batch_size(batch_size)
+        return self.backend.find_all(batch_size=batch_size)
+
+    def import_echelons(self, documents, batch_size=1000):
+        """
+        Create or entirely replace Echelons, members included, as
+        produced by `export_echelons`. Documents are consumed lazily and
+        written in batches of `batch_size`, each validated before it is
+        written. Echelons missing from `documents` are left alone.
+
+        :param documents: iterable of dicts, or of NDJSON lines
+        :param batch_size: (int) number of Echelons written per batch, at
+        least 1
+        :return: (int) number of Echelons imported
+        :raises ImportFailed: on an invalid document, with the number of
+        Echelons written by the batches before it
+        """
+        self._check_batch_size(batch_size)
+        documents = (self._import_document(d) for d in documents if not isinstance(d, (str, bytes)) or d.strip())
+        imported = 0
+        while True:
+            try:
+                batch = list(islice(documents, batch_size))
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                raise ImportFailed('Invalid document after {} imported Echelons: {!r}'.format(imported, e),
+                                   imported) from e
+            if not batch:
+                return imported
+            self.backend.replace(batch)
+            self._invalidate_many([(document['echelon'], None, None) for document in batch])
+            imported += len(batch)
+
+    def refresh_snapshot(self):
+        """
+        Load the whole echelons collection and compile it into a new
+        `EchelonSnapshot`, or a `BitsetSnapshot` using the backend's stable
+        Echelon IDs, atomically replacing the current snapshot
+
+        With `snapshot='mmap'` the snapshot file is mapped again only if
+        it was replaced, and written first if it does not exist yet.
+
+        :return: `EchelonSnapshot`
+        """
+        if self._snapshot_path is not None:
+            if self.snapshot is None or self.snapshot.changed():
+                if not os.path.exists(self._snapshot_path):
+                    self.write_snapshot()
+                self.snapshot = MappedSnapshot(self._snapshot_path)
+            return self.snapshot
+        generation = self.backend.generation()
+        if self._snapshot_bitset:
+            documents = list(self.backend.find_all())
+            ids = self.backend.echelon_ids(document['echelon'] for document in documents)
+            self.snapshot = BitsetSnapshot(documents, ids, self._separator, generation)
+        else:
+            self.snapshot = EchelonSnapshot(self.backend.find_all(), self._separator, generation)
+        return self.snapshot
+
+    def write_snapshot(self, path=None):
+        """
+        Compile the whole echelons collection into a snapshot file for
+        `snapshot='mmap'` managers to map, atomically replacing any
+        previous one
+
+        :param path: (str) defaults to `snapshot_path`
+        :return: (int) generation of the collection written
+        """
+        path = path or self._snapshot_path
+        if not path:
+            raise ValueError('No path given or snapshot_path defined to write the snapshot to')
+        generation = self.backend.generation()
+        write_snapshot(path, self.backend.find_all(), self._separator, generation)
+        return generation
+
+    @property
+    def generation(self):
+        """
+        Generation of the echelons collection, bumped by every write from
+        any process. Re-read at most once per `generation_interval` seconds.
+
+        :return: int
+        """
+        self._sync_generation()
+        return self._generation
+
+    def version(self, echelon=None):
+        """
+        Version of a single Echelon, or of the whole collection if
+        `echelon` is None. Changes on every write to it, from any process,
+        and never repeats. Always read from the backend, without touching
+        the Echelon documents themselves.
+
+        An Echelon is at least at version 1 once defined, 0 means it was
+        never written by a manager, or does not exist.
+
+        :param echelon: (str) Representation of a single Echelon within
+        a permission hierarchy
+        :return: int
+        """
+        if echelon is None:
+            return self.backend.generation()
+        return self.backend.version(echelon)
+
+    def issue_token(self, member, member_type=MemberTypes.USER, expires_in=300, secret_key=None):
+        """
+        Sign a member's effective Echelons into a compact token other
+        services can check access against without a database, see
+        `read_token`
+
+        The token carries the roots of `member_echelons`, stamped with the
+        collection generation they were read at and an expiry.
+
+        :param member: (`Flask_Login.User`) or (str) group name
+        :param member_type: (`MemberTypes`)
+        :param expires_in: (int) seconds the token is valid for
+        :param secret_key: (str) defaults to the app's `secret_key`
+        :return: str
+        """
+        if member_type not in MemberTypes:
+            raise TypeError('Got invalid argument for member_type: {}'.format(member_type))
+        if self._snapshot_refresher is not None:
+            # Stamp the generation the snapshot was built at, which may lag the collection's
+            self._sync_generation()
+            snapshot = self._get_snapshot()
+            version = snapshot.generation
+            echelons = snapshot.member_echelons(*self._identity(member, member_type))
+        else:
+            # Read before the Echelons, so a concurrent write leaves the token stale rather than wrong
+            version = self.backend.generation()
+            echelons = self.member_echelons(member, member_type)
+        subject = member.get_id() if member_type is MemberTypes.USER else member
+        token = PermissionToken(subject, member_type, roots(echelons, self._separator), version,
+                                int(time.time() + expires_in))
+        return token.dumps(self._secret_key(secret_key))
+
+    def read_token(self, token, secret_key=None):
+        """
+        Decode a token made by `issue_token`, if it is still usable
+
+        Tokens are rejected once expired, or stale once any write bumped
+        the generation since they were issued. The generation is re-read
+        at most once per `generation_interval` seconds, so usually no
+        database is touched.
+
+        :param token: (str)
+        :param secret_key: (str) defaults to the app's `secret_key`
+        :return: (`PermissionToken`) or None if the token is invalid,
+        expired or stale
+        """
+        permissions = PermissionToken.loads(token, self._secret_key(secret_key))
+        if permissions is None or permissions.expired or permissions.version != self.generation:
+            return None
+        return permissions
+
+    def rebuild_effective(self):
+        """
+        Recreate the backend's materialized effective permissions from
+        the Echelons, ie to recover after writes which bypassed the manager
+
+        :return: (int) number of members in the view
+        """
+        return self.backend.rebuild_effective()
+
+    def check_effective(self):
+        """
+        Compare the backend's materialized effective permissions with the
+        Echelons they are derived from
+
+        :return: list of (str) problems, empty if they are consistent
+        """
+        return self.backend.check_effective()
+
+    def verify_indexes(self):
+        """
+        Check every index the backend relies on exists as expected. They
+        are created by `init_app` according to `index_mode`, or by
+        `ensure_indexes`.
+
+        :return: list of (str) problems, empty if every index is in place
+        """
+        return self.backend.verify_indexes()
+
+    def explain(self, member, echelon, member_type=MemberTypes.USER):
+        """
+        Run `explain()` on each query the manager issues when `member`
+        checks or lists `echelon`, logging a warning for any which falls
+        back to a collection scan. Mongo only.
+
+        :param member: (`Flask_Login.User`) or (str) group name
+        :param echelon: (str) Representation of a single point in a
+        permission hierarchy
+        :param member_type: (`MemberTypes`)
+        :return: dict of (str) query name to list of (str) plan stages
+        """
+        users, groups = self._identity(member, member_type)
+        return self.backend.explain(users, groups, self._hierarchy(echelon), self._separator)
+
+    def instrument(self, sinks=None):
+        """
+        Record call counts, latency, round trips and the level granting
+        access for every operation until `uninstrument` is called. Without
+        instrumentation no operation pays for any of it.
+
+        :param sinks: iterable of (`flask_echelon.metrics.MetricsSink`),
+        by default an `InMemoryMetrics` plus a `SignalSink` sending the
+        `flask_echelon.metrics` signals
+        :return: `flask_echelon.metrics.Instrumentation`
+        """
+        from .metrics import InMemoryMetrics, Instrumentation, SignalSink
+
+        self.uninstrument()
+        if sinks is None:
+            sinks = [InMemoryMetrics(), SignalSink(self)]
+        self.metrics = Instrumentation(self, sinks).install()
+        return self.metrics
+
+    def uninstrument(self):
+        if self.metrics is not None:
+            self.metrics.uninstall()
+            self.metrics = None
+
+    @property
+    def query_count(self):
+        """
+        Number of round trips made to the backend, useful for confirming
+        how many a given operation costs
+
+        :return: int
+        """
+        return self.backend.query_count
+
     @property
     def db(self):
         """
@@ -155,22 +735,224 @@ class EchelonManager:
                 pass  # We'll handle this failure at the end of the method
         raise Exception('No database defined on manager or current_app')
 
-    def _is_member(self, member, level, member_type):
+    def _secret_key(self, secret_key=None):
+        if secret_key is None:
+            app = current_app if has_app_context() else getattr(self, 'app', None)
+            secret_key = app.secret_key if app is not None else None
+        if not secret_key:
+            raise Exception('No secret_key given or defined on the app for signing tokens')
+        return secret_key
+
+    def _create_indexes_in_background(self):
+        if self._index_thread is not None:
+            return
+
+        def create():
+            try:
+                self.backend.create_indexes()
+            except Exception:
+                logger.exception('Failed to create Echelon indexes, run `flask echelon ensure-indexes`')
+
+        self._index_thread = threading.Thread(target=create, name='echelon-indexes', daemon=True)
+        self._index_thread.start()
+
+    def _check_hierarchy(self, users, groups, hierarchy):
+        return self._granting_level(users, groups, hierarchy) is not None
+
+    def _granting_level(self, users, groups, hierarchy):
+        """
+        Topmost level of `hierarchy` granted to any of `users` or `groups`,
+        read with one query, or one per level until a grant is found
+
+        :return: (str) or None if access is denied
+        """
+        if not users and not groups:
+            return None
+        if self._single_query or self.backend.indexed_checks:
+            granted = self.backend.granted(users, groups, hierarchy)
+            return next((level for level in hierarchy if level in granted), None)
+
+        for level in hierarchy:
+            if self.backend.is_member(users, groups, [level]):
+                return level
+        return None
+
+    def _merge_levels(self, hierarchy, member_types):
+        """
+        Members of each level of `hierarchy`, deduplicated top > bottom
+        """
+        documents = {document['echelon']: document for document in self.backend.find_levels(hierarchy)}
+        seen = set()
+        for level in hierarchy:
+            document = documents.get(level)
+            if document is None:
+                continue
+            for member_type in member_types:
+                for member in document.get(member_type.value, ()):
+                    if (member_type, member) not in seen:
+                        seen.add((member_type, member))
+                        yield {'member': member, 'member_type': member_type.value, 'echelon': level}
+
+    def _get_snapshot(self):
+        if self.snapshot is None:
+            with self._snapshot_lock:
+                if self.snapshot is None:
+                    self.refresh_snapshot()
+                    self._snapshot_refresher.start()
+        return self.snapshot
+
+    @staticmethod
+    def _check_batch_size(batch_size):
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1, got {}'.format(batch_size))
+
+    def _member_op(self, op):
+        """
+        Validate a single op passed to `bulk_update_members`
+
+        :return: (action, echelon, member_type, members)
+        """
+        if op.get('op') not in ('add', 'remove'):
+            raise ValueError('Got invalid op, expected "add" or "remove": {}'.format(op.get('op')))
+        member_type = op.get('member_type')
+        if isinstance(member_type, str):
+            member_type = MemberTypes(member_type)
+        return op['op'], op['echelon'], member_type, self._members(op['member'], member_type)
+
+    def _member_changes(self, changes):
+        """
+        Normalize a dict of member type to members, as taken by
+        `apply_changes`
+
+        :return: dict of (`MemberTypes`) to list
+        """
+        changes = changes or {}
+        if not isinstance(changes, dict):
+            raise TypeError('Expected a dict of member type to members, got {!r}'.format(changes))
+        normalized = {}
+        for member_type, members in changes.items():
+            member_type = member_type if isinstance(member_type, MemberTypes) else MemberTypes(member_type)
+            normalized[member_type] = self._members(members, member_type)
+        return normalized
+
+    def _import_document(self, document):
+        """
+        Validate a single document passed to `import_echelons`
+
+        :return: dict
+        """
+        if isinstance(document, (str, bytes)):
+            document = json.loads(document)
+        echelon = document['echelon']
+        name, help = self._definition(echelon, document.get('name'), document.get('help'))
+        imported = {'echelon': echelon, 'name': name, 'help': help}
+        for member_type in MemberTypes:
+            members = document.get(member_type.value, [])
+            if not isinstance(members, (list, tuple)):
+                raise TypeError('Expected a list of {} for {}, got {!r}'.format(member_type.value, echelon, members))
+            imported[member_type.value] = self._members(members, member_type)
+        return imported
+
+    def _identity(self, member, member_type):
+        """
+        Resolve the user ids and group names a member is checked as
+
+        :return: (frozenset, frozenset)
+        """
         if member_type is MemberTypes.USER:
             user_id = member.get_id()
-            # Groups is not a default attribute, default to empty list
-            user_groups = member.groups if hasattr(member, 'groups') else []
-
-            query = {'echelon': level,
-                     "$or": [
-                         {'groups': {'$in': user_groups}},
-                         {'users': {'$in': [user_id]}},
-                     ]}
-        elif member_type is MemberTypes.GROUP:
-            query = {'echelon': level,
-                     'groups': {'$in': [member]}}
+            return frozenset([user_id]), self._resolve_groups(member, user_id)
+        if member_type is MemberTypes.GROUP:
+            return frozenset(), frozenset([member])
+        return frozenset(), frozenset()
+
+    def _resolve_groups(self, user, user_id):
+        if self.group_cache is not None:
+            groups = self.group_cache.get(user_id)
+            if groups is not None:
+                return groups
+        if self._group_resolver is not None:
+            groups = frozenset(self._group_resolver(user))
         else:
-            return False
+            # Groups is not a default attribute, default to empty list
+            groups = frozenset(getattr(user, 'groups', []))
+        if self.group_cache is not None:
+            self.group_cache.set(user_id, groups)
+        return groups
+
+    def _invalidate(self, echelon, members=None, member_type=None):
+        """
+        Drop cached decisions a write to `echelon` may have changed, ie
+        decisions on `echelon` or any level beneath it. If `members` is
+        given only decisions involving those members are dropped.
+
+        Bumps the collection generation so other processes drop their
+        cached state as well.
+
+        :param echelon: (str) Echelon which was written to
+        :param members: (frozenset) Members which were added or removed
+        :param member_type: (`MemberTypes`) Type of `members`
+        :return: None
+        """
+        self._invalidate_many([(echelon, members, member_type)])
+
+    def _invalidate_many(self, writes):
+        """
+        `_invalidate` for several writes at once, bumping the generation
+        only once
+
+        :param writes: list of (echelon, members, member_type) tuples
+        :return: None
+        """
+        written = {}
+        for echelon, members, member_type in writes:
+            if members != frozenset():
+                written.setdefault(echelon, []).append((members, member_type))
+
+        if self.cache is not None and written:
+            def affected(key):
+                key_type, key_users, key_groups, key_echelon = key
+                for level in self._hierarchy(key_echelon):
+                    for members, member_type in written.get(level, ()):
+                        if members is None:
+                            return True
+                        if not members.isdisjoint(key_groups if member_type is MemberTypes.GROUP else key_users):
+                            return True
+                return False
+
+            self.cache.discard_where(affected)
+        self._bump_generation([echelon for echelon, _, _ in writes])
+        if self.snapshot is not None:
+            self._snapshot_refresher.request()
+
+    def _bump_generation(self, echelons):
+        generation = self.backend.bump_generation(echelons)
+        if generation != (self._generation or 0) + 1:
+            # Another process wrote since we last looked
+            self._drop_cached_state()
+        self._generation = generation
+
+    def _sync_generation(self):
+        """
+        Compare the collection generation with the one our cached state
+        was built from, dropping that state if another process has written
+        since. Only hits the database once per `generation_interval`.
+
+        :return: None
+        """
+        now = time.monotonic()
+        if self._generation_checked is not None and now - self._generation_checked < self._generation_interval:
+            return
+        self._generation_checked = now
+        generation = self.backend.generation()
+        if generation != self._generation:
+            if self._generation is not None:
+                self._drop_cached_state()
+            self._generation = generation
 
-        if self.db[self._mongo_collection].find_one(query, {'_id': 1}):
-            return True
+    def _drop_cached_state(self):
+        if self.cache is not None:
+            self.cache.clear()
+        if self.snapshot is not None:
+            # Keep serving the current snapshot until the new one is ready
+            self._snapshot_refresher.request()
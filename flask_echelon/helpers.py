@@ -1,37 +1,269 @@
 # -*- coding: utf-8 -*-
 
+import logging
 from functools import wraps
 
-from flask import current_app
+from flask import current_app, g
 from flask_login import current_user
 
 from flask_echelon import AccessCheckFailed
 
+logger = logging.getLogger(__name__)
 
-def has_access(echelon):
+
+def _manager():
+    if not hasattr(current_app, 'echelon_manager'):
+        raise Exception("Flask app '{!r}' does not have a bound interaction manager".format(current_app))
+    return current_app.echelon_manager
+
+
+def _granted_echelons(manager):
+    """
+    Echelons granted directly to `current_user`, resolved at most once
+    per request and stored on `flask.g`
+
+    :return: frozenset
+    """
+    user_id = current_user.get_id()
+    memo = g.get('_echelon_grants')
+    if memo is None or memo[0] != user_id:
+        memo = g._echelon_grants = (user_id, manager.granted_echelons(current_user))
+    return memo[1]
+
+
+def _check(echelon, memoize):
+    manager = _manager()
+    if not memoize:
+        return manager.check_access(current_user, echelon)
+    return not _granted_echelons(manager).isdisjoint(manager._hierarchy(echelon))
+
+
+def verify_token(token):
+    """
+    Decode a permission token issued by `EchelonManager.issue_token`,
+    signed with the `secret_key` of `current_app`
+
+    :return: (`flask_echelon.tokens.PermissionToken`) or None if the token
+    is invalid, expired or stale
+    """
+    return _manager().read_token(token)
+
+
+def has_access(echelon, memoize=True, token=None):
     """
     Check if `current_user` has access to an Echelon in `current_app`
 
+    The Echelons granted to `current_user` are looked up once per request,
+    every later check is answered locally. Pass `memoize=False` to see
+    writes made earlier in the same request.
+
+    Given a `token` from `EchelonManager.issue_token`, the check is
+    answered for the member it was issued to without touching the
+    database, as long as it verifies. Otherwise it falls back to
+    checking `current_user`.
+
     :return: bool
     """
-    if not hasattr(current_app, 'echelon_manager'):
-        raise Exception("Flask app '{!r}' does not have a bound interaction manager".format(current_app))
-    return current_app.echelon_manager.check_access(current_user, echelon)
+    if token is not None:
+        permissions = verify_token(token)
+        if permissions is not None:
+            return permissions.allows(_manager()._hierarchy(echelon))
+    return _check(echelon, memoize)
 
 
-def require_echelon(echelon):
+def has_access_many(echelons):
+    """
+    Check if `current_user` has access to each of several Echelons in
+    `current_app`, resolving all of them at once
+
+    :return: dict mapping each Echelon to bool
+    """
+    return _manager().check_access_many(current_user, echelons)
+
+
+class EchelonRegistry:
+    """
+    Every Echelon guarding a view or blueprint, recorded as they are
+    decorated, so an application's whole policy can be audited in one
+    place
+
+    The levels of each guarded Echelon are computed once when it is
+    registered. A guarded request then costs one dict lookup for them
+    and a set intersection with the memoized grants of `current_user`.
+
+    :param separator: (str) Echelon hierarchy separator of the managers
+    guarding with this registry. Levels for a manager using another
+    separator are split on its first check and cached apart.
+    """
+
+    def __init__(self, separator='::'):
+        self.separator = separator
+        self.views = {}  # Guarded view function -> Echelon
+        self.blueprints = {}  # Guarded blueprint name -> Echelon
+        self._levels = {}  # Echelon -> tuple of its levels, top > bottom
+        self._foreign_levels = {}  # (separator, Echelon) -> tuple of its levels, top > bottom
+
+    @property
+    def echelons(self):
+        """
+        :return: set of every guarding Echelon
+        """
+        return set(self._levels)
+
+    def register(self, echelon):
+        """
+        Validate an Echelon and precompute its levels
+
+        :return: tuple
+        """
+        levels = self._levels.get(echelon)
+        if levels is None:
+            levels = self._levels[echelon] = self._split(echelon, self.separator)
+        return levels
+
+    def require(self, echelon, memoize=True):
+        """
+        Decorate a view so `current_user` must have access to `echelon`,
+        raising `AccessCheckFailed` otherwise. See `require_echelon`.
+        """
+        self.register(echelon)
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if self._allowed(echelon, memoize):
+                    return func(*args, **kwargs)
+                raise AccessCheckFailed('{} does not have access to Echelon "{}"'.format(current_user, echelon))
+
+            self.views[wrapper] = echelon
+            return wrapper
+
+        return decorator
+
+    def guard(self, blueprint, echelon, memoize=True):
+        """
+        Require access to `echelon` for every request to `blueprint`,
+        checked in a `before_request` hook
+
+        :param blueprint: (`flask.Blueprint`)
+        """
+        self.register(echelon)
+        self.blueprints[blueprint.name] = echelon
+
+        @blueprint.before_request
+        def guard():
+            if not self._allowed(echelon, memoize):
+                raise AccessCheckFailed('{} does not have access to Echelon "{}"'.format(current_user, echelon))
+
+        return blueprint
+
+    def init_app(self, app):
+        """
+        Report guarding Echelons which are not defined before the first
+        request to `app`, and make the registry known to
+        `flask echelon audit`
+        """
+        if not hasattr(app, 'echelon_registries'):
+            app.echelon_registries = []
+        if self not in app.echelon_registries:
+            app.echelon_registries.append(self)
+            app.before_first_request(lambda: self.report(app))
+
+    def policy(self, app):
+        """
+        Every route of `app` with the Echelons guarding it, from its
+        blueprint and its view
+
+        :return: list of dicts with `rule`, `endpoint` and `echelons`
+        """
+        policy = []
+        for rule in sorted(app.url_map.iter_rules(), key=lambda rule: (rule.rule, rule.endpoint)):
+            echelons = []
+            if '.' in rule.endpoint:
+                blueprint = self.blueprints.get(rule.endpoint.rsplit('.', 1)[0])
+                if blueprint is not None:
+                    echelons.append(blueprint)
+            view = self.views.get(app.view_functions.get(rule.endpoint))
+            if view is not None:
+                echelons.append(view)
+            policy.append({'rule': rule.rule, 'endpoint': rule.endpoint, 'echelons': echelons})
+        return policy
+
+    def missing(self, app, manager=None):
+        """
+        Echelons guarding a route of `app` which are not defined, read
+        with a single query
+
+        :return: list, sorted
+        """
+        echelons = {echelon for route in self.policy(app) for echelon in route['echelons']}
+        if not echelons:
+            return []
+        manager = manager if manager is not None else app.echelon_manager
+        defined = {document['echelon'] for document in manager.backend.find_levels(echelons)}
+        return sorted(echelons - defined)
+
+    def report(self, app, manager=None):
+        """
+        Log a warning for each Echelon `missing` from `app`. Never raises,
+        so an unavailable backend cannot fail the request running it.
+
+        :return: list, None if the backend could not be read
+        """
+        try:
+            missing = self.missing(app, manager)
+        except Exception:
+            logger.exception('Failed to audit the Echelons guarding routes of %r, run `flask echelon audit`', app)
+            return None
+        for echelon in missing:
+            logger.warning('Echelon "%s" guards routes of %r but is not defined', echelon, app)
+        return missing
+
+    def _allowed(self, echelon, memoize):
+        manager = _manager()
+        if not memoize:
+            return manager.check_access(current_user, echelon)
+        return not _granted_echelons(manager).isdisjoint(self._levels_for(echelon, manager._separator))
+
+    def _levels_for(self, echelon, separator):
+        # Never rewrites shared state, the registry is used by every thread
+        # and possibly by managers with different separators at once
+        if separator == self.separator:
+            return self._levels[echelon]
+        levels = self._foreign_levels.get((separator, echelon))
+        if levels is None:
+            levels = self._foreign_levels[(separator, echelon)] = self._split(echelon, separator)
+        return levels
+
+    @staticmethod
+    def _split(echelon, separator):
+        if echelon.startswith(separator):
+            raise ValueError('{} leads with separator "{}"'.format(echelon, separator))
+        parts = echelon.split(separator)
+        return tuple(separator.join(parts[:i]) for i in range(1, len(parts) + 1))
+
+
+#: Registry used by `require_echelon` and `guard_blueprint`
+registry = EchelonRegistry()
+
+
+def require_echelon(echelon, memoize=True):
     """
     Check if `current_user` has access to an Echelon in `current_app`
     If check fails, raise `AccessCheckFailed`
+
+    Checks share the per request lookup used by `has_access`, pass
+    `memoize=False` to bypass it. The Echelon is recorded in `registry`
+    and its levels computed once, when the view is decorated.
     """
+    return registry.require(echelon, memoize)
 
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            if current_app.echelon_manager.check_access(current_user, echelon):
-                return func(*args, **kwargs)
-            raise AccessCheckFailed('{} does not have access to Echelon "{}"'.format(current_user, echelon))
 
-        return wrapper
+def guard_blueprint(blueprint, echelon, memoize=True):
+    """
+    Check if `current_user` has access to an Echelon before every request
+    to `blueprint`, raising `AccessCheckFailed` otherwise
 
-    return decorator
+    :return: `blueprint`
+    """
+    return registry.guard(blueprint, echelon, memoize)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from functools import wraps
+
+from flask.signals import Namespace
+
+from . import MemberTypes
+
+_signals = Namespace()
+
+#: Sent after every instrumented manager operation with `operation`,
+#: `duration` (seconds), `round_trips` and `error` (the exception raised or None)
+operation_completed = _signals.signal('echelon-operation-completed')
+
+#: Sent after every `check_access` with `echelon`, `granted`, `level` (the
+#: Echelon which granted access, None if unknown or denied), `depth` (its
+#: index in the hierarchy, 0 being the top) and `cached`
+access_checked = _signals.signal('echelon-access-checked')
+
+#: Manager methods timed by default, the writes included
+OPERATIONS = ('check_access', 'check_access_many', 'member_echelons', 'granted_echelons', '_check_hierarchy',
+              'add_member', 'remove_member', 'bulk_update_members', 'define_echelon', 'remove_echelon',
+              'import_echelons')
+
+#: Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1.0, float('inf'))
+
+
+class MetricsSink:
+    """
+    Receives measurements from `Instrumentation`, override either method
+    to forward them to a metrics library
+    """
+
+    def operation(self, operation, duration, round_trips, error=None):
+        """
+        :param operation: (str) name of the manager method
+        :param duration: (float) seconds spent in the call
+        :param round_trips: (int) backend round trips made by the call
+        :param error: (Exception) raised by the call, or None
+        """
+
+    def access(self, echelon, granted, level=None, depth=None, cached=False):
+        """
+        :param echelon: (str) Echelon which was checked
+        :param granted: (bool) outcome of the check
+        :param level: (str) Echelon which granted access
+        :param depth: (int) index of `level` in the hierarchy
+        :param cached: (bool) if the decision came from the cache
+        """
+
+
+class InMemoryMetrics(MetricsSink):
+    """
+    Aggregates call counts, latency histograms, round trips and granting
+    levels in process
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = Counter()
+            self.errors = Counter()
+            self.round_trips = Counter()
+            self.durations = defaultdict(float)
+            self.histograms = defaultdict(lambda: [0] * len(self.buckets))
+            self.granted_depths = Counter()
+            self.denied = 0
+            self.cached = 0
+
+    def operation(self, operation, duration, round_trips, error=None):
+        with self._lock:
+            self.calls[operation] += 1
+            self.round_trips[operation] += round_trips
+            self.durations[operation] += duration
+            self.histograms[operation][bisect_left(self.buckets, duration)] += 1
+            if error is not None:
+                self.errors[operation] += 1
+
+    def access(self, echelon, granted, level=None, depth=None, cached=False):
+        with self._lock:
+            if not granted:
+                self.denied += 1
+            elif depth is not None:
+                self.granted_depths[depth] += 1
+            if cached:
+                self.cached += 1
+
+    def summary(self):
+        """
+        :return: dict keyed by operation with `calls`, `errors`,
+        `round_trips`, `mean` latency and its `histogram` as a dict of
+        bucket upper bound to count
+        """
+        with self._lock:
+            return {operation: {'calls': calls,
+                                'errors': self.errors[operation],
+                                'round_trips': self.round_trips[operation],
+                                'mean': self.durations[operation] / calls,
+                                'histogram': dict(zip(self.buckets, self.histograms[operation]))}
+                    for operation, calls in self.calls.items()}
+
+
+class SignalSink(MetricsSink):
+    """
+    Forwards measurements as the `operation_completed` and
+    `access_checked` signals, with the manager as sender
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def operation(self, operation, duration, round_trips, error=None):
+        operation_completed.send(self.manager, operation=operation, duration=duration, round_trips=round_trips,
+                                 error=error)
+
+    def access(self, echelon, granted, level=None, depth=None, cached=False):
+        access_checked.send(self.manager, echelon=echelon, granted=granted, level=level, depth=depth,
+                            cached=cached)
+
+
+class Instrumentation:
+    """
+    Times manager operations and reports them to `sinks`
+
+    Nothing is patched until `install()`, which shadows each of
+    `operations` with a timed wrapper on the manager instance only.
+    `uninstall()` removes the wrappers again, leaving the manager exactly
+    as fast as one which was never instrumented.
+
+    Round trips are read from the backend's shared counter, so under
+    concurrency an operation may be charged with those of another thread.
+
+    :param manager: (`EchelonManager`)
+    :param sinks: iterable of (`MetricsSink`)
+    :param operations: iterable of (str) manager method names
+    """
+
+    def __init__(self, manager, sinks, operations=OPERATIONS):
+        self.manager = manager
+        self.sinks = list(sinks)
+        self.operations = tuple(operations)
+        self._local = threading.local()
+
+    @property
+    def installed(self):
+        return any(name in vars(self.manager) for name in self.operations)
+
+    def install(self):
+        manager = self.manager
+        for name in self.operations:
+            if name == '_check_hierarchy':
+                method = self._check_hierarchy
+            elif name == 'check_access':
+                method = self._check_access
+            else:
+                method = getattr(manager, name)
+            setattr(manager, name, self._timed(name, method))
+        return self
+
+    def uninstall(self):
+        for name in self.operations:
+            vars(self.manager).pop(name, None)
+
+    def cache_hit_ratio(self):
+        """
+        :return: (float) share of cache lookups which hit, None without a
+        cache or before the first lookup
+        """
+        cache = self.manager.cache
+        if cache is None or not cache.hits + cache.misses:
+            return None
+        return cache.hits / (cache.hits + cache.misses)
+
+    def _timed(self, name, method):
+        backend = self.manager.backend
+        sinks = self.sinks
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            queries = backend.query_count
+            error = None
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                duration = time.perf_counter() - start
+                for sink in sinks:
+                    sink.operation(name, duration, backend.query_count - queries, error)
+
+        return wrapper
+
+    def _check_access(self, member, echelon, member_type=MemberTypes.USER):
+        manager = self.manager
+        self._local.level = self._local.computed = None
+        granted = type(manager).check_access(manager, member, echelon, member_type)
+
+        level, computed = self._local.level, self._local.computed
+        if not computed and granted and manager.snapshot is not None:
+            level = manager.snapshot.granting_level(echelon, *manager._identity(member, member_type))
+        depth = level.count(manager._separator) if level is not None else None
+        cached = not computed and manager.cache is not None and manager._snapshot_refresher is None
+        for sink in self.sinks:
+            sink.access(echelon, granted, level, depth, cached)
+        return granted
+
+    def _check_hierarchy(self, users, groups, hierarchy):
+        """
+        `EchelonManager._check_hierarchy`, remembering which level granted
+        access
+        """
+        level = self.manager._granting_level(users, groups, hierarchy)
+        self._local.level = level
+        self._local.computed = True
+        return level is not None
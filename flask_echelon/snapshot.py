@@ -0,0 +1,653 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from zlib import crc32
+
+logger = logging.getLogger(__name__)
+
+
+class _Node:
+    __slots__ = ('children', 'echelon', 'users', 'groups')
+
+    def __init__(self):
+        self.children = {}
+        self.echelon = None  # Only set if the Echelon is defined
+        self.users = frozenset()
+        self.groups = frozenset()
+
+
+class EchelonSnapshot:
+    """
+    Read only, in memory compilation of an echelons collection
+
+    Echelons are stored in a trie keyed by separator segment, each node
+    carrying the frozen set of users and groups granted at that level.
+    Checks never touch the database.
+    """
+
+    def __init__(self, documents, separator='::', generation=None):
+        self.separator = separator
+        self.generation = generation
+        self._root = _Node()
+        self._order = []
+        for document in documents:
+            node = self._root
+            for part in document['echelon'].split(separator):
+                node = node.children.setdefault(part, _Node())
+            node.echelon = document['echelon']
+            node.users = frozenset(document.get('users', ()))
+            node.groups = frozenset(document.get('groups', ()))
+            self._order.append(document['echelon'])
+
+    def __len__(self):
+        return len(self._order)
+
+    def check(self, echelon, users=frozenset(), groups=frozenset()):
+        """
+        Verify if any of `users` or `groups` is granted `echelon` or any
+        level above it
+
+        :param echelon: (str) Representation of a single point in a
+        permission hierarchy
+        :param users: (frozenset) user ids to check
+        :param groups: (frozenset) group names to check
+        :return: Bool
+        """
+        node = self._root
+        for part in echelon.split(self.separator):
+            node = node.children.get(part)
+            if node is None:
+                return False
+            if not node.users.isdisjoint(users) or not node.groups.isdisjoint(groups):
+                return True
+        return False
+
+    def granting_level(self, echelon, users=frozenset(), groups=frozenset()):
+        """
+        The highest level of `echelon` which grants `users` or `groups`
+
+        :return: (str) Echelon, or None if access is denied
+        """
+        node = self._root
+        for part in echelon.split(self.separator):
+            node = node.children.get(part)
+            if node is None:
+                return None
+            if not node.users.isdisjoint(users) or not node.groups.isdisjoint(groups):
+                return node.echelon
+        return None
+
+    def check_many(self, echelons, users=frozenset(), groups=frozenset()):
+        """
+        :return: dict mapping each of `echelons` to Bool
+        """
+        return {echelon: self.check(echelon, users, groups) for echelon in echelons}
+
+    def granted(self, users=frozenset(), groups=frozenset()):
+        """
+        Every Echelon which grants `users` or `groups` directly
+
+        :return: frozenset
+        """
+        granted = set()
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if not node.users.isdisjoint(users) or not node.groups.isdisjoint(groups):
+                granted.add(node.echelon)
+            stack.extend(node.children.values())
+        return frozenset(granted)
+
+    def member_echelons(self, users=frozenset(), groups=frozenset()):
+        """
+        Every defined Echelon which `users` or `groups` can access
+
+        :return: list
+        """
+        granted = set()
+        stack = [(self._root, False)]
+        while stack:
+            node, inherited = stack.pop()
+            inherited = inherited or not node.users.isdisjoint(users) or not node.groups.isdisjoint(groups)
+            if inherited and node.echelon is not None:
+                granted.add(node.echelon)
+            stack.extend((child, inherited) for child in node.children.values())
+        return [echelon for echelon in self._order if echelon in granted]
+
+
+class _BitNode:
+    __slots__ = ('children', 'id')
+
+    def __init__(self):
+        self.children = {}
+        self.id = None  # Only set if the Echelon is defined
+
+
+def _bits(mask):
+    """
+    Positions of the set bits of `mask`, lowest first
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class BitsetSnapshot:
+    """
+    Read only, in memory compilation of an echelons collection with the
+    same interface as `EchelonSnapshot`, holding permissions as bitsets
+
+    Every Echelon is a bit, at the stable integer ID its backend assigned
+    it. Each user and group keeps one integer with the bits of the
+    Echelons granting it directly and one with the bits of every Echelon
+    it can access, descendants included. Merging a user's groups is a
+    bitwise or, and a check is a walk down the trie to the deepest defined
+    level of the Echelon followed by a single bit test.
+
+    :param documents: iterable of Echelon documents
+    :param ids: dict of (str) Echelon to (int) ID, as returned by
+    `Backend.echelon_ids`
+    """
+
+    def __init__(self, documents, ids, separator='::', generation=None):
+        self.separator = separator
+        self.generation = generation
+        self._root = _BitNode()
+        self._echelons = {}
+        self._rank = {}
+        documents = list(documents)
+        # Bits of each level and every defined Echelon beneath it, folded
+        # into each parent deepest first so every level is merged once
+        subtree = {}
+        for document in documents:
+            echelon = document['echelon']
+            node = self._root
+            for part in echelon.split(separator):
+                node = node.children.setdefault(part, _BitNode())
+            node.id = ids[echelon]
+            self._echelons[node.id] = echelon
+            self._rank[node.id] = len(self._rank)
+            subtree[echelon] = subtree.get(echelon, 0) | 1 << node.id
+            while separator in echelon:
+                echelon = echelon.rsplit(separator, 1)[0]
+                subtree.setdefault(echelon, 0)
+        for level in sorted(subtree, key=lambda level: level.count(separator), reverse=True):
+            if separator in level:
+                parent = level.rsplit(separator, 1)[0]
+                subtree[parent] |= subtree[level]
+
+        self._granted = {member_type: {} for member_type in ('users', 'groups')}
+        self._effective = {member_type: {} for member_type in ('users', 'groups')}
+        for document in documents:
+            echelon = document['echelon']
+            for member_type, granted in self._granted.items():
+                effective = self._effective[member_type]
+                for member in document.get(member_type, ()):
+                    granted[member] = granted.get(member, 0) | 1 << ids[echelon]
+                    effective[member] = effective.get(member, 0) | subtree[echelon]
+
+    def __len__(self):
+        return len(self._echelons)
+
+    def mask(self, users=frozenset(), groups=frozenset(), effective=True):
+        """
+        Union of the bitsets of `users` and `groups`
+
+        :param effective: (bool) include inherited Echelons, otherwise
+        only those granted directly
+        :return: int
+        """
+        masks = self._effective if effective else self._granted
+        mask = 0
+        for member_type, members in (('users', users), ('groups', groups)):
+            known = masks[member_type]
+            for member in members:
+                mask |= known.get(member, 0)
+        return mask
+
+    def check(self, echelon, users=frozenset(), groups=frozenset()):
+        """
+        Verify if any of `users` or `groups` is granted `echelon` or any
+        level above it
+
+        :return: Bool
+        """
+        deepest = self._deepest(echelon)
+        if deepest is None:
+            return False
+        # Test each member's bitset in turn rather than allocating their union
+        for member_type, members in (('users', users), ('groups', groups)):
+            known = self._effective[member_type]
+            for member in members:
+                mask = known.get(member)
+                if mask is not None and mask >> deepest & 1:
+                    return True
+        return False
+
+    def check_many(self, echelons, users=frozenset(), groups=frozenset()):
+        """
+        :return: dict mapping each of `echelons` to Bool
+        """
+        mask = self.mask(users, groups)
+        return {echelon: self._test(echelon, mask) for echelon in echelons}
+
+    def granting_level(self, echelon, users=frozenset(), groups=frozenset()):
+        """
+        The highest level of `echelon` which grants `users` or `groups`
+
+        :return: (str) Echelon, or None if access is denied
+        """
+        mask = self.mask(users, groups, effective=False)
+        node = self._root
+        for part in echelon.split(self.separator):
+            node = node.children.get(part)
+            if node is None:
+                return None
+            if node.id is not None and mask >> node.id & 1:
+                return self._echelons[node.id]
+        return None
+
+    def granted(self, users=frozenset(), groups=frozenset()):
+        """
+        Every Echelon which grants `users` or `groups` directly
+
+        :return: frozenset
+        """
+        return frozenset(self._echelons[i] for i in _bits(self.mask(users, groups, effective=False)))
+
+    def member_echelons(self, users=frozenset(), groups=frozenset()):
+        """
+        Every defined Echelon which `users` or `groups` can access, in
+        the order they were loaded
+
+        :return: list
+        """
+        return [self._echelons[i] for i in sorted(_bits(self.mask(users, groups)), key=self._rank.__getitem__)]
+
+    def _deepest(self, echelon):
+        """
+        ID of the deepest defined level of `echelon`. Being granted any
+        level above it means being granted this one.
+        """
+        deepest = None
+        node = self._root
+        for part in echelon.split(self.separator):
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.id is not None:
+                deepest = node.id
+        return deepest
+
+    def _test(self, echelon, mask):
+        deepest = self._deepest(echelon)
+        return deepest is not None and bool(mask >> deepest & 1)
+
+
+#: File header, followed by the words section then the strings section:
+#: magic, byte order mark, generation (-1 if unknown), then the length of
+#: the separator and the number of Echelons, Echelon index buckets, users,
+#: user index buckets, groups, group index buckets and postings
+_HEADER = struct.Struct('=8sIq8I')
+_MAGIC = b'ECHELON2'
+_BYTE_ORDER = 0x01020304
+_ECHELON_WIDTH = 5  # name offset, name length, load rank, first and last + 1 descendant
+_MEMBER_WIDTH = 4  # name offset, name length, first posting, postings
+
+
+def _member_key(member):
+    """
+    Bytes a member is stored and looked up under, tagged with its type so
+    the user id 1 and the user id '1' stay distinct. Members stored by the
+    backends are strings, None for an anonymous user, or integer ids.
+
+    :return: bytes, or None for a member of any other type
+    """
+    if isinstance(member, str):
+        return b's' + member.encode('utf-8')
+    if member is None:
+        return b'n'
+    if isinstance(member, int) and not isinstance(member, bool):
+        return b'i' + str(member).encode('ascii')
+    return None
+
+
+def _buckets(count):
+    """
+    Open addressing table size for `count` keys, a power of two leaving
+    at least half the buckets empty
+    """
+    size = 1
+    while size < 2 * count:
+        size *= 2
+    return size
+
+
+def _index(records, buckets):
+    """
+    Hash table of `buckets` words mapping the crc32 of each key to its
+    position in `records` + 1, 0 marking an empty bucket
+    """
+    table = [0] * buckets
+    for position, key in enumerate(records):
+        slot = crc32(key) & (buckets - 1)
+        while table[slot]:
+            slot = (slot + 1) & (buckets - 1)
+        table[slot] = position + 1
+    return table
+
+
+def compile_snapshot(documents, separator='::', generation=None):
+    """
+    Compile Echelon documents into the binary format read by
+    `MappedSnapshot`
+
+    Echelons are sorted by name, which puts every Echelon beneath a
+    level in one contiguous range, recorded on the level. Each user and
+    group has a sorted posting list of the Echelons granted to it
+    directly. Echelons and members are found through crc32 hash indexes.
+    All integers are 32 bit words in native byte order.
+
+    :return: bytes
+    """
+    strings = bytearray()
+
+    def intern(text):
+        encoded = text if isinstance(text, bytes) else text.encode('utf-8')
+        strings.extend(encoded)
+        return len(strings) - len(encoded), len(encoded)
+
+    intern(separator)
+    documents = list(documents)
+    names = [document['echelon'].encode('utf-8') for document in documents]
+    order = sorted(range(len(names)), key=names.__getitem__)
+    position = {rank: i for i, rank in enumerate(order)}
+    ordered = [names[rank] for rank in order]
+    below = separator.encode('utf-8')
+
+    words = array('I')
+    for rank in order:
+        name = names[rank]
+        words.extend(intern(documents[rank]['echelon']))
+        # UTF-8 never contains 0xff, bounding every name starting with the prefix
+        words.extend((rank, bisect_left(ordered, name + below), bisect_left(ordered, name + below + b'\xff')))
+    echelon_buckets = _buckets(len(ordered))
+    words.extend(_index(ordered, echelon_buckets))
+
+    postings = array('I')
+    counts = []
+    for member_type in ('users', 'groups'):
+        granted = {}
+        for rank, document in enumerate(documents):
+            for member in document.get(member_type, ()):
+                key = _member_key(member)
+                if key is None:
+                    raise TypeError('Cannot store {} member {!r} of {} in a snapshot file, members must be str, '
+                                    'int or None'.format(member_type, member, document['echelon']))
+                granted.setdefault(key, set()).add(position[rank])
+        for key, echelons in granted.items():
+            words.extend(intern(key))
+            words.extend((len(postings), len(echelons)))
+            postings.extend(sorted(echelons))
+        buckets = _buckets(len(granted))
+        words.extend(_index(list(granted), buckets))
+        counts.extend((len(granted), buckets))
+    words.extend(postings)
+
+    header = _HEADER.pack(_MAGIC, _BYTE_ORDER, -1 if generation is None else generation, len(separator.encode('utf-8')),
+                          len(ordered), echelon_buckets, counts[0], counts[1], counts[2], counts[3], len(postings))
+    return header + words.tobytes() + bytes(strings)
+
+
+def write_snapshot(path, documents, separator='::', generation=None):
+    """
+    Compile Echelon documents into a snapshot file at `path`, replacing
+    any previous one atomically. Processes which mapped the previous file
+    keep reading it until they remap.
+
+    :return: (int) bytes written
+    """
+    data = compile_snapshot(documents, separator, generation)
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, scratch = tempfile.mkstemp(prefix='.echelon-snapshot-', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(scratch, 0o644)
+        os.replace(scratch, path)
+    except BaseException:
+        os.unlink(scratch)
+        raise
+    return len(data)
+
+
+class MappedSnapshot:
+    """
+    Read only snapshot memory mapped from a file written by
+    `write_snapshot`, with the same interface as `EchelonSnapshot`
+
+    Every process mapping the same file shares one copy of it in the page
+    cache. Checks read the mapped words in place, only names returned to
+    the caller are copied out. The file is never modified, a new one
+    replaces it and `changed()` reports when to map that instead.
+
+    :param path: (str) snapshot file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stat.st_size < _HEADER.size:
+            raise ValueError('{} is not an Echelon snapshot file'.format(path))
+        (magic, byte_order, generation, separator, echelons, echelon_buckets, users, user_buckets, groups,
+         group_buckets, postings) = _HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC:
+            raise ValueError('{} is not an Echelon snapshot file'.format(path))
+        if byte_order != _BYTE_ORDER:
+            raise ValueError('{} was written on a host with a different byte order'.format(path))
+        self.generation = None if generation < 0 else generation
+        self._count = echelons
+        self._echelon_buckets = echelon_buckets
+        # Offsets of each section, in words
+        self._echelon_index = echelons * _ECHELON_WIDTH
+        self._members = {}
+        offset = self._echelon_index + echelon_buckets
+        for member_type, count, buckets in (('users', users, user_buckets), ('groups', groups, group_buckets)):
+            self._members[member_type] = (offset, offset + count * _MEMBER_WIDTH, buckets)
+            offset += count * _MEMBER_WIDTH + buckets
+        self._postings = offset
+        end = _HEADER.size + (offset + postings) * 4
+        view = memoryview(self._mmap)
+        self._words = view[_HEADER.size:end].cast('I')
+        self._strings = view[end:]
+        self.separator = bytes(self._strings[:separator]).decode('utf-8')
+
+    def __len__(self):
+        return self._count
+
+    def changed(self):
+        """
+        If the file at `path` was replaced since it was mapped
+
+        :return: bool
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self._identity
+
+    def check(self, echelon, users=frozenset(), groups=frozenset()):
+        """
+        Verify if any of `users` or `groups` is granted `echelon` or any
+        level above it
+
+        :return: Bool
+        """
+        levels = self._levels(echelon)
+        if not levels:
+            return False
+        for start, count in self._postings_of(users, groups):
+            for level in levels:
+                if self._contains(start, count, level):
+                    return True
+        return False
+
+    def check_many(self, echelons, users=frozenset(), groups=frozenset()):
+        """
+        :return: dict mapping each of `echelons` to Bool
+        """
+        postings = list(self._postings_of(users, groups))
+        return {echelon: any(self._contains(start, count, level)
+                             for level in self._levels(echelon) for start, count in postings)
+                for echelon in echelons}
+
+    def granting_level(self, echelon, users=frozenset(), groups=frozenset()):
+        """
+        The highest level of `echelon` which grants `users` or `groups`
+
+        :return: (str) Echelon, or None if access is denied
+        """
+        postings = list(self._postings_of(users, groups))
+        for level in self._levels(echelon):
+            if any(self._contains(start, count, level) for start, count in postings):
+                return self._name(level)
+        return None
+
+    def granted(self, users=frozenset(), groups=frozenset()):
+        """
+        Every Echelon which grants `users` or `groups` directly
+
+        :return: frozenset
+        """
+        return frozenset(self._name(position) for position in self._granted(users, groups))
+
+    def member_echelons(self, users=frozenset(), groups=frozenset()):
+        """
+        Every defined Echelon which `users` or `groups` can access, in
+        the order they were loaded
+
+        :return: list
+        """
+        words = self._words
+        positions = set()
+        for position in self._granted(users, groups):
+            record = position * _ECHELON_WIDTH
+            positions.add(position)
+            positions.update(range(words[record + 3], words[record + 4]))
+        return [self._name(position)
+                for position in sorted(positions, key=lambda position: words[position * _ECHELON_WIDTH + 2])]
+
+    def _find(self, index, buckets, records, width, key):
+        """
+        Position of the record named `key` in a hash indexed section, or
+        None
+        """
+        words, strings = self._words, self._strings
+        slot = crc32(key) & (buckets - 1)
+        while True:
+            entry = words[index + slot]
+            if not entry:
+                return None
+            record = records + (entry - 1) * width
+            offset, length = words[record], words[record + 1]
+            if length == len(key) and strings[offset:offset + length] == key:
+                return entry - 1
+            slot = (slot + 1) & (buckets - 1)
+
+    def _levels(self, echelon):
+        """
+        Positions of the defined levels of `echelon`, top first
+        """
+        levels = []
+        parts = echelon.split(self.separator)
+        for i in range(1, len(parts) + 1):
+            key = self.separator.join(parts[:i]).encode('utf-8')
+            position = self._find(self._echelon_index, self._echelon_buckets, 0, _ECHELON_WIDTH, key)
+            if position is not None:
+                levels.append(position)
+        return levels
+
+    def _postings_of(self, users, groups):
+        """
+        (start, count) of the posting list of each known member
+        """
+        words = self._words
+        for member_type, members in (('users', users), ('groups', groups)):
+            records, index, buckets = self._members[member_type]
+            for member in members:
+                key = _member_key(member)
+                position = self._find(index, buckets, records, _MEMBER_WIDTH, key) if key is not None else None
+                if position is not None:
+                    record = records + position * _MEMBER_WIDTH
+                    yield self._postings + words[record + 2], words[record + 3]
+
+    def _contains(self, start, count, position):
+        words = self._words
+        low, high = start, start + count
+        while low < high:
+            middle = (low + high) // 2
+            if words[middle] < position:
+                low = middle + 1
+            else:
+                high = middle
+        return low < start + count and words[low] == position
+
+    def _granted(self, users, groups):
+        words = self._words
+        granted = set()
+        for start, count in self._postings_of(users, groups):
+            granted.update(words[start:start + count])
+        return granted
+
+    def _name(self, position):
+        record = position * _ECHELON_WIDTH
+        offset, length = self._words[record], self._words[record + 1]
+        return bytes(self._strings[offset:offset + length]).decode('utf-8')
+
+
+class SnapshotRefresher:
+    """
+    Rebuilds a snapshot in a background thread, either every `interval`
+    seconds or as soon as `request()` is called. The current snapshot
+    keeps serving checks until its replacement is ready.
+    """
+
+    def __init__(self, build, interval=None):
+        self._build = build
+        self._interval = interval
+        self._wanted = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='echelon-snapshot', daemon=True)
+                self._thread.start()
+
+    def request(self):
+        self._wanted.set()
+        self.start()
+
+    def _run(self):
+        while True:
+            self._wanted.wait(self._interval)
+            self._wanted.clear()
+            try:
+                self._build()
+            except Exception:
+                logger.exception('Failed to rebuild Echelon snapshot, continuing with the previous one')
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from . import MemberTypes
+
+SALT = 'flask-echelon-permissions'
+
+
+def roots(echelons, separator='::'):
+    """
+    The Echelons of `echelons` with no level above them also in it.
+    Access granted by a set of Echelons closed under descendants is
+    decided by its roots alone.
+
+    :return: list, sorted
+    """
+    echelons = set(echelons)
+    found = []
+    for echelon in sorted(echelons):
+        parts = echelon.split(separator)
+        if not any(separator.join(parts[:i]) in echelons for i in range(1, len(parts))):
+            found.append(echelon)
+    return found
+
+
+class PermissionToken:
+    """
+    A member's effective Echelons as of a collection `version`, decoded
+    from a signed token
+
+    :param member: (str) user id or group name
+    :param member_type: (`MemberTypes`)
+    :param echelons: iterable of (str) roots of the member's effective
+    Echelons, see `roots`
+    :param version: (int) collection generation the Echelons were read at
+    :param expires: (int) unix time after which the token is rejected
+    """
+
+    def __init__(self, member, member_type, echelons, version, expires):
+        self.member = member
+        self.member_type = member_type
+        self.echelons = frozenset(echelons)
+        self.version = version
+        self.expires = expires
+
+    @property
+    def expired(self):
+        return time.time() >= self.expires
+
+    def allows(self, hierarchy):
+        """
+        :param hierarchy: list of every level of an Echelon
+        :return: bool
+        """
+        return not self.echelons.isdisjoint(hierarchy)
+
+    def dumps(self, secret_key):
+        payload = {'m': self.member, 't': self.member_type.value, 'e': sorted(self.echelons), 'v': self.version,
+                   'x': self.expires}
+        return URLSafeSerializer(secret_key, salt=SALT).dumps(payload)
+
+    @classmethod
+    def loads(cls, token, secret_key):
+        """
+        :return: (`PermissionToken`) or None if `token` is malformed or
+        its signature does not match `secret_key`
+        """
+        try:
+            payload = URLSafeSerializer(secret_key, salt=SALT).loads(token)
+            return cls(payload['m'], MemberTypes(payload['t']), payload['e'], payload['v'], payload['x'])
+        except (BadSignature, KeyError, TypeError, ValueError):
+            return None
+
+    def __repr__(self):
+        return '<PermissionToken {}:{} version={} echelons={}>'.format(self.member_type.value, self.member,
+                                                                       self.version, len(self.echelons))
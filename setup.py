@@ -36,7 +36,7 @@ setup(
     author="Jesse Roberts",
     author_email='jesse@jesseops.net',
     url='https://github.com/jesseops/flask_echelon',
-    packages=find_packages(exclude=('tests',)),
+    packages=find_packages(exclude=('tests', 'benchmarks')),
     include_package_data=True,
     install_requires=__requirements__,
     license="MIT license",
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_aio
+----------------------------------
+
+Tests for `aio` module.
+"""
+
+import asyncio
+
+import pytest
+from flask import Flask, _request_ctx_stack
+from flask_login import LoginManager, UserMixin
+from pymongo import MongoClient
+
+from flask_echelon import AccessCheckFailed, EchelonManager, MemberTypes
+from flask_echelon.aio import AsyncEchelonManager, has_access, require_echelon
+
+# only use one MongoClient instance
+DB = MongoClient().test_flask_echelon
+
+
+class User(UserMixin):
+    """Mocks Flask-Login User"""
+
+    def __init__(self, user_id, groups):
+        self.id = user_id
+        self.groups = groups
+
+
+class AsyncCursor:
+    def __init__(self, cursor):
+        self._cursor = iter(cursor)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0)
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncCollection:
+    """In memory stand in for a Motor collection, wrapping a synchronous one"""
+
+    in_flight = 0
+    max_in_flight = 0
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            AsyncCollection.in_flight += 1
+            AsyncCollection.max_in_flight = max(AsyncCollection.max_in_flight, AsyncCollection.in_flight)
+            try:
+                await asyncio.sleep(0.001)
+                return method(*args, **kwargs)
+            finally:
+                AsyncCollection.in_flight -= 1
+
+        return call
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self._collection.find(*args, **kwargs))
+
+
+class AsyncDatabase:
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return AsyncCollection(self._database[name])
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def setup_function(function):
+    DB.echelons.drop()
+    DB.echelons_meta.drop()
+    DB.echelons_effective.drop()
+
+
+def teardown_function(function):
+    DB.echelons.drop()
+    DB.echelons_meta.drop()
+    DB.echelons_effective.drop()
+
+
+@pytest.fixture
+def manager():
+    manager = AsyncEchelonManager(database=AsyncDatabase(DB))
+    run(manager.create_indexes())
+    run(manager.define_echelon('foo'))
+    run(manager.define_echelon('foo::bar'))
+    run(manager.define_echelon('spam'))
+    return manager
+
+
+def test_000_mirrors_sync_manager(manager):
+    run(manager.add_member('foo', 'user', MemberTypes.USER))
+    run(manager.add_member('spam', ['group', 'other'], MemberTypes.GROUP))
+    run(manager.remove_member('spam', 'other', MemberTypes.GROUP))
+    user = User('user', ['group'])
+    sync = EchelonManager(database=DB)
+
+    for echelon in ('foo', 'foo::bar::baz', 'spam', 'ham'):
+        assert run(manager.check_access(user, echelon)) is sync.check_access(user, echelon)
+    assert run(manager.member_echelons(user, MemberTypes.USER)) == sync.member_echelons(user, MemberTypes.USER)
+    assert run(manager.all_echelons) == sync.all_echelons
+    assert run(manager.get_echelon('spam'))['groups'] == ['group']
+    access = run(manager.check_access_many('group', ['spam', 'foo'], MemberTypes.GROUP))
+    assert access == {'spam': True, 'foo': False}
+
+    run(manager.remove_echelon('spam'))
+    assert run(manager.get_echelon('spam')) is None
+    assert sync.generation == 7
+
+
+def test_001_concurrent_checks(manager):
+    run(manager.add_member('foo', 'user', MemberTypes.USER))
+    users = [User('user', []), User('other', [])] * 10
+    AsyncCollection.max_in_flight = 0
+
+    async def check_all():
+        return await asyncio.gather(*[manager.check_access(user, 'foo::bar') for user in users])
+
+    assert run(check_all()) == [True, False] * 10
+    assert AsyncCollection.max_in_flight > 1
+
+
+def test_002_async_group_resolver():
+    async def resolver(user):
+        return ['group']
+
+    manager = AsyncEchelonManager(database=AsyncDatabase(DB), group_resolver=resolver)
+    run(manager.define_echelon('foo'))
+    run(manager.add_member('foo', 'group', MemberTypes.GROUP))
+    assert run(manager.check_access(User('user', []), 'foo::bar')) is True
+
+
+def test_003_helpers(manager):
+    app = Flask(__name__)
+    LoginManager(app)
+    manager.init_app(app)
+    run(manager.add_member('foo', 'user', MemberTypes.USER))
+
+    @require_echelon('foo::bar')
+    async def foo():
+        return 'foo'
+
+    @require_echelon('spam')
+    async def spam():
+        return 'spam'
+
+    with app.test_request_context():
+        _request_ctx_stack.top.user = User('user', [])
+        assert run(has_access('foo')) is True
+        assert run(foo()) == 'foo'
+        with pytest.raises(AccessCheckFailed):
+            run(spam())
+
+
+def test_004_effective_view():
+    """Async writes keep the effective view of synchronous managers current"""
+    manager = AsyncEchelonManager(database=AsyncDatabase(DB), effective=True)
+    run(manager.create_indexes())
+    sync = EchelonManager(database=DB, effective=True, generation_interval=0)
+    user = User('user', ['staff'])
+
+    run(manager.define_echelon('foo'))
+    run(manager.add_member('foo', 'user', MemberTypes.USER))
+    run(manager.define_echelon('foo::bar'))
+    run(manager.define_echelon('spam'))
+    run(manager.add_member('spam', ['staff', 'other'], MemberTypes.GROUP))
+    assert sync.check_effective() == []
+    assert sync.check_access(user, 'foo::bar') is True
+    assert sync.check_access(user, 'spam') is True
+
+    run(manager.remove_member('spam', 'staff', MemberTypes.GROUP))
+    run(manager.remove_echelon('foo::bar'))
+    assert sync.check_effective() == []
+    assert sync.check_access(user, 'spam') is False
+    assert sync.member_echelons(user, MemberTypes.USER) == ['foo']
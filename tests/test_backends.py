@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_backends
+----------------------------------
+
+Tests for `backends` package. Every backend runs the same tests.
+"""
+
+import sqlite3
+
+import pytest
+from flask_login import UserMixin
+from pymongo import MongoClient
+
+from flask_echelon import EchelonManager, MemberTypes
+from flask_echelon.backends import MemoryBackend, MongoBackend, SQLiteBackend
+
+# only use one MongoClient instance
+DB = MongoClient().test_flask_echelon
+
+BACKENDS = {'mongo': lambda: MongoBackend(DB),
+            'memory': MemoryBackend,
+            'sqlite': SQLiteBackend}
+
+
+class User(UserMixin):
+    """Mocks Flask-Login User"""
+
+    def __init__(self, user_id, groups):
+        self.id = user_id
+        self.groups = groups
+
+
+def setup_function(function):
+    DB.echelons.drop()
+    DB.echelons_meta.drop()
+
+
+def teardown_function(function):
+    DB.echelons.drop()
+    DB.echelons_meta.drop()
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request):
+    backend = BACKENDS[request.param]()
+    backend.create_indexes()
+    return backend
+
+
+@pytest.fixture(params=[{}, {'single_query': True}, {'cache_size': 100}, {'snapshot': True}, {'snapshot': 'bitset'},
+                        {'snapshot': 'mmap'}],
+                ids=['levels', 'single_query', 'cache', 'snapshot', 'bitset', 'mmap'])
+def manager(request, backend, tmp_path):
+    options = dict(request.param)
+    if options.get('snapshot') == 'mmap':
+        options['snapshot_path'] = str(tmp_path / 'echelons.snapshot')
+    return EchelonManager(backend=backend, **options)
+
+
+def refresh(manager):
+    """Rebuild a snapshot manager's snapshot, writing its file first as the refresher process would"""
+    if manager.snapshot is not None:
+        if manager._snapshot_path is not None:
+            manager.write_snapshot()
+        manager.refresh_snapshot()
+
+
+def test_000_define_get_remove(backend):
+    assert backend.get('foo') is None
+    backend.define('foo', 'Foo', 'Foo help')
+    backend.add_members('foo', MemberTypes.USER, ['bob'])
+    backend.define('foo', 'Renamed', 'New help')
+    assert backend.get('foo') == {'echelon': 'foo', 'name': 'Renamed', 'help': 'New help',
+                                  'users': ['bob'], 'groups': []}
+    backend.remove('foo')
+    assert backend.get('foo') is None
+    assert not backend.is_member({'bob'}, frozenset(), ['foo'])
+
+
+def test_001_members_keep_order(backend):
+    backend.define('foo', 'foo', 'foo')
+    backend.add_members('foo', MemberTypes.USER, ['c', 'a', 'b'])
+    backend.add_members('foo', MemberTypes.USER, ['a', 'd'])
+    backend.remove_members('foo', MemberTypes.USER, ['b'])
+    backend.add_members('undefined', MemberTypes.USER, ['a'])
+    assert backend.get('foo')['users'] == ['c', 'a', 'd']
+    assert backend.get('undefined') is None
+
+
+def test_002_anonymous_member(backend):
+    backend.define('anon', 'anon', 'anon')
+    backend.add_members('anon', MemberTypes.USER, [None])
+    backend.add_members('anon', MemberTypes.USER, [None])
+    assert backend.get('anon')['users'] == [None]
+    assert backend.is_member({None}, frozenset(), ['anon'])
+    assert backend.granted({None}, frozenset()) == {'anon'}
+
+
+def test_003_lookups(backend):
+    for echelon in ('foo', 'foo::bar', 'foo::bar::baz', 'foo:;', 'foobar', 'spam'):
+        backend.define(echelon, echelon, echelon)
+    backend.add_members('foo::bar', MemberTypes.GROUP, ['staff'])
+    backend.add_members('spam', MemberTypes.USER, ['bob'])
+
+    assert backend.is_member(frozenset(), {'staff'}, ['foo', 'foo::bar'])
+    assert not backend.is_member({'staff'}, frozenset(), ['foo::bar'])
+    assert backend.granted({'bob'}, {'staff'}) == {'foo::bar', 'spam'}
+    assert backend.granted({'bob'}, {'staff'}, ['foo', 'foo::bar']) == {'foo::bar'}
+    assert backend.descendants(['foo'], '::') == ['foo', 'foo::bar', 'foo::bar::baz']
+    assert backend.descendants(['foo::bar', 'spam'], '::') == ['foo::bar', 'foo::bar::baz', 'spam']
+    assert [e['echelon'] for e in backend.find_all()] == ['foo', 'foo::bar', 'foo::bar::baz', 'foo:;', 'foobar',
+                                                          'spam']
+
+
+def test_004_generation(backend):
+    assert backend.generation() == 0
+    assert backend.bump_generation() == 1
+    assert backend.bump_generation() == 2
+    assert backend.generation() == 2
+
+
+def test_010_versions(backend):
+    assert backend.version('foo') == 0
+    assert backend.bump_generation(['foo', 'bar']) == 1
+    assert backend.bump_generation(['bar']) == 2
+    assert backend.bump_generation() == 3
+    assert (backend.version('foo'), backend.version('bar'), backend.version('baz')) == (1, 2, 0)
+
+
+def test_005_manager(manager):
+    manager.define_echelon('foo')
+    manager.define_echelon('foo::bar')
+    manager.define_echelon('ham::spam::eggs')
+    manager.define_echelon('spam')
+    manager.add_member('foo', 'user', MemberTypes.USER)
+    manager.add_member('ham::spam::eggs', 'group', MemberTypes.GROUP)
+    refresh(manager)
+    user = User('user', ['group'])
+
+    assert manager.check_access(user, 'foo::bar::baz') is True
+    assert manager.check_access(user, 'ham::spam') is False
+    assert manager.check_access('group', 'ham::spam::eggs', MemberTypes.GROUP) is True
+    assert manager.check_access(User('other', []), 'foo') is False
+    assert manager.check_access_many(user, ['foo', 'spam']) == {'foo': True, 'spam': False}
+    assert manager.member_echelons(user, MemberTypes.USER) == ['foo', 'foo::bar', 'ham::spam::eggs']
+    assert manager.granted_echelons(user) == {'foo', 'ham::spam::eggs'}
+    assert set(manager.all_echelons) == {'foo', 'foo::bar', 'ham::spam::eggs', 'spam'}
+
+    manager.remove_member('foo', 'user', MemberTypes.USER)
+    manager.remove_echelon('ham::spam::eggs')
+    refresh(manager)
+    assert manager.check_access(user, 'foo') is False
+    assert manager.member_echelons(user, MemberTypes.USER) == []
+    assert manager.generation == 8
+
+
+def test_006_sqlite_shared_file(tmp_path):
+    path = str(tmp_path / 'echelons.db')
+    writer = EchelonManager(backend=SQLiteBackend(path))
+    reader = EchelonManager(backend=SQLiteBackend(path), cache_size=10, generation_interval=0)
+    writer.define_echelon('foo')
+    user = User('user', [])
+
+    assert reader.check_access(user, 'foo') is False
+    writer.add_member('foo', 'user', MemberTypes.USER)
+    assert reader.check_access(user, 'foo') is True
+
+
+def test_007_bulk_update(backend):
+    backend.define('foo', 'foo', 'foo')
+    backend.define('spam', 'spam', 'spam')
+    backend.add_members('spam', MemberTypes.USER, ['bob'])
+    result = backend.bulk_update([('add', 'foo', MemberTypes.USER, ['bob', 'alice']),
+                                  ('add', 'foo', MemberTypes.GROUP, ['staff']),
+                                  ('remove', 'spam', MemberTypes.USER, ['bob']),
+                                  ('remove', 'spam', MemberTypes.USER, ['nobody']),
+                                  ('add', 'undefined', MemberTypes.USER, ['bob'])])
+    assert result == {'operations': 5, 'matched': 4, 'modified': 3}
+    assert backend.get('foo')['users'] == ['bob', 'alice']
+    assert backend.get('foo')['groups'] == ['staff']
+    assert backend.get('spam')['users'] == []
+
+
+def test_008_replace_and_find_all(backend):
+    backend.define('foo', 'foo', 'foo')
+    backend.add_members('foo', MemberTypes.USER, ['old'])
+    documents = [{'echelon': 'foo', 'name': 'Foo', 'help': 'Foo help', 'users': ['new'], 'groups': ['staff']},
+                 {'echelon': 'bar', 'name': 'Bar', 'help': 'Bar help', 'users': [], 'groups': ['staff']}]
+    backend.replace(documents)
+    assert sorted(backend.find_all(batch_size=1), key=lambda d: d['echelon']) == documents[::-1]
+    assert backend.granted({'old'}, frozenset()) == set()
+    assert backend.granted({'new'}, {'staff'}) == {'foo', 'bar'}
+
+
+def test_009_find_page(backend):
+    for echelon in ('spam', 'foo::bar', 'foo', 'foobar', 'foo::baz', 'eggs'):
+        backend.define(echelon, echelon, echelon)
+    backend.add_members('foo', MemberTypes.USER, ['bob'])
+
+    assert [e['echelon'] for e in backend.find_page(limit=2)] == ['eggs', 'foo']
+    assert [e['echelon'] for e in backend.find_page(after='foo', limit=2)] == ['foo::bar', 'foo::baz']
+    assert [e['echelon'] for e in backend.find_page(prefix='foo::')] == ['foo::bar', 'foo::baz']
+    assert [e['echelon'] for e in backend.find_page(after='foo::bar', prefix='foo')] == ['foo::baz', 'foobar']
+    assert backend.find_page(limit=1, prefix='foo', fields={'name'}) == [{'echelon': 'foo', 'name': 'foo'}]
+    assert backend.find_page(limit=1, prefix='foo', fields={'users'}) == [{'echelon': 'foo', 'users': ['bob']}]
+
+
+def test_011_verify_indexes(backend):
+    assert backend.verify_indexes() == []
+    if isinstance(backend, MongoBackend):
+        DB.echelons.drop_index('groups_1_echelon_1')
+        assert backend.verify_indexes() == ['groups_1_echelon_1 is missing']
+        backend.create_indexes()
+        assert EchelonManager(backend=backend).verify_indexes() == []
+
+
+def test_012_explain(monkeypatch, caplog):
+    """Warns about any query falling back to a collection scan"""
+    def explain(cursor):
+        # Pretend only filters on the echelon can use an index
+        stage = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}} if 'echelon' in cursor._spec else \
+            {'stage': 'COLLSCAN'}
+        return {'queryPlanner': {'winningPlan': {'stage': 'PROJECTION_SIMPLE', 'inputStage': stage}}}
+
+    monkeypatch.setattr(type(DB.echelons.find()), 'explain', explain, raising=False)
+    manager = EchelonManager(backend=MongoBackend(DB))
+    report = manager.explain(User('user', ['staff']), 'foo::bar')
+    assert report['is_member'] == ['PROJECTION_SIMPLE', 'FETCH', 'IXSCAN']
+    assert report['granted'] == ['PROJECTION_SIMPLE', 'COLLSCAN']
+    assert [r.getMessage().split()[0] for r in caplog.records if r.levelname == 'WARNING'] == ['granted']
+
+    with pytest.raises(NotImplementedError):
+        EchelonManager(backend=MemoryBackend()).explain(User('user', []), 'foo')
+
+
+def test_013_members_with_access(manager):
+    for echelon in ('billing', 'billing::refunds', 'billing::refunds::issue', 'other'):
+        manager.define_echelon(echelon)
+    manager.add_member('billing', ['alice', 'bob'], MemberTypes.USER)
+    manager.add_member('billing::refunds', ['bob', 'carol'], MemberTypes.USER)
+    manager.add_member('billing::refunds', 'finance', MemberTypes.GROUP)
+    manager.add_member('billing::refunds::issue', 'support', MemberTypes.GROUP)
+    manager.add_member('other', 'dave', MemberTypes.USER)
+
+    queries = manager.query_count
+    members = manager.members_with_access('billing::refunds::issue')
+    assert manager.query_count == queries
+    assert list(members) == [
+        {'member': 'alice', 'member_type': 'users', 'echelon': 'billing'},
+        {'member': 'bob', 'member_type': 'users', 'echelon': 'billing'},
+        {'member': 'carol', 'member_type': 'users', 'echelon': 'billing::refunds'},
+        {'member': 'finance', 'member_type': 'groups', 'echelon': 'billing::refunds'},
+        {'member': 'support', 'member_type': 'groups', 'echelon': 'billing::refunds::issue'},
+    ]
+    assert manager.query_count == queries + 1
+    assert [m['member'] for m in manager.members_with_access('billing::refunds::x', MemberTypes.GROUP)] == \
+        ['finance']
+    assert list(manager.members_with_access('billing::undefined')) == [
+        {'member': 'alice', 'member_type': 'users', 'echelon': 'billing'},
+        {'member': 'bob', 'member_type': 'users', 'echelon': 'billing'}]
+    assert list(manager.members_with_access('undefined')) == []
+    with pytest.raises(TypeError):
+        manager.members_with_access('billing', 'users')
+
+
+def test_014_echelon_ids(backend):
+    ids = backend.echelon_ids(['foo', 'bar', 'foo::baz'])
+    assert sorted(ids.values()) == [0, 1, 2]
+    assert backend.echelon_ids(['bar', 'spam', 'bar']) == {'bar': ids['bar'], 'spam': 3}
+    # Stable however often they are asked for, and never reused
+    assert backend.echelon_ids(['foo::baz', 'foo']) == {'foo::baz': ids['foo::baz'], 'foo': ids['foo']}
+    assert backend.echelon_ids([]) == {}
+
+
+def test_015_apply_changes(manager):
+    manager.define_echelon('foo', help='Foo help')
+    manager.add_member('foo', ['a', 'b', 'c'], MemberTypes.USER)
+    manager.add_member('foo', 'staff', MemberTypes.GROUP)
+    refresh(manager)
+    user = User('d', ['admins'])
+    assert manager.check_access(user, 'foo') is False
+
+    generation = manager.generation
+    # Adding to and removing from the same list at once, along with the name
+    result = manager.apply_changes('foo', set={'name': 'Foo'},
+                                   add={MemberTypes.USER: ['d', 'b', 'e'], 'groups': 'admins'},
+                                   remove={'users': ['b', 'e']})
+    assert result == {'matched': True, 'modified': True, 'created': False}
+    assert manager.generation == generation + 1
+    assert manager.get_echelon('foo') == {'echelon': 'foo', 'name': 'Foo', 'help': 'Foo help',
+                                          'users': ['a', 'c', 'd'], 'groups': ['staff', 'admins']}
+    refresh(manager)
+    assert manager.check_access(user, 'foo::bar') is True
+
+    assert manager.apply_changes('foo', set={'groups': ['ops'], 'help': None}, add={'groups': ['admins']},
+                                 remove={'groups': ['ops']})['modified']
+    assert manager.get_echelon('foo')['groups'] == ['admins']
+    assert manager.get_echelon('foo')['help'] == 'Provides access to foo'
+    assert manager.apply_changes('foo', remove={'users': 'x'}) == {'matched': True, 'modified': False,
+                                                                   'created': False}
+    assert manager.apply_changes('foo') == {'matched': True, 'modified': False, 'created': False}
+    with pytest.raises(TypeError):
+        manager.apply_changes('foo', add=['bob'])
+    assert manager.apply_changes('missing', add={'users': 'a'}) == {'matched': False, 'modified': False,
+                                                                    'created': False}
+    assert manager.get_echelon('missing') is None
+
+    # Creating never touches an existing Echelon
+    assert manager.apply_changes('foo', set={'name': 'Other', 'users': []}, create=True)['created'] is False
+    assert manager.get_echelon('foo')['name'] == 'Foo'
+    assert manager.apply_changes('bar', set={'users': ['a', 'a']}, add={'groups': 'g'}, create=True) == \
+        {'matched': False, 'modified': True, 'created': True}
+    assert manager.get_echelon('bar') == {'echelon': 'bar', 'name': 'bar', 'help': 'Provides access to bar',
+                                          'users': ['a'], 'groups': ['g']}
+
+    with pytest.raises(ValueError):
+        manager.apply_changes('foo', set={'echelon': 'bar'})
+    with pytest.raises(ValueError):
+        manager.apply_changes('foo', add={'members': ['a']})
+
+
+def test_016_descendants_sorted(backend):
+    backend.replace([{'echelon': echelon, 'name': echelon, 'help': '', 'users': [], 'groups': []}
+                     for echelon in ('b::z', 'a::b', 'b', 'c', 'a', 'b::a')])
+    assert backend.descendants(['b', 'a'], '::') == ['a', 'a::b', 'b', 'b::a', 'b::z']
+    assert backend.descendants([], '::') == []
+
+
+@pytest.mark.skipif(not hasattr(sqlite3.Connection, 'setlimit'), reason='Connection.setlimit needs Python 3.11')
+def test_017_sqlite_variable_limit():
+    """Long value lists fit the 999 bound parameters of SQLite before 3.32"""
+    backend = SQLiteBackend()
+    backend._connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    echelons = ['e{:04}'.format(i) for i in range(1200)]
+    backend.replace([{'echelon': echelon, 'name': echelon, 'help': '', 'users': [echelon], 'groups': ['all']}
+                     for echelon in echelons])
+    users = ['e{:04}'.format(i) for i in range(0, 1200, 2)]
+
+    assert len(list(backend.find_all(batch_size=1000))) == 1200
+    assert backend.descendants(echelons, '::') == echelons
+    assert backend.granted(users, []) == set(users)
+    assert backend.granted(users, [], levels=echelons[:600]) == set(users[:300])
+    assert backend.granted([], ['all'], levels=echelons) == set(echelons)
+    assert backend.is_member(users, [], ['e1199', 'e1198']) is True
+    assert backend.is_member(users, [], ['e1199']) is False
+    assert len(backend.find_levels(echelons)) == 1200
+
+
+class Pymongo4Collection:
+    """Wraps a collection, failing on every method pymongo 4 removed"""
+
+    REMOVED = {'count', 'ensure_index', 'find_and_modify', 'insert', 'remove', 'save', 'update'}
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        if name in self.REMOVED:
+            raise AttributeError('Collection.{} was removed in pymongo 4'.format(name))
+        return getattr(self._collection, name)
+
+
+def test_018_mongo_pymongo4_api():
+    class Pymongo4Backend(MongoBackend):
+        @property
+        def collection(self):
+            return Pymongo4Collection(super().collection)
+
+        @property
+        def meta(self):
+            return Pymongo4Collection(super().meta)
+
+    manager = EchelonManager(backend=Pymongo4Backend(DB))
+    manager.define_echelon('foo')
+    manager.define_echelon('foo', name='Foo')
+    manager.add_member('foo', ['bob', 'alice'], MemberTypes.USER)
+    manager.remove_member('foo', 'alice', MemberTypes.USER)
+    manager.bulk_update_members([{'op': 'add', 'echelon': 'foo', 'member': 'ops', 'member_type': 'groups'}])
+    manager.apply_changes('foo', add={'users': ['carol']}, remove={'users': ['bob']})
+    assert manager.get_echelon('foo')['name'] == 'Foo'
+    assert manager.get_echelon('foo')['users'] == ['carol']
+    manager.remove_echelon('foo')
+    assert manager.get_echelon('foo') is None
+
+
+def test_019_member_echelons_order(manager):
+    """Every mode lists a member's Echelons in the same, sorted, order"""
+    for echelon in ('spam', 'foo::bar', 'ham', 'foo', 'foo::baz', 'ham::eggs'):
+        manager.define_echelon(echelon)
+    manager.add_member('spam', 'user', MemberTypes.USER)
+    manager.add_member('foo', 'group', MemberTypes.GROUP)
+    manager.add_member('ham::eggs', 'user', MemberTypes.USER)
+    refresh(manager)
+    user = User('user', ['group'])
+
+    expected = ['foo', 'foo::bar', 'foo::baz', 'ham::eggs', 'spam']
+    assert manager.member_echelons(user, MemberTypes.USER) == expected
+    assert EchelonManager(backend=manager.backend).member_echelons(user, MemberTypes.USER) == expected
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_benchmarks.py
+----------------------------------
+
+Tests for the `benchmarks` suite, kept small enough to run with the tests.
+"""
+from benchmarks import snapshots
+from benchmarks.data import Dataset
+from benchmarks.run import main, parse_args, percentile, run
+
+
+def test_000_dataset():
+    dataset = Dataset(depth=3, fanout=2, echelons=10, users_per_echelon=2, groups_per_user=2, groups=4)
+    assert dataset.echelons == ['e0', 'e1', 'e0::0', 'e0::1', 'e1::0', 'e1::1',
+                                'e0::0::0', 'e0::0::1', 'e0::1::0', 'e0::1::1']
+    assert dataset.leaves == ['e0::0::0', 'e0::0::1', 'e0::1::0', 'e0::1::1']
+    assert all(len(d['users']) == 2 and len(d['groups']) == 1 for d in dataset.documents)
+    assert all(len(user.groups) == 2 for user in dataset.users)
+    # Deterministic for a seed
+    assert Dataset(echelons=50).documents == Dataset(echelons=50).documents
+
+
+def test_001_percentile():
+    samples = list(range(1, 101))
+    assert (percentile(samples, 50), percentile(samples, 90), percentile(samples, 99)) == (50, 90, 99)
+    assert percentile([7], 99) == 7
+
+
+def test_002_run():
+    args = parse_args(['--backend', 'memory', 'sqlite', '--mode', 'levels', 'snapshot', '--echelons', '50',
+                       '--iterations', '10', '--warmup', '1'])
+    results = run(args)
+    assert len(results) == 2 * 2 * 6
+    levels = {(r['backend'], r['mode'], r['operation']): r for r in results}
+    assert levels['memory', 'levels', 'check_access_many']['round_trips'] == 1
+    assert levels['sqlite', 'snapshot', 'check_access']['round_trips'] == 0
+    assert all(r['p50_us'] <= r['p90_us'] <= r['p99_us'] for r in results)
+
+
+def test_003_json(capsys):
+    main(['--backend', 'memory', '--mode', 'levels', '--operation', 'check_access', '--echelons', '20',
+          '--iterations', '5', '--format', 'json'])
+    assert '"operation": "check_access"' in capsys.readouterr().out
+
+
+def test_004_snapshots(capsys):
+    snapshots.main(['--echelons', '200', '--iterations', '5', '--sample', '10'])
+    output = capsys.readouterr().out
+    assert 'sets' in output and 'bitset' in output and 'mmap' in output
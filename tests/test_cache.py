@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cache
+----------------------------------
+
+Tests for `cache` module.
+"""
+
+import pytest
+
+from flask_echelon.cache import TTLCache
+
+
+class Clock:
+    """Manually advanced timer"""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_000_hit_miss():
+    cache = TTLCache(maxsize=2)
+    assert cache.get('foo') is None
+    cache.set('foo', False)
+    assert cache.get('foo') is False
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_001_lru_eviction():
+    cache = TTLCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+
+def test_002_ttl_expiry():
+    clock = Clock()
+    cache = TTLCache(maxsize=2, ttl=10, timer=clock)
+    cache.set('a', 1)
+    clock.now = 9
+    assert cache.get('a') == 1
+    clock.now = 10
+    assert cache.get('a') is None
+    assert cache.expirations == 1
+
+
+def test_003_discard_where():
+    cache = TTLCache(maxsize=10)
+    for key in ('foo', 'foo::bar', 'spam'):
+        cache.set(key, True)
+    assert cache.discard_where(lambda key: key.startswith('foo')) == 2
+    assert cache.get('spam') is True
+    assert cache.stats['invalidations'] == 2
+
+
+def test_004_invalid_size():
+    with pytest.raises(ValueError):
+        TTLCache(maxsize=0)
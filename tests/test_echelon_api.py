@@ -14,7 +14,7 @@ import pytest
 from flask import Flask
 from pymongo import MongoClient
 
-from flask_echelon import EchelonManager
+from flask_echelon import EchelonManager, MemberTypes
 
 # only use one MongoClient instance
 DB = MongoClient().test_flask_echelon
@@ -138,3 +138,148 @@ def test_004_edit_echelon(client, foo):
 def test_005_delete_echelon(client, foo):
     client.delete(f'/api/echelons/{foo["echelon"]}')
     assert client.get(f'/api/echelons/{foo["echelon"]}').status_code == 404
+
+
+def test_006_bulk_update(client, foo):
+    ops = [{'op': 'add', 'echelon': foo['echelon'], 'member': ['john117', 'kelly087'], 'member_type': 'users'},
+           {'op': 'add', 'echelon': foo['echelon'], 'member': 'spartans', 'member_type': 'groups'}]
+    response = client.post('/api/bulk', data=json.dumps({'ops': ops, 'batch_size': 1}),
+                           headers={'Content-Type': 'application/json'})
+    assert response.status_code == 200
+    assert [batch['modified'] for batch in get_response_json(response)['batches']] == [1, 1]
+
+    e = get_response_json(client.get(f'/api/echelons/{foo["echelon"]}'))
+    assert e['users'] == ['john117', 'kelly087']
+    assert e['groups'] == ['spartans']
+
+    invalid = client.post('/api/bulk', data=json.dumps({'ops': [{'op': 'add'}]}),
+                          headers={'Content-Type': 'application/json'})
+    assert invalid.status_code == 400
+    invalid = client.post('/api/bulk', data=json.dumps({'ops': ops, 'batch_size': 0}),
+                          headers={'Content-Type': 'application/json'})
+    assert invalid.status_code == 400
+    invalid = client.post('/api/bulk', data=json.dumps({'ops': [dict(ops[0], op='remove'), {'op': 'add'}],
+                                                        'batch_size': 1}),
+                          headers={'Content-Type': 'application/json'})
+    assert invalid.status_code == 400
+    assert get_response_json(client.get(f'/api/echelons/{foo["echelon"]}'))['users'] == ['john117', 'kelly087']
+
+
+def test_007_export_import(client, foo):
+    client.post(f'/api/echelons/{foo["echelon"]}', data=json.dumps({'add': {'users': ['john117']}}),
+                headers={'Content-Type': 'application/json'})
+    response = client.get('/api/export?batch_size=1')
+    assert response.mimetype == 'application/x-ndjson'
+    exported = [json.loads(line) for line in response.data.decode('utf8').splitlines()]
+    assert exported == [get_response_json(client.get(f'/api/echelons/{foo["echelon"]}'))]
+
+    client.delete(f'/api/echelons/{foo["echelon"]}')
+    response = client.post('/api/import', data=response.data, headers={'Content-Type': 'application/x-ndjson'})
+    assert get_response_json(response) == {'imported': 1}
+    assert get_response_json(client.get(f'/api/echelons/{foo["echelon"]}'))['users'] == ['john117']
+
+    assert client.post('/api/import', data=b'not json\n').status_code == 400
+    assert client.get('/api/export?batch_size=0').status_code == 400
+    assert client.post('/api/import?batch_size=0', data=response.data).status_code == 400
+
+    lines = b'{"echelon": "spam"}\n{"echelon": "eggs", "users": "alice"}\n'
+    response = client.post('/api/import?batch_size=1', data=lines)
+    assert response.status_code == 400
+    assert get_response_json(response)['imported'] == 1
+    assert client.get('/api/echelons/eggs').status_code == 404
+
+
+def test_008_list_echelons_pages(app, client):
+    for echelon in ('b', 'a::x', 'a', 'c', 'a::y'):
+        app.echelon_manager.define_echelon(echelon)
+
+    response = client.get('/api/echelons?limit=2&fields=name')
+    assert get_response_json(response) == [{'echelon': 'a', 'name': 'a'}, {'echelon': 'a::x', 'name': 'a::x'}]
+    seen = []
+    url = '/api/echelons?limit=2&fields=name'
+    while url:
+        response = client.get(url)
+        seen += [e['echelon'] for e in get_response_json(response)]
+        link = response.headers.get('Link')
+        url = link[link.index('<') + 1:link.index('>')] if link else None
+    assert seen == ['a', 'a::x', 'a::y', 'b', 'c']
+
+    assert [e['echelon'] for e in get_response_json(client.get('/api/echelons?prefix=a::'))] == ['a::x', 'a::y']
+    assert client.get('/api/echelons?fields=password').status_code == 400
+
+
+def test_009_conditional_get(app, client, foo):
+    manager = app.echelon_manager
+    response = client.get('/api/echelons/foo')
+    etag = response.headers['ETag']
+    listing = client.get('/api/echelons').headers['ETag']
+
+    reads = manager.query_count
+    response = client.get('/api/echelons/foo', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert client.get('/api/echelons', headers={'If-None-Match': listing}).status_code == 304
+    # Only the versions were read
+    assert manager.query_count - reads == 2
+
+    manager.define_echelon('bar')
+    assert client.get('/api/echelons/foo', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/api/echelons', headers={'If-None-Match': listing}).status_code == 200
+
+    client.post('/api/echelons/foo', json={'name': 'Foo'})
+    response = client.get('/api/echelons/foo', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert get_response_json(response)['name'] == 'Foo'
+
+    # Version 0 is never a match, an Echelon which was never written may not exist
+    assert manager.version('missing') == 0
+    assert client.get('/api/echelons/missing', headers={'If-None-Match': '"0"'}).status_code == 404
+    manager.define_echelon('new')
+    assert manager.version('new') >= 1
+    # Defined without a manager, so never versioned
+    manager.backend.define('legacy', 'Legacy', 'Legacy help')
+    response = client.get('/api/echelons/legacy', headers={'If-None-Match': '"0"'})
+    assert response.status_code == 200 and 'ETag' not in response.headers
+
+
+def test_010_members(app, client):
+    manager = app.echelon_manager
+    manager.define_echelon('foo')
+    manager.define_echelon('foo::bar')
+    manager.add_member('foo', 'john117', MemberTypes.USER)
+    manager.add_member('foo::bar', ['john117', 'cortana'], MemberTypes.USER)
+    manager.add_member('foo::bar', 'spartans', MemberTypes.GROUP)
+
+    expected = [{'member': 'john117', 'member_type': 'users', 'echelon': 'foo'},
+                {'member': 'cortana', 'member_type': 'users', 'echelon': 'foo::bar'},
+                {'member': 'spartans', 'member_type': 'groups', 'echelon': 'foo::bar'}]
+    assert get_response_json(client.get('/api/echelons/foo::bar/members')) == expected
+    assert get_response_json(client.get('/api/echelons/foo::bar/members?member_type=groups')) == expected[2:]
+
+    response = client.get('/api/echelons/foo::bar/members', headers={'Accept': 'application/x-ndjson'})
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line) for line in response.data.decode('utf8').splitlines()] == expected
+    response = client.get('/api/echelons/foo::bar/members?format=ndjson&member_type=users')
+    assert len(response.data.decode('utf8').splitlines()) == 2
+
+    assert client.get('/api/echelons/foo/members?member_type=robots').status_code == 400
+
+
+def test_011_edit_echelon_atomic(app, client, foo):
+    """An edit is a single write however many changes it carries"""
+    manager = app.echelon_manager
+    resource = f'/api/echelons/{foo["echelon"]}'
+    client.post(resource, json={'add': {'users': ['john117', 'kelly087']}})
+    writes = manager.query_count
+    response = client.post(resource, json={'name': 'Renamed', 'add': {'users': ['dutch'], 'groups': ['odst']},
+                                           'remove': {'users': ['kelly087']}})
+    assert response.status_code == 200
+    # The write and the generation bump
+    assert manager.query_count - writes == 3
+    e = get_response_json(client.get(resource))
+    assert (e['name'], e['users'], e['groups']) == ('Renamed', ['john117', 'dutch'], ['odst'])
+    assert client.post(resource, json={'add': {'members': ['x']}}).status_code == 400
+    assert client.post(resource, json={'add': ['bob']}).status_code == 400
+    assert client.post(resource, json={'remove': 'bob'}).status_code == 400
+    assert client.post(resource, json=['bob']).status_code == 400
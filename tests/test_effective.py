@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_effective
+----------------------------------
+
+Tests for the materialized effective permissions of `backends.mongo`.
+"""
+
+import itertools
+
+import pytest
+from flask import Flask
+from flask_login import UserMixin
+from pymongo import MongoClient
+
+from flask_echelon import EchelonManager, MemberTypes
+from flask_echelon.backends import MemoryBackend
+
+# only use one MongoClient instance
+DB = MongoClient().test_flask_echelon
+
+ECHELONS = ['billing', 'billing::refunds', 'billing::refunds::issue', 'billing::invoices', 'ops', 'ops::deploy']
+
+
+class User(UserMixin):
+    """Mocks Flask-Login User"""
+
+    def __init__(self, user_id, groups):
+        self.id = user_id
+        self.groups = groups
+
+
+USERS = [User('alice', []), User('bob', ['finance']), User('carol', ['support', 'finance']), User('dave', [])]
+
+
+def setup_function(function):
+    for name in ('echelons', 'echelons_meta', 'echelons_effective'):
+        DB[name].drop()
+
+
+def teardown_function(function):
+    for name in ('echelons', 'echelons_meta', 'echelons_effective'):
+        DB[name].drop()
+
+
+@pytest.fixture
+def manager():
+    manager = EchelonManager(database=DB, effective=True, generation_interval=0)
+    manager.backend.create_indexes()
+    for echelon in ECHELONS:
+        manager.define_echelon(echelon)
+    return manager
+
+
+def assert_consistent(manager):
+    """The view matches its source, and checks agree with a manager reading the source"""
+    assert manager.check_effective() == []
+    source = EchelonManager(database=DB, generation_interval=0)
+    for user, echelon in itertools.product(USERS, ECHELONS + ['billing::refunds::issue::undefined', 'undefined']):
+        assert manager.check_access(user, echelon) == source.check_access(user, echelon), (user.id, echelon)
+    for user in USERS:
+        assert manager.granted_echelons(user) == source.granted_echelons(user)
+
+
+def test_000_incremental(manager):
+    manager.add_member('billing', 'alice', MemberTypes.USER)
+    manager.add_member('billing::refunds', ['bob', 'dave'], MemberTypes.USER)
+    manager.add_member('ops', 'support', MemberTypes.GROUP)
+    assert_consistent(manager)
+    assert DB.echelons_effective.find_one({'_id': {'member_type': 'users', 'member': 'alice'}}) == {
+        '_id': {'member_type': 'users', 'member': 'alice'},
+        'granted': ['billing'],
+        'echelons': ['billing', 'billing::invoices', 'billing::refunds', 'billing::refunds::issue']}
+
+    # A new Echelon is inherited by everyone granted above it
+    manager.define_echelon('billing::refunds::approve')
+    assert manager.check_access(USERS[1], 'billing::refunds::approve')
+    assert_consistent(manager)
+
+    manager.remove_member('billing::refunds', 'dave', MemberTypes.USER)
+    assert DB.echelons_effective.find_one({'_id': {'member_type': 'users', 'member': 'dave'}}) is None
+    manager.remove_echelon('billing::refunds')
+    manager.remove_echelon('ops::deploy')
+    assert_consistent(manager)
+
+
+def test_001_bulk_and_import(manager):
+    manager.bulk_update_members([
+        {'op': 'add', 'echelon': 'billing::invoices', 'member': 'finance', 'member_type': 'groups'},
+        {'op': 'add', 'echelon': 'ops', 'member': ['alice', 'carol'], 'member_type': 'users'},
+        {'op': 'remove', 'echelon': 'ops', 'member': 'alice', 'member_type': 'users'},
+    ])
+    assert_consistent(manager)
+
+    manager.import_echelons([{'echelon': 'ops', 'users': ['dave']},
+                             {'echelon': 'ops::deploy::prod', 'groups': ['support']}])
+    assert not manager.check_access(USERS[2], 'ops')
+    assert manager.check_access(USERS[3], 'ops::deploy::prod')
+    assert_consistent(manager)
+
+
+def test_002_point_lookup(manager):
+    manager.add_member('billing', 'alice', MemberTypes.USER)
+    queries = manager.query_count
+    assert manager.check_access(USERS[0], 'billing::refunds::issue')
+    assert not manager.check_access(USERS[3], 'billing::refunds::issue')
+    # One lookup per check, however deep the Echelon
+    assert manager.query_count - queries == 2
+
+
+def test_003_rebuild_and_check(manager):
+    manager.add_member('billing', ['alice', 'bob'], MemberTypes.USER)
+    manager.add_member('ops', 'finance', MemberTypes.GROUP)
+    # Writes behind the manager's back
+    DB.echelons.update_one({'echelon': 'ops'}, {'$push': {'users': 'dave'}})
+    DB.echelons_effective.delete_one({'_id': {'member_type': 'users', 'member': 'bob'}})
+    DB.echelons_effective.update_one({'_id': {'member_type': 'users', 'member': 'alice'}},
+                                     {'$push': {'echelons': 'ops'}})
+
+    assert sorted(manager.check_effective()) == [
+        "users:alice has echelons ['billing', 'billing::invoices', 'billing::refunds', 'billing::refunds::issue', "
+        "'ops'], expected ['billing', 'billing::invoices', 'billing::refunds', 'billing::refunds::issue']",
+        'users:bob is missing from the view',
+        'users:dave is missing from the view']
+    assert manager.rebuild_effective() == 4
+    assert_consistent(manager)
+    assert set(DB.echelons_effective.index_information()) >= {'granted_1', 'echelons_1'}
+
+
+def test_004_cli(manager):
+    app = Flask(__name__)
+    manager.init_app(app)
+    runner = app.test_cli_runner()
+    manager.add_member('ops', 'alice', MemberTypes.USER)
+
+    result = runner.invoke(args=['echelon', 'check-effective'])
+    assert result.exit_code == 0 and 'consistent' in result.output
+    DB.echelons_effective.drop()
+    result = runner.invoke(args=['echelon', 'check-effective'])
+    assert result.exit_code == 1 and 'users:alice is missing from the view' in result.output
+    result = runner.invoke(args=['echelon', 'rebuild-effective'])
+    assert result.exit_code == 0 and 'of 1 members' in result.output
+    assert manager.check_effective() == []
+
+
+def test_005_unsupported():
+    with pytest.raises(NotImplementedError):
+        EchelonManager(backend=MemoryBackend()).check_effective()
+    with pytest.raises(NotImplementedError):
+        EchelonManager(database=DB).rebuild_effective()
+
+
+def test_006_apply_changes(manager):
+    manager.add_member('billing::refunds', ['bob', 'dave'], MemberTypes.USER)
+    manager.add_member('ops', 'support', MemberTypes.GROUP)
+    manager.apply_changes('billing', add={'users': ['alice', 'bob'], 'groups': 'finance'}, remove={'users': 'bob'})
+    manager.apply_changes('billing::refunds', add={'users': 'carol'}, remove={'users': 'dave'})
+    assert_consistent(manager)
+    manager.apply_changes('ops', set={'groups': ['finance']})
+    manager.apply_changes('ops::new', set={'users': ['dave']}, create=True)
+    assert_consistent(manager)
@@ -8,13 +8,20 @@ test_flask_echelon
 Tests for `flask_echelon` module.
 """
 
+import json
+import os
+import subprocess
+import sys
+import time
+
 import pytest
 from flask import Flask, _request_ctx_stack
 from flask_login import AnonymousUserMixin, LoginManager, UserMixin
 from pymongo import MongoClient
 
-from flask_echelon import AccessCheckFailed, EchelonManager, MemberTypes
-from flask_echelon.helpers import has_access, require_echelon
+from flask_echelon import AccessCheckFailed, EchelonManager, ImportFailed, MemberTypes
+from flask_echelon.backends import MemoryBackend
+from flask_echelon.helpers import EchelonRegistry, has_access, has_access_many, require_echelon
 
 # only use one MongoClient instance
 DB = MongoClient().test_flask_echelon
@@ -49,10 +56,12 @@ def foobarbaz():
 
 def setup_function(function):
     DB.echelons.drop()
+    DB.echelons_meta.drop()
 
 
 def teardown_function(function):
     DB.echelons.drop()
+    DB.echelons_meta.drop()
 
 
 def test_000_init():
@@ -340,5 +349,647 @@ def test_021__is_member():
     assert 'spam::spam::spam' not in access
 
 
+def test_022_single_query_access():
+    """Single query mode agrees with the level by level check"""
+    levels = EchelonManager(database=DB)
+    single = EchelonManager(database=DB, single_query=True)
+    levels.define_echelon('foo')
+    levels.define_echelon('foo::bar::baz')
+    levels.add_member('foo::bar::baz', 'user', MemberTypes.USER)
+    levels.add_member('foo', 'admins', MemberTypes.GROUP)
+
+    users = [User('user', []), User('admin', ['admins']), User('nobody', ['nogroup'])]
+    checks = ['foo', 'foo::bar', 'foo::bar::baz', 'foo::bar::baz::qux', 'spam::eggs']
+    for user in users:
+        for echelon in checks:
+            assert levels.check_access(user, echelon) is single.check_access(user, echelon)
+    for echelon in checks:
+        assert (levels.check_access('admins', echelon, MemberTypes.GROUP) is
+                single.check_access('admins', echelon, MemberTypes.GROUP))
+
+
+def test_023_single_query_count():
+    manager = EchelonManager(database=DB)
+    manager.define_echelon('a')
+    user = User('user', [])
+
+    before = manager.query_count
+    assert manager.check_access(user, 'a::b::c::d::e') is False
+    assert manager.query_count - before == 5
+
+    manager = EchelonManager(database=DB, single_query=True)
+    before = manager.query_count
+    assert manager.check_access(user, 'a::b::c::d::e') is False
+    assert manager.query_count - before == 1
+
+
+def test_024_decision_cache():
+    manager = EchelonManager(database=DB, cache_size=100)
+    manager.define_echelon('foo')
+    manager.define_echelon('spam')
+    user = User('user', ['group'])
+
+    assert manager.check_access(user, 'foo::bar') is False
+    assert manager.check_access(user, 'spam') is False
+    queries = manager.query_count
+    assert manager.check_access(user, 'foo::bar') is False
+    assert manager.query_count == queries
+    assert manager.cache.hits == 1
+
+    manager.add_member('foo', 'group', MemberTypes.GROUP)
+    assert len(manager.cache) == 1  # Only foo::bar was affected
+    assert manager.check_access(user, 'foo::bar') is True
+
+    manager.remove_member('foo', 'group', MemberTypes.GROUP)
+    assert manager.check_access(user, 'foo::bar') is False
+
+    manager.add_member('spam', 'someone_else', MemberTypes.USER)
+    assert len(manager.cache) == 2
+
+    manager.remove_echelon('spam')
+    assert len(manager.cache) == 1
+
+
+def test_025_decision_cache_size():
+    manager = EchelonManager(database=DB, cache_size=2)
+    user = User('user', [])
+    for echelon in ('a', 'b', 'c'):
+        manager.check_access(user, echelon)
+    assert len(manager.cache) == 2
+    assert manager.cache.evictions == 1
+
+
+def test_026_generation():
+    manager = EchelonManager(database=DB)
+    assert manager.generation == 0
+    manager.define_echelon('foo')
+    manager.add_member('foo', 'user', MemberTypes.USER)
+    manager.remove_member('foo', 'user', MemberTypes.USER)
+    manager.remove_echelon('foo')
+    assert manager.generation == 4
+
+
+def test_027_cross_process_cache():
+    """Writes from another manager drop cached decisions"""
+    reader = EchelonManager(database=DB, cache_size=100, generation_interval=0)
+    writer = EchelonManager(database=DB)
+    writer.define_echelon('foo')
+    user = User('user', [])
+
+    assert reader.check_access(user, 'foo') is False
+    writer.add_member('foo', 'user', MemberTypes.USER)
+    assert reader.check_access(user, 'foo') is True
+
+
+def test_028_generation_interval():
+    reader = EchelonManager(database=DB, cache_size=100, generation_interval=3600)
+    writer = EchelonManager(database=DB)
+    writer.define_echelon('foo')
+    user = User('user', [])
+
+    assert reader.check_access(user, 'foo') is False
+    queries = reader.query_count
+    writer.add_member('foo', 'user', MemberTypes.USER)
+    # Stale until the interval passes, without touching the database
+    assert reader.check_access(user, 'foo') is False
+    assert reader.query_count == queries
+
+    reader._generation_checked = None
+    assert reader.check_access(user, 'foo') is True
+
+
+def test_029_snapshot():
+    manager = EchelonManager(database=DB, snapshot=True)
+    manager.define_echelon('foo')
+    manager.define_echelon('foo::bar')
+    manager.define_echelon('spam')
+    manager.add_member('foo', 'user', MemberTypes.USER)
+    manager.add_member('spam', 'group', MemberTypes.GROUP)
+    user = User('user', ['group'])
+
+    assert manager.check_access(user, 'foo::bar::baz') is True
+    assert manager.check_access(User('nobody', []), 'foo') is False
+    assert manager.check_access('group', 'spam', MemberTypes.GROUP) is True
+    assert manager.member_echelons(user, MemberTypes.USER) == ['foo', 'foo::bar', 'spam']
+
+    queries = manager.query_count
+    manager.check_access(user, 'spam')
+    manager.member_echelons(user, MemberTypes.USER)
+    assert manager.query_count == queries
+
+
+def test_030_snapshot_rebuild():
+    manager = EchelonManager(database=DB, snapshot=True)
+    manager.define_echelon('foo')
+    user = User('user', [])
+    assert manager.check_access(user, 'foo') is False
+
+    snapshot = manager.snapshot
+    manager.add_member('foo', 'user', MemberTypes.USER)
+    deadline = time.monotonic() + 5
+    while manager.snapshot is snapshot and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert manager.check_access(user, 'foo') is True
+
+
+def test_031_member_echelons_queries():
+    manager = EchelonManager(database=DB)
+    for echelon in ('foo', 'foo::bar', 'foo::bar::baz', 'foobar', 'ham', 'ham::spam', 'eggs::ham'):
+        manager.define_echelon(echelon)
+    manager.add_member('foo', 'user', MemberTypes.USER)
+    manager.add_member('foo::bar', 'group', MemberTypes.GROUP)
+    manager.add_member('ham::spam', 'group', MemberTypes.GROUP)
+    user = User('user', ['group'])
+
+    queries = manager.query_count
+    access = manager.member_echelons(user, MemberTypes.USER)
+    assert manager.query_count - queries == 2
+    assert access == ['foo', 'foo::bar', 'foo::bar::baz', 'ham::spam']
+    assert access == [e for e in manager.all_echelons if manager.check_access(user, e)]
+
+    assert manager.member_echelons('group', MemberTypes.GROUP) == ['foo::bar', 'foo::bar::baz', 'ham::spam']
+    assert manager.member_echelons(User('nobody', []), MemberTypes.USER) == []
+
+
+@pytest.mark.parametrize('options', [{}, {'cache_size': 100}, {'snapshot': True}])
+def test_032_check_access_many(options):
+    manager = EchelonManager(database=DB, **options)
+    manager.define_echelon('nav')
+    manager.define_echelon('nav::admin')
+    manager.define_echelon('nav::reports')
+    manager.add_member('nav::reports', 'user', MemberTypes.USER)
+    manager.add_member('nav::admin', 'admins', MemberTypes.GROUP)
+    user = User('user', [])
+    admin = User('admin', ['admins'])
+    echelons = ['nav', 'nav::admin', 'nav::admin::users', 'nav::reports', 'nav::reports::daily']
+
+    for member in (user, admin):
+        access = manager.check_access_many(member, echelons)
+        assert access == {echelon: manager.check_access(member, echelon) for echelon in echelons}
+    assert manager.check_access_many('admins', echelons, MemberTypes.GROUP)['nav::admin::users'] is True
+
+    queries = manager.query_count
+    manager.check_access_many(User('other', ['others']), echelons)
+    assert manager.query_count - queries <= 1
+
+
+def test_033_helper_has_access_many():
+    app = Flask(__name__)
+    LoginManager(app)
+    manager = EchelonManager(app, database=DB)
+    manager.define_echelon('foo')
+    user = User('user1', ['group1'])
+    manager.add_member('foo', 'group1', MemberTypes.GROUP)
+
+    with app.test_request_context():
+        _request_ctx_stack.top.user = user
+        assert has_access_many(['foo::bar', 'spam']) == {'foo::bar': True, 'spam': False}
+
+
+def test_034_helper_request_memo():
+    app = Flask(__name__)
+    LoginManager(app)
+    manager = EchelonManager(app, database=DB)
+    manager.define_echelon('foo')
+    manager.define_echelon('spam')
+    user = User('user1', ['group1'])
+    manager.add_member('foo', 'group1', MemberTypes.GROUP)
+
+    @require_echelon('foo::bar')
+    def view():
+        return has_access('foo') and not has_access('spam')
+
+    with app.test_request_context():
+        _request_ctx_stack.top.user = user
+        queries = manager.query_count
+        assert view()
+        assert has_access('foo::bar::baz')
+        assert manager.query_count - queries == 1
+
+        manager.add_member('spam', 'user1', MemberTypes.USER)
+        assert not has_access('spam')
+        assert has_access('spam', memoize=False)
+
+    with app.test_request_context():
+        _request_ctx_stack.top.user = user
+        assert has_access('spam')
+
+
+def test_035_groups_resolved_once():
+    class CountingUser(User):
+        lookups = 0
+
+        @property
+        def groups(self):
+            CountingUser.lookups += 1
+            return self._groups
+
+    manager = EchelonManager(database=DB)
+    manager.define_echelon('a::b::c::d::e')
+    user = CountingUser('user', ['group'])
+
+    assert manager.check_access(user, 'a::b::c::d::e') is False
+    assert CountingUser.lookups == 1
+
+
+def test_036_group_resolver():
+    directory = {'user': ['admins']}
+    calls = []
+
+    def resolver(user):
+        calls.append(user.get_id())
+        return directory[user.get_id()]
+
+    manager = EchelonManager(database=DB, group_resolver=resolver, group_cache_size=10)
+    manager.define_echelon('foo')
+    manager.add_member('foo', 'admins', MemberTypes.GROUP)
+    user = User('user', [])
+
+    assert manager.check_access(user, 'foo') is True
+    assert manager.check_access(user, 'foo::bar') is True
+    assert manager.member_echelons(user, MemberTypes.USER) == ['foo']
+    assert calls == ['user']
+    assert manager.group_cache.hits == 2
+
+
+def test_037_bulk_update_members():
+    manager = EchelonManager(database=DB, cache_size=100)
+    for echelon in ('a', 'b', 'c'):
+        manager.define_echelon(echelon)
+    user = User('user', ['group'])
+    assert manager.check_access(user, 'c') is False
+
+    ops = [{'op': 'add', 'echelon': echelon, 'member': 'user', 'member_type': MemberTypes.USER}
+           for echelon in ('a', 'b')]
+    ops += [{'op': 'add', 'echelon': 'c', 'member': ['group', 'other'], 'member_type': 'groups'},
+            {'op': 'remove', 'echelon': 'c', 'member': 'other', 'member_type': 'groups'}]
+    generation = manager.generation
+    results = manager.bulk_update_members(ops, batch_size=3)
+    assert [r['operations'] for r in results] == [3, 1]
+    assert manager.generation == generation + 2
+    assert manager.check_access_many(user, ['a', 'b', 'c']) == {'a': True, 'b': True, 'c': True}
+    assert manager.get_echelon('c')['groups'] == ['group']
+
+    with pytest.raises(ValueError):
+        manager.bulk_update_members([{'op': 'replace', 'echelon': 'a', 'member': 'x', 'member_type': 'users'}])
+    with pytest.raises(ValueError):
+        manager.bulk_update_members(ops, batch_size=0)
+
+    # An invalid op late in the list fails the call before any batch is written
+    generation = manager.generation
+    with pytest.raises(ValueError):
+        manager.bulk_update_members([{'op': 'remove', 'echelon': 'a', 'member': 'user', 'member_type': 'users'},
+                                     {'op': 'replace', 'echelon': 'b', 'member': 'x', 'member_type': 'users'}],
+                                    batch_size=1)
+    assert manager.generation == generation
+    assert manager.check_access(user, 'a') is True
+
+
+def test_038_export_import():
+    source = EchelonManager(database=DB)
+    source.define_echelon('foo', help='Foo help')
+    source.define_echelon('foo::bar')
+    source.add_member('foo', ['user', 'admin'], MemberTypes.USER)
+    source.add_member('foo::bar', 'group', MemberTypes.GROUP)
+    lines = [json.dumps(echelon) + '\n' for echelon in source.export_echelons(batch_size=1)]
+
+    target = EchelonManager(backend=MemoryBackend(), cache_size=10)
+    user = User('user', [])
+    assert target.check_access(user, 'foo') is False
+    assert target.import_echelons(lines + ['\n'], batch_size=1) == 2
+    assert target.all_echelons == source.all_echelons
+    assert target.check_access(user, 'foo') is True
+
+    with pytest.raises(ValueError):
+        target.import_echelons(['{"echelon": "::foo"}'])
+    with pytest.raises(ValueError):
+        target.import_echelons(lines, batch_size=0)
+    with pytest.raises(ValueError):
+        source.export_echelons(batch_size=0)
+
+    # Members must be lists, a bare string is never split into characters
+    with pytest.raises(ImportFailed) as failed:
+        target.import_echelons([{'echelon': 'spam', 'users': 'alice'}])
+    assert failed.value.imported == 0
+    assert target.get_echelon('spam') is None
+
+    # Batches written before an invalid document are reported
+    with pytest.raises(ImportFailed) as failed:
+        target.import_echelons([{'echelon': 'spam'}, {'echelon': 'eggs'}, {'echelon': 'ham', 'groups': 'staff'}],
+                               batch_size=2)
+    assert failed.value.imported == 2
+    assert target.get_echelon('eggs') is not None and target.get_echelon('ham') is None
+
+
+def test_039_versions():
+    """Every write to an Echelon, from any manager, changes its version"""
+    reader = EchelonManager(database=DB, generation_interval=3600)
+    writer = EchelonManager(database=DB)
+    assert reader.version('foo') == 0
+    writer.define_echelon('foo')
+    writer.define_echelon('bar')
+    foo = reader.version('foo')
+    assert reader.version() == 2
+    writer.bulk_update_members([{'op': 'add', 'echelon': 'bar', 'member': 'user', 'member_type': MemberTypes.USER}])
+    assert reader.version('foo') == foo
+    assert reader.version('bar') == reader.version() == 3
+
+
+def test_040_permission_tokens():
+    app = Flask(__name__)
+    app.secret_key = 'secret'
+    LoginManager(app)
+    manager = EchelonManager(app, database=DB)
+    for echelon in ('foo', 'foo::bar', 'foo::bar::baz', 'spam', 'eggs::ham'):
+        manager.define_echelon(echelon)
+    manager.add_member('foo', 'group1', MemberTypes.GROUP)
+    manager.add_member('foo::bar', 'user1', MemberTypes.USER)
+    manager.add_member('eggs::ham', 'user1', MemberTypes.USER)
+    user = User('user1', ['group1'])
+
+    with app.app_context():
+        token = manager.issue_token(user)
+        permissions = manager.read_token(token)
+    assert permissions.member == 'user1'
+    assert permissions.member_type is MemberTypes.USER
+    assert permissions.echelons == {'foo', 'eggs::ham'}
+    assert permissions.version == manager.generation
+
+    # Answered without the database, even for a member who is not logged in
+    with app.test_request_context():
+        _request_ctx_stack.top.user = AnonUser('anonymous')
+        queries = manager.query_count
+        assert has_access('foo::bar::baz::undefined', token=token)
+        assert has_access('eggs::ham', token=token)
+        assert not has_access('eggs', token=token)
+        assert not has_access('spam', token=token)
+        assert manager.query_count == queries
+
+    assert manager.read_token(token, secret_key='other') is None
+    assert manager.read_token(token + 'x', secret_key='secret') is None
+    with app.app_context():
+        assert manager.read_token(manager.issue_token(user, expires_in=-1)) is None
+    with pytest.raises(Exception):
+        EchelonManager(database=DB).issue_token(user)
+
+
+def test_041_permission_tokens_stale():
+    """Tokens are stale after any write, checks then fall back to the database"""
+    app = Flask(__name__)
+    app.secret_key = 'secret'
+    LoginManager(app)
+    manager = EchelonManager(app, database=DB, generation_interval=0)
+    manager.define_echelon('foo')
+    manager.add_member('foo', 'group1', MemberTypes.GROUP)
+    user = User('user1', [])
+
+    with app.test_request_context():
+        _request_ctx_stack.top.user = user
+        token = manager.issue_token('group1', MemberTypes.GROUP)
+        assert has_access('foo', token=token)
+        manager.remove_member('foo', 'group1', MemberTypes.GROUP)
+        assert manager.read_token(token) is None
+        assert not has_access('foo', token=token)
+
+
+def test_042_permission_tokens_snapshot():
+    app = Flask(__name__)
+    app.secret_key = 'secret'
+    manager = EchelonManager(app, database=DB, snapshot='bitset')
+    manager.define_echelon('foo::bar')
+    manager.add_member('foo::bar', 'user1', MemberTypes.USER)
+    with app.app_context():
+        permissions = manager.read_token(manager.issue_token(User('user1', [])))
+    assert permissions.echelons == {'foo::bar'}
+    assert permissions.version == manager.snapshot.generation
+
+
+def test_043_mapped_snapshot(tmp_path):
+    """Workers map the file written by one process and remap once it is replaced"""
+    path = str(tmp_path / 'echelons.snapshot')
+    app = Flask(__name__)
+    writer = EchelonManager(app, database=DB)
+    writer.define_echelon('foo')
+    writer.add_member('foo', 'user1', MemberTypes.USER)
+    worker = EchelonManager(database=DB, snapshot='mmap', snapshot_path=path, snapshot_interval=3600)
+    user = User('user1', ['group1'])
+
+    # The first worker to start writes the missing file
+    assert worker.check_access(user, 'foo::bar')
+    queries = worker.query_count
+    assert not worker.check_access(user, 'spam')
+    assert worker.member_echelons(user, MemberTypes.USER) == ['foo']
+    assert worker.query_count == queries
+
+    writer.define_echelon('spam')
+    writer.add_member('spam', 'group1', MemberTypes.GROUP)
+    result = app.test_cli_runner().invoke(args=['echelon', 'write-snapshot', path])
+    assert result.exit_code == 0, result.output
+    assert 'generation {}'.format(writer.version()) in result.output
+    assert not worker.check_access(user, 'spam')
+    worker.refresh_snapshot()
+    assert worker.check_access(user, 'spam')
+    assert worker.snapshot.generation == writer.version()
+
+    with pytest.raises(ValueError):
+        EchelonManager(database=DB, snapshot='mmap')
+
+
+def test_044_registry():
+    """Guarded Echelons are split once, when decorated"""
+    from flask import Blueprint
+
+    registry = EchelonRegistry()
+    app = Flask(__name__)
+    LoginManager(app)
+    manager = EchelonManager(app, database=DB)
+    registry.init_app(app)
+    manager.define_echelon('foo')
+    manager.add_member('foo', 'group1', MemberTypes.GROUP)
+
+    admin = Blueprint('admin', __name__)
+    registry.guard(admin, 'foo::admin')
+
+    @admin.route('/admin/')
+    def admin_index():
+        return 'admin'
+
+    @app.route('/foo')
+    @registry.require('foo::bar')
+    def foo():
+        return 'foo'
+
+    @app.route('/spam')
+    @registry.require('spam')
+    def spam():
+        return 'spam'
+
+    @app.route('/open')
+    def open_view():
+        return 'open'
+
+    app.register_blueprint(admin)
+    assert registry.echelons == {'foo::admin', 'foo::bar', 'spam'}
+    assert registry.register('foo::bar') == ('foo', 'foo::bar')
+    with pytest.raises(ValueError):
+        registry.require('::foo')
+
+    with app.test_request_context():
+        _request_ctx_stack.top.user = User('user1', ['group1'])
+        assert foo() == 'foo'
+        with pytest.raises(AccessCheckFailed):
+            spam()
+        assert app.preprocess_request() is None
+
+    with app.test_request_context('/admin/'):
+        _request_ctx_stack.top.user = User('user1', ['group1'])
+        assert app.preprocess_request() is None
+        _request_ctx_stack.top.user = User('user2', [])
+        with pytest.raises(AccessCheckFailed):
+            app.preprocess_request()
+
+    policy = {route['endpoint']: route['echelons'] for route in registry.policy(app)}
+    assert policy['admin.admin_index'] == ['foo::admin']
+    assert policy['foo'] == ['foo::bar'] and policy['spam'] == ['spam']
+    assert policy['open_view'] == []
+    assert registry.missing(app) == ['foo::admin', 'foo::bar', 'spam']
+
+
+def test_045_registry_audit(caplog):
+    registry = EchelonRegistry(separator='|')
+    app = Flask(__name__)
+    LoginManager(app)
+    manager = EchelonManager(app, database=DB, separator='|')
+    registry.init_app(app)
+    manager.define_echelon('foo')
+    manager.add_member('foo', 'user1', MemberTypes.USER)
+
+    @app.route('/foo')
+    @registry.require('foo|bar')
+    def foo():
+        return 'foo'
+
+    @app.route('/spam')
+    @registry.require('spam')
+    def spam():
+        return 'spam'
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['echelon', 'audit'])
+    assert result.exit_code == 1
+    assert 'foo|bar' in result.output and 'Echelon "spam" is not defined' in result.output
+
+    manager.define_echelon('foo|bar')
+    manager.define_echelon('spam')
+    result = runner.invoke(args=['echelon', 'audit', '--all'])
+    assert result.exit_code == 0, result.output
+    assert '/static/<path:filename>' in result.output
+
+    # Reported once, on the first request
+    manager.remove_echelon('spam')
+    with caplog.at_level('WARNING', logger='flask_echelon.helpers'):
+        app.test_client().get('/static/missing')
+        app.test_client().get('/static/missing')
+    assert [record.getMessage() for record in caplog.records].count(
+        'Echelon "spam" guards routes of {!r} but is not defined'.format(app)) == 1
+
+
+def test_046_index_modes():
+    """Indexes are created at init, on the first request, or only on demand"""
+    manager = EchelonManager(Flask(__name__), database=DB)
+    assert manager.verify_indexes() == []
+
+    DB.echelons.drop()
+    app = Flask(__name__)
+    manager = EchelonManager(app, database=DB, index_mode='manual')
+    app.test_client().get('/')
+    assert manager.verify_indexes()
+    result = app.test_cli_runner().invoke(args=['echelon', 'ensure-indexes'])
+    assert result.exit_code == 0, result.output
+    assert manager.verify_indexes() == []
+
+    DB.echelons.drop()
+    app = Flask(__name__)
+    manager = EchelonManager(app, database=DB, index_mode='deferred')
+    assert manager.query_count == 0
+    app.test_client().get('/')
+    manager._index_thread.join()
+    assert manager.verify_indexes() == []
+
+    with pytest.raises(ValueError):
+        EchelonManager(database=DB, index_mode='lazy')
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='module __getattr__ requires Python 3.7')
+def test_047_lazy_import():
+    """Importing the package does not import Flask, the manager or the blueprint"""
+    code = 'import sys, flask_echelon; print("flask" in sys.modules, "flask_echelon.api" in sys.modules)'
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert output.split() == [b'False', b'False']
+
+
+def test_048_registry_report_failure(caplog):
+    """An unavailable backend is logged on the first request, never failing it"""
+    class Unavailable(MemoryBackend):
+        def find_levels(self, levels):
+            raise Exception('backend unavailable')
+
+        def create_indexes(self):
+            raise Exception('backend unavailable')
+
+    registry = EchelonRegistry()
+    app = Flask(__name__)
+    LoginManager(app)
+    manager = EchelonManager(app, backend=Unavailable(), index_mode='deferred')
+    registry.init_app(app)
+
+    @app.route('/guarded')
+    @registry.require('foo')
+    def guarded():
+        return 'guarded'
+
+    @app.route('/open')
+    def open_view():
+        return 'open'
+
+    client = app.test_client()
+    with caplog.at_level('ERROR'):
+        assert [client.get('/open').status_code for _ in range(3)] == [200, 200, 200]
+    manager._index_thread.join()
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(message.startswith('Failed to audit') for message in messages)
+    assert messages.count('Failed to create Echelon indexes, run `flask echelon ensure-indexes`') == 1
+
+
+def test_049_registry_separators():
+    """Managers with different separators share a registry without changing it"""
+    registry = EchelonRegistry()
+
+    @registry.require('foo|bar')
+    def view():
+        return 'view'
+
+    apps = []
+    for separator in ('::', '|'):
+        app = Flask(__name__)
+        LoginManager(app)
+        manager = EchelonManager(app, backend=MemoryBackend(), separator=separator)
+        manager.define_echelon('foo')
+        manager.add_member('foo', 'user1', MemberTypes.USER)
+        apps.append(app)
+
+    for _ in range(2):
+        for app, allowed in zip(apps, (False, True)):
+            with app.test_request_context():
+                _request_ctx_stack.top.user = User('user1', [])
+                if allowed:
+                    assert view() == 'view'
+                else:
+                    with pytest.raises(AccessCheckFailed):
+                        view()
+    assert registry.separator == '::'
+    assert registry.register('foo|bar') == ('foo|bar',)
+
+
 if __name__ == "__main__":
     pytest.main()
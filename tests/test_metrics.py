@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_metrics
+----------------------------------
+
+Tests for `metrics` module.
+"""
+
+import pytest
+from flask.signals import signals_available
+from flask_login import UserMixin
+
+from flask_echelon import EchelonManager, MemberTypes
+from flask_echelon.backends import MemoryBackend
+from flask_echelon.metrics import InMemoryMetrics, MetricsSink, access_checked, operation_completed
+
+
+class User(UserMixin):
+    """Mocks Flask-Login User"""
+
+    def __init__(self, user_id, groups):
+        self.id = user_id
+        self.groups = groups
+
+
+def populated(**kwargs):
+    manager = EchelonManager(backend=MemoryBackend(), **kwargs)
+    for echelon in ('foo', 'foo::bar', 'foo::bar::baz'):
+        manager.define_echelon(echelon)
+    manager.add_member('foo::bar', 'user', MemberTypes.USER)
+    manager.add_member('foo', 'staff', MemberTypes.GROUP)
+    return manager
+
+
+def test_000_off_by_default():
+    manager = populated()
+    assert manager.metrics is None
+    assert 'check_access' not in vars(manager)
+
+    metrics = manager.instrument([InMemoryMetrics()])
+    assert metrics.installed and 'check_access' in vars(manager)
+    manager.uninstrument()
+    assert not metrics.installed and manager.metrics is None
+    assert manager.check_access(User('user', []), 'foo::bar') is True
+
+
+@pytest.mark.parametrize('options', [{}, {'single_query': True}, {'snapshot': True}],
+                         ids=['levels', 'single_query', 'snapshot'])
+def test_001_granting_level(options):
+    manager = populated(**options)
+    sink = InMemoryMetrics()
+    manager.instrument([sink])
+
+    assert manager.check_access(User('user', []), 'foo::bar::baz') is True
+    assert manager.check_access(User('user', ['staff']), 'foo::bar::baz') is True
+    assert manager.check_access(User('nobody', []), 'foo::bar::baz') is False
+    assert sink.granted_depths == {1: 1, 0: 1}
+    assert sink.denied == 1
+
+    summary = sink.summary()
+    assert summary['check_access']['calls'] == 3
+    assert sum(summary['check_access']['histogram'].values()) == 3
+    if options.get('snapshot'):
+        assert '_check_hierarchy' not in summary
+    else:
+        assert summary['_check_hierarchy']['calls'] == 3
+        # One query per level until a grant is found, or one in total
+        assert summary['check_access']['round_trips'] == (3 if options else 2 + 1 + 3)
+
+
+def test_002_cache_hits():
+    manager = populated(cache_size=10)
+    sink = InMemoryMetrics()
+    metrics = manager.instrument([sink])
+    assert metrics.cache_hit_ratio() is None
+
+    user = User('user', [])
+    assert manager.check_access(user, 'foo::bar') is True
+    assert manager.check_access(user, 'foo::bar') is True
+    assert sink.cached == 1
+    assert sink.granted_depths == {1: 1}
+    assert metrics.cache_hit_ratio() == 0.5
+
+
+def test_003_writes_and_errors():
+    manager = populated()
+    sink = InMemoryMetrics()
+    manager.instrument([sink])
+
+    manager.add_member('foo', 'other', MemberTypes.USER)
+    with pytest.raises(TypeError):
+        manager.add_member('foo', 'other', 'users')
+    manager.bulk_update_members([{'op': 'remove', 'echelon': 'foo', 'member': 'other', 'member_type': 'users'}])
+    summary = sink.summary()
+    assert summary['add_member']['calls'] == 2
+    assert summary['add_member']['errors'] == 1
+    assert summary['bulk_update_members']['round_trips'] > 0
+
+
+@pytest.mark.skipif(not signals_available, reason='signals require blinker')
+def test_004_signals():
+    manager = populated()
+    manager.instrument()
+    operations, accesses = [], []
+
+    def on_operation(sender, **kwargs):
+        operations.append(kwargs['operation'])
+
+    def on_access(sender, **kwargs):
+        accesses.append((sender, kwargs['level'], kwargs['depth']))
+
+    with operation_completed.connected_to(on_operation, manager), access_checked.connected_to(on_access, manager):
+        manager.check_access(User('user', []), 'foo::bar::baz')
+    assert operations == ['_check_hierarchy', 'check_access']
+    assert accesses == [(manager, 'foo::bar', 1)]
+
+
+def test_005_custom_sink():
+    class Recorder(MetricsSink):
+        def __init__(self):
+            self.operations = []
+
+        def operation(self, operation, duration, round_trips, error=None):
+            self.operations.append((operation, round_trips))
+
+    recorder = Recorder()
+    manager = populated(metrics=[recorder])
+    assert recorder.operations[:2] == [('define_echelon', 2), ('define_echelon', 2)]
+    del recorder.operations[:]
+    manager.member_echelons(User('user', []), MemberTypes.USER)
+    assert recorder.operations == [('granted_echelons', 1), ('member_echelons', 2)]
+
+
+@pytest.mark.parametrize('options', [{}, {'single_query': True}], ids=['levels', 'single_query'])
+def test_006_same_queries(options):
+    """Instrumenting a manager never changes the queries it makes"""
+    class Recording(MemoryBackend):
+        def __init__(self):
+            super().__init__()
+            self.calls = []
+
+        def is_member(self, users, groups, levels):
+            self.calls.append(('is_member', tuple(levels)))
+            return super().is_member(users, groups, levels)
+
+        def granted(self, users, groups, levels=None):
+            self.calls.append(('granted', levels and tuple(levels)))
+            return super().granted(users, groups, levels)
+
+    calls = []
+    for metrics in (None, [InMemoryMetrics()]):
+        manager = EchelonManager(backend=Recording(), metrics=metrics, **options)
+        manager.define_echelon('foo')
+        manager.add_member('foo', 'user', MemberTypes.USER)
+        manager.check_access(User('user', []), 'foo::bar')
+        manager.check_access(User('nobody', []), 'foo::bar')
+        calls.append(manager.backend.calls)
+    assert calls[0] == calls[1]
+    assert calls[0]
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_snapshot
+----------------------------------
+
+Tests for `snapshot` module.
+"""
+
+import random
+
+import pytest
+from flask_login import AnonymousUserMixin, UserMixin
+
+from flask_echelon import EchelonManager, MemberTypes
+from flask_echelon.backends import MemoryBackend
+from flask_echelon.snapshot import BitsetSnapshot, EchelonSnapshot, MappedSnapshot, write_snapshot
+
+DOCUMENTS = [{'echelon': 'foo', 'users': ['admin'], 'groups': []},
+             {'echelon': 'foo::bar', 'users': [], 'groups': []},
+             {'echelon': 'foo::bar::baz', 'users': ['user'], 'groups': ['staff']},
+             {'echelon': 'spam', 'users': [], 'groups': ['staff']},
+             {'echelon': 'ham::eggs', 'users': ['user'], 'groups': []}]
+
+
+def test_000_check():
+    snapshot = EchelonSnapshot(DOCUMENTS)
+    assert len(snapshot) == 5
+    assert snapshot.check('foo::bar::baz::qux', users={'admin'})
+    assert snapshot.check('foo::bar::baz', users={'user'})
+    assert not snapshot.check('foo::bar', users={'user'})
+    assert snapshot.check('spam', groups={'staff'})
+    assert not snapshot.check('ham', users={'user'})
+    assert not snapshot.check('undefined', users={'admin'})
+
+
+def test_001_member_echelons():
+    snapshot = EchelonSnapshot(DOCUMENTS)
+    assert snapshot.member_echelons(users={'admin'}) == ['foo', 'foo::bar', 'foo::bar::baz']
+    assert snapshot.member_echelons(users={'user'}) == ['foo::bar::baz', 'ham::eggs']
+    assert snapshot.member_echelons(groups={'staff'}) == ['foo::bar::baz', 'spam']
+    assert snapshot.member_echelons(users={'nobody'}) == []
+
+
+def test_002_custom_separator():
+    snapshot = EchelonSnapshot([{'echelon': 'foo|bar', 'users': ['user']}], separator='|')
+    assert snapshot.check('foo|bar|baz', users={'user'})
+    assert not snapshot.check('foo::bar', users={'user'})
+
+
+def test_003_granting_level():
+    snapshot = EchelonSnapshot(DOCUMENTS)
+    assert snapshot.granting_level('foo::bar::baz::qux', users={'admin', 'user'}) == 'foo'
+    assert snapshot.granting_level('foo::bar::baz', groups={'staff'}) == 'foo::bar::baz'
+    assert snapshot.granting_level('foo::bar', users={'user'}) is None
+
+
+def bitset(documents=DOCUMENTS, separator='::'):
+    ids = {d['echelon']: i for i, d in enumerate(reversed(documents))}
+    return BitsetSnapshot(documents, ids, separator)
+
+
+def test_004_bitset():
+    snapshot = bitset()
+    assert len(snapshot) == 5
+    assert snapshot.check('foo::bar::baz::qux', users={'admin'})
+    assert snapshot.check('foo::bar::baz', users={'user'})
+    assert not snapshot.check('foo::bar', users={'user'})
+    assert snapshot.check('spam', groups={'staff'})
+    assert not snapshot.check('ham', users={'user'})
+    assert not snapshot.check('undefined', users={'admin'})
+    assert snapshot.check_many(['foo::bar', 'spam::eggs', 'ham::eggs'], users={'user'}, groups={'staff'}) == \
+        {'foo::bar': False, 'spam::eggs': True, 'ham::eggs': True}
+
+    assert snapshot.member_echelons(users={'admin'}) == ['foo', 'foo::bar', 'foo::bar::baz']
+    assert snapshot.member_echelons(users={'user'}, groups={'staff'}) == ['foo::bar::baz', 'spam', 'ham::eggs']
+    assert snapshot.granted(users={'user'}) == {'foo::bar::baz', 'ham::eggs'}
+    assert snapshot.granting_level('foo::bar::baz::qux', users={'admin', 'user'}) == 'foo'
+    assert snapshot.mask(groups={'staff'}, effective=False) == 1 << 2 | 1 << 1
+    assert bitset([{'echelon': 'foo|bar', 'users': ['user']}], separator='|').check('foo|bar|baz', users={'user'})
+
+
+def test_005_bitset_matches_sets():
+    rng = random.Random(0)
+    echelons = ['::'.join(str(rng.randrange(3)) for _ in range(rng.randrange(1, 5))) for _ in range(60)]
+    documents = [{'echelon': e, 'users': rng.sample(range(20), 2), 'groups': rng.sample('abcdef', 1)}
+                 for e in dict.fromkeys(echelons)]
+    sets, bits = EchelonSnapshot(documents), bitset(documents)
+    probes = set(echelons) | {e + '::9' for e in echelons} | {'9'}
+    for user in range(20):
+        for groups in ({'a'}, {'b', 'c'}, set()):
+            assert sets.member_echelons({user}, groups) == bits.member_echelons({user}, groups)
+            assert sets.granted({user}, groups) == bits.granted({user}, groups)
+            for echelon in probes:
+                assert sets.check(echelon, {user}, groups) == bits.check(echelon, {user}, groups)
+                assert sets.granting_level(echelon, {user}, groups) == bits.granting_level(echelon, {user}, groups)
+
+
+def test_006_mapped(tmp_path):
+    path = str(tmp_path / 'echelons.snapshot')
+    assert write_snapshot(path, DOCUMENTS, generation=3) > 0
+    snapshot = MappedSnapshot(path)
+    assert len(snapshot) == 5
+    assert snapshot.generation == 3
+    assert snapshot.check('foo::bar::baz::qux', users={'admin'})
+    assert not snapshot.check('foo::bar', users={'user'})
+    assert not snapshot.check('undefined', users={'admin'})
+    assert snapshot.check_many(['foo::bar', 'spam::eggs', 'ham::eggs'], users={'user'}, groups={'staff'}) == \
+        {'foo::bar': False, 'spam::eggs': True, 'ham::eggs': True}
+    assert snapshot.member_echelons(users={'user'}, groups={'staff'}) == ['foo::bar::baz', 'spam', 'ham::eggs']
+    assert snapshot.granting_level('foo::bar::baz::qux', users={'admin', 'user'}) == 'foo'
+
+    # Replaced atomically, the mapped file keeps answering until remapped
+    assert not snapshot.changed()
+    write_snapshot(path, [{'echelon': 'ünïcode|bar', 'users': ['user']}], separator='|')
+    assert snapshot.changed()
+    assert snapshot.check('foo', users={'admin'})
+    remapped = MappedSnapshot(path)
+    assert remapped.generation is None
+    assert remapped.check('ünïcode|bar|baz', users={'user'})
+    assert list(tmp_path.iterdir()) == [tmp_path / 'echelons.snapshot']
+
+    write_snapshot(path, [{'echelon': 'ids', 'users': [1, None, 'x'], 'groups': []}])
+    members = MappedSnapshot(path)
+    assert members.check('ids', users={1}) and members.check('ids', users={None}) and members.check('ids', {'x'})
+    assert not members.check('ids', users={'1', 1.5, True, ('x',)})
+    with pytest.raises(TypeError):
+        write_snapshot(path, [{'echelon': 'ids', 'users': [1.5]}])
+
+    (tmp_path / 'other').write_bytes(b'not a snapshot file at all, not at all')
+    with pytest.raises(ValueError):
+        MappedSnapshot(str(tmp_path / 'other'))
+
+
+def test_007_mapped_matches_sets(tmp_path):
+    rng = random.Random(1)
+    echelons = ['::'.join(str(rng.randrange(3)) for _ in range(rng.randrange(1, 5))) for _ in range(60)]
+    members = [str(i) for i in range(20)]
+    documents = [{'echelon': e, 'users': rng.sample(members, 2), 'groups': rng.sample('abcdef', 1)}
+                 for e in dict.fromkeys(echelons)]
+    write_snapshot(str(tmp_path / 'snapshot'), documents)
+    sets, mapped = EchelonSnapshot(documents), MappedSnapshot(str(tmp_path / 'snapshot'))
+    probes = set(echelons) | {e + '::9' for e in echelons} | {'9'}
+    for user in members:
+        for groups in ({'a'}, {'b', 'c'}, set()):
+            assert sets.member_echelons({user}, groups) == mapped.member_echelons({user}, groups)
+            assert sets.granted({user}, groups) == mapped.granted({user}, groups)
+            for echelon in probes:
+                assert sets.check(echelon, {user}, groups) == mapped.check(echelon, {user}, groups)
+                assert sets.granting_level(echelon, {user}, groups) == mapped.granting_level(echelon, {user}, groups)
+
+
+def test_008_mapped_manager_members(tmp_path):
+    """Anonymous and integer members survive a manager's mapped snapshot file"""
+    class User(UserMixin):
+        def __init__(self, user_id):
+            self.id = user_id
+            self.groups = []
+
+    manager = EchelonManager(backend=MemoryBackend(), snapshot='mmap', snapshot_path=str(tmp_path / 'snapshot'))
+    manager.define_echelon('anon')
+    manager.define_echelon('ids')
+    manager.add_member('anon', None, MemberTypes.USER)
+    manager.add_member('ids', [1, '2'], MemberTypes.USER)
+    manager.write_snapshot()
+    manager.refresh_snapshot()
+
+    anonymous = AnonymousUserMixin()
+    anonymous.groups = []
+    assert manager.check_access(anonymous, 'anon') is True
+    assert manager.check_access(anonymous, 'ids') is False
+    assert manager.check_access(User('2'), 'ids') is True
+    assert manager.check_access(User('1'), 'ids') is False
+    assert manager.snapshot.check('ids', users={1})